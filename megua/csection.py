@@ -203,7 +203,7 @@ AUTHOR:
 import collections
   
 #MEGUA modules
-from megua.localstore import ExIter
+from megua.localstore import ExIter, str_to_list, first_part
 
 
 
@@ -226,21 +226,20 @@ class SectionClassifier:
     def classify(self):
         """
         Classify by sections.
+
+        Sections of each exercise come from the table ``sections`` of the 
+        LocalStore (see ``LocalStore.section_rows``): ``sections_text`` is not
+        parsed again.
         """        
 
-        for row in ExIter(self.megbook_store):
-            if self.exercise_set and not row['unique_name'] in self.exercise_set:
+        for (sec_list,unique_name) in self.megbook_store.section_rows(self.max_level):
+            if self.exercise_set and not unique_name in self.exercise_set:
                 continue
-            #get a list in form ["section", "subsection", "subsubsection", ...]
-            sec_list = str_to_list(row['sections_text'])
-            if sec_list == [] or sec_list == [u'']:
-               sec_list = [ first_part(row['unique_name']) ]
-            #sec_list contain at least one element.
+            #sec_list in form ["section", "subsection", "subsubsection", ...] contains at least one element.
             if not sec_list[0] in self.contents:
                 self.contents[sec_list[0]] = Section(sec_list[0])
-            #sec_list contains less than `max_level` levels
-            subsec_list = sec_list[1:self.max_level]
-            self.contents[sec_list[0]].add(row['unique_name'],subsec_list)
+            #sec_list contains at most `max_level` levels
+            self.contents[sec_list[0]].add(unique_name,sec_list[1:])
 
 
     def textprint(self):
@@ -318,37 +317,3 @@ class Section:
         for sub in self.subsections:
             self.subsections[sub].textprint()
 
-
-
-
-
-def str_to_list(s):
-    """
-    Convert::
-  
-       'section description; subsection description; subsubsection description'
-
-    into::
-
-       [ 'section description', 'subsection description', 'subsubsection description']
-
-    """
-    sl = s.split(';')
-    for i in range(len(sl)):
-        sl[i] = sl[i].strip()
-    return sl
-
-
-def first_part(s):
-    """
-    Usually exercise are named like `E12X34_name_001` and this routine extracts `E12X34` or `top` if no underscore is present.
-    """
-    p = s.find("_")
-    p = s.find("_",p+1)
-    if p!=-1:
-        s = s[:p]
-    if s=='':
-        s = 'top'
-    return s
-
-
@@ -0,0 +1,250 @@
+# coding=utf-8
+
+r"""
+diskcache -- a directory of files addressed by the hash of their content sources.
+
+A ``DiskCache`` keeps files (images, text fragments, ...) whose names are the
+hash of everything used to produce them. For example, ``UnifiedGraphics.latex_render``
+keeps each png image under the hash of the standalone LaTeX document and of the
+resize percentage: the same tikz picture in other exercise or other ekey is not
+compiled again.
+
+The directory is shared by all processes (see ``MEGUA_CACHE_DIR`` in megoptions). Files
+are written to a temporary name and then renamed, so a reader never gets a partial file.
+When the total size is over ``maxsize`` the least recently used files are removed
+(use is recorded in the file modification time).
+
+EXAMPLES::
+
+    sage: from megua.diskcache import DiskCache
+    sage: import tempfile, os
+    sage: cache = DiskCache(tempfile.mkdtemp(), maxsize=10*1024)
+    sage: key = cache.key(u"\\documentclass{standalone}...", "50%")
+    sage: src = os.path.join(tempfile.mkdtemp(), "a.png")
+    sage: with open(src,"w") as f: f.write("png data")
+    sage: cache.has(key,'.png')
+    False
+    sage: cache.store(key,'.png',src)
+    sage: dst = os.path.join(tempfile.mkdtemp(), "b.png")
+    sage: cache.fetch(key,'.png',dst)
+    True
+    sage: open(dst).read()
+    'png data'
+
+"""
+
+
+#*****************************************************************************
+#  Distributed under the terms of the GNU General Public License (GPL)
+#                  http://www.gnu.org/licenses/
+#*****************************************************************************
+
+
+#PYTHON modules
+import os
+import shutil
+import hashlib
+import tempfile
+
+
+
+class DiskCache:
+    """
+    Files addressed by a hash key in a directory ``directory/ab/abcdef...<suffix>``.
+    """
+
+    def __init__(self,directory,maxsize=None):
+        """
+        INPUT:
+
+        - ``directory`` -- where files are kept (created if it does not exist).
+        - ``maxsize`` -- maximum total size in bytes (None: no limit).
+        """
+        self.directory = directory
+        self.maxsize = maxsize
+
+        #Estimate of total size: only this process stores are counted.
+        #When over maxsize the directory is scanned (see evict).
+        self._size = None
+
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass #other process created it
+
+
+    def __repr__(self):
+        return "DiskCache('%s')" % self.directory
+
+
+    def key(self,*parts):
+        """
+        Hash key (hexadecimal sha1) of all ``parts`` (str, unicode or others converted with repr).
+        """
+        h = hashlib.sha1()
+        for p in parts:
+            if type(p)==unicode:
+                p = p.encode('utf-8')
+            elif type(p)!=str:
+                p = repr(p)
+            h.update(p)
+            h.update('\0')
+        return h.hexdigest()
+
+
+    def pathname(self,key,suffix=''):
+        """
+        Full pathname of the cached file for ``key``.
+        """
+        return os.path.join(self.directory,key[:2],key+suffix)
+
+
+    def has(self,key,suffix=''):
+        return os.path.isfile(self.pathname(key,suffix))
+
+
+    def fetch(self,key,suffix,destination):
+        """
+        Hard link (or copy if not possible) the cached file to ``destination``.
+
+        OUTPUT:
+
+        - True if ``key`` was in cache.
+        """
+        source = self.pathname(key,suffix)
+        try:
+            os.utime(source,None) #recently used
+        except OSError:
+            return False
+
+        if os.path.exists(destination):
+            os.remove(destination)
+        try:
+            os.link(source,destination)
+        except (OSError,AttributeError):
+            try:
+                shutil.copyfile(source,destination)
+            except IOError:
+                return False #evicted meanwhile
+        return True
+
+
+    def store(self,key,suffix,source):
+        """
+        Keep a copy of file ``source`` under ``key``.
+        """
+        def copy_source(f):
+            with open(source,'rb') as fsource:
+                shutil.copyfileobj(fsource,f)
+        self._write(self.pathname(key,suffix), copy_source)
+
+
+    def read_text(self,key,suffix=''):
+        """
+        Contents (unicode) of the cached file or None if ``key`` is not in cache.
+        """
+        pathname = self.pathname(key,suffix)
+        try:
+            with open(pathname,'rb') as f:
+                text = f.read()
+            os.utime(pathname,None) #recently used
+        except (IOError,OSError):
+            return None
+        return unicode(text,'utf-8')
+
+
+    def write_text(self,key,suffix,text):
+        """
+        Keep ``text`` (unicode or utf-8 str) under ``key``.
+        """
+        if type(text)==unicode:
+            text = text.encode('utf-8')
+        self._write(self.pathname(key,suffix), lambda f: f.write(text))
+
+
+    def _write(self,target,write_function):
+        """
+        Write to a temporary file and then rename it to ``target``.
+        """
+        target_dir = os.path.dirname(target)
+        if not os.path.exists(target_dir):
+            try:
+                os.makedirs(target_dir)
+            except OSError:
+                pass #other process created it
+
+        fd,tmpname = tempfile.mkstemp(dir=target_dir,prefix='.tmp')
+        try:
+            with os.fdopen(fd,'wb') as f:
+                write_function(f)
+            os.chmod(tmpname,0644) #mkstemp creates with 0600
+            os.rename(tmpname,target)
+        except:
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+            raise
+
+        if self.maxsize:
+            if self._size is not None:
+                self._size += os.path.getsize(target)
+            if self._size is None or self._size > self.maxsize:
+                self.evict()
+
+
+    def evict(self):
+        """
+        Remove the least recently used files until total size is at most ``maxsize``.
+        """
+        files = []
+        total = 0
+        for dirpath,dirnames,filenames in os.walk(self.directory):
+            for fn in filenames:
+                if fn.startswith('.tmp'):
+                    continue #being written
+                pathname = os.path.join(dirpath,fn)
+                try:
+                    st = os.stat(pathname)
+                except OSError:
+                    continue #removed by other process
+                files.append( (st.st_mtime,st.st_size,pathname) )
+                total += st.st_size
+
+        if self.maxsize:
+            files.sort()
+            for (mtime,size,pathname) in files:
+                if total <= self.maxsize:
+                    break
+                try:
+                    os.remove(pathname)
+                except OSError:
+                    pass
+                total -= size
+
+        self._size = total
+
+
+    def clear(self):
+        """
+        Remove all cached files.
+        """
+        for entry in os.listdir(self.directory):
+            pathname = os.path.join(self.directory,entry)
+            if os.path.isdir(pathname):
+                shutil.rmtree(pathname,ignore_errors=True)
+        self._size = 0
+
+
+
+_default_cache = None
+
+def megua_cache():
+    """
+    The DiskCache configured by MEGUA_CACHE_DIR and MEGUA_CACHE_MAXSIZE (see megoptions).
+    """
+    global _default_cache
+    if _default_cache is None:
+        from megua.megoptions import MEGUA_CACHE_DIR, MEGUA_CACHE_MAXSIZE
+        _default_cache = DiskCache(MEGUA_CACHE_DIR,MEGUA_CACHE_MAXSIZE)
+    return _default_cache
+
@@ -217,6 +217,12 @@ import sys
 import re
 import codecs
 import subprocess
+import zlib
+import urlparse
+import traceback
+import time
+import functools
+from multiprocessing.pool import ThreadPool
 import requests #TODO: passar tudo da web para este módulo
 
 #import json
@@ -235,10 +241,485 @@ import requests #TODO: passar tudo da web para este módulo
 from megua.exbase import ExerciseBase
 from megua.jinjatemplates import templates
 from megua.platex import html2latex
+from megua.siacuastore import siacua_store, file_sha256
+from megua.siacuabundle import open_bundle
 from megua.megoptions import *
 
 
 
+class InvalidKeyError(Exception):
+    r"""siacua does not accept SIACUA_WEBKEY."""
+    pass
+
+
+def siacua_session(max_connections):
+    r"""
+    A ``requests.Session`` keeping alive up to ``max_connections`` connections to each host
+    (one for each thread posting with it).
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=max_connections)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def _siacua_extract(course, concepts, send_fields, ex):
+    r"""
+    Payload of ``ExSiacua.siacua`` built in a worker of ``MegBook.iter_generate``.
+    """
+    ex.course = course
+    ex.siacua_concepts = concepts
+    return ex._siacua_payload(send_fields)
+
+
+
+#Payload encodings a server accepts: it sends header X-Megua-Encoding (like "compact, gzip")
+#in its answers. Learned from each answer (see siacua_post).
+SIACUA_ENCODINGS = dict() # targeturl -> set of encodings
+
+#Size of the pieces of json encoded at a time in a streamed body (multiple of 3).
+SIACUA_BODY_CHUNK = 3*16384
+
+
+def siacua_encoding(targeturl):
+    r"""
+    Encoding of the payloads to ``targeturl``: None (the original format: json with indent=4
+    in base64), "compact" (json without spaces) or "gzip" (compact json compressed with gzip).
+
+    Only what the server said it accepts (see ``SIACUA_ENCODINGS``) and only if
+    ``MEGUA_SIACUA_COMPACT`` (see megoptions).
+    """
+    if not MEGUA_SIACUA_COMPACT:
+        return None
+    accepted = SIACUA_ENCODINGS.get(targeturl, set())
+    if 'gzip' in accepted:
+        return 'gzip'
+    if 'compact' in accepted:
+        return 'compact'
+    return None
+
+
+def siacua_body(json_send_dict, encoding, metrics):
+    r"""
+    Generator of the pieces of the urlencoded body (fields ``Encoding`` and ``Base64``)
+    with ``json_send_dict`` in a compact ``encoding`` (see ``siacua_encoding``).
+
+    The body is sent while it is encoded (http chunked transfer). The number of bytes 
+    produced is added to ``metrics['sent_bytes']``.
+    """
+    piece = "Encoding=%s&Base64=" % encoding
+    metrics['sent_bytes'] += len(piece)
+    yield piece
+
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16+zlib.MAX_WBITS) if encoding=='gzip' else None
+    pending = ''
+    for i in range(0, len(json_send_dict), SIACUA_BODY_CHUNK):
+        data = json_send_dict[i:i+SIACUA_BODY_CHUNK]
+        pending += compressor.compress(data) if compressor else data
+        n = len(pending) - len(pending)%3 #base64 of pieces with 3*k bytes can be joined
+        if n:
+            piece = urllib.quote_plus(base64.b64encode(pending[:n]))
+            pending = pending[n:]
+            metrics['sent_bytes'] += len(piece)
+            yield piece
+    if compressor:
+        pending += compressor.flush()
+    piece = urllib.quote_plus(base64.b64encode(pending))
+    metrics['sent_bytes'] += len(piece)
+    yield piece
+
+
+def siacua_post(session, targeturl, send_dict, verbose=False, metrics=None):
+    r"""
+    Post ``send_dict`` (see ``ExSiacua._siacua_json``) to ``targeturl`` with ``session``.
+
+    The payload is in the original format unless the server accepts a compact one 
+    (see ``siacua_encoding``). If given, dictionary ``metrics`` gets the ``encoding``, 
+    ``json_bytes`` (size of the json in the original format) and ``sent_bytes`` (size of the body).
+
+    OUTPUT:
+
+    - list of "New: <id>" or "Improved: <id>" (siacua) or ["ok"] (pmate).
+
+    Raises ``InvalidKeyError`` if siacua does not accept SIACUA_WEBKEY and ``SiacuaSendError`` 
+    for other answers (see ``is_transient``).
+    """
+
+    #Experiencia com Alex:
+    #como dito no email: json.dumps(texto , indent=4, sort_keys=True, ensure_ascii=False)
+    #Não deu? encoded_send_dict =  base64.b64encode( json.dumps(send_dict,ensure_ascii=True, encoding="utf-8") ) #,,  ensure_ascii=True dumps ) ) #string ASCII
+
+    if metrics is None:
+        metrics = dict()
+    encoding = siacua_encoding(targeturl)
+
+    json_send_dict =   json.dumps(send_dict, ensure_ascii=False, indent=4, sort_keys=True)
+    if type(json_send_dict)==unicode:
+        json_send_dict = json_send_dict.encode('utf-8') #payloads from the outbox have unicode fields
+    if verbose:
+        print "json_send_dict="
+        print json_send_dict
+    metrics.update(encoding=encoding, json_bytes=len(json_send_dict), sent_bytes=0)
+
+    if encoding is None:
+        base64_send_dict =  base64.b64encode( json_send_dict  )
+        metrics['sent_bytes'] = len(urllib.urlencode({'Base64': base64_send_dict}))
+        content = session.post(targeturl, data={'Base64': base64_send_dict} )
+    else:
+        json_send_dict = json.dumps(send_dict, ensure_ascii=False, separators=(',',':'), sort_keys=True)
+        if type(json_send_dict)==unicode:
+            json_send_dict = json_send_dict.encode('utf-8')
+        content = session.post(targeturl, data=siacua_body(json_send_dict, encoding, metrics),
+                               headers={'Content-Type': 'application/x-www-form-urlencoded'})
+
+    if verbose:
+        print "exsiacua.py: payload of %d bytes sent in %d bytes (encoding %s)." % (metrics['json_bytes'],metrics['sent_bytes'],encoding)
+
+    #What the server accepts next time.
+    if 'X-Megua-Encoding' in content.headers:
+        SIACUA_ENCODINGS[targeturl] = set(e.strip() for e in content.headers['X-Megua-Encoding'].split(','))
+
+    #Check content.
+    if content.status_code == 200:
+
+        if verbose:
+            print "="*30
+            print "exsiacua.py: Content has reached siacua with the following content:"
+            print "="*30
+            print dir(content) #content is has type: requests.models.Response
+            print type(content)
+            print "print content:"
+            print content
+            print "print content.headers:"
+            print content.headers
+            print "print content.text:"
+            print content.text
+            r"""
+Comentário:
+==============================
+exsiacua.py: Content has reached siacua with the following content:
+==============================
+['__attrs__', '__bool__', '__class__', '__delattr__', '__dict__', '__doc__', '__enter__', '__exit__', '__format__', '__getattribute__', '__getstate__', '__hash__', '__init__', '__iter__', '__module__', '__new__', '__nonzero__', '__reduce__', '__reduce_ex__', '__repr__', '__setattr__', '__setstate__', '__sizeof__', '__str__', '__subclasshook__', '__weakref__', '_content', '_content_consumed', '_next', 'apparent_encoding', 'close', 'connection', 'content', 'cookies', 'elapsed', 'encoding', 'headers', 'history', 'is_permanent_redirect', 'is_redirect', 'iter_content', 'iter_lines', 'json', 'links', 'next', 'ok', 'raise_for_status', 'raw', 'reason', 'request', 'status_code', 'text', 'url']
+<Response [200]>
+<form name="form1" method="post" action="./MeguaInsert.aspx" id="form1">
+<input type="hidden" name="__VIEWSTATE" id="__VIEWSTATE" value="/wEPDwULLTE1NDM3NzE5MDAPZBYCZg9kFgICBQ8PFgIeBFRleHQFO09jb3JyZXUgYWxndW0gZXJybyBhIGludGVycHJldGFyIG8gcGFyw6JtZXRybyAnc2lhY3VhX2tleScuZGRkpdRObJ5RADj/Mv9lwFaiyM40nR5duyt4BJas+6wM+Ig=" />
+
+<input type="hidden" name="__VIEWSTATEGENERATOR" id="__VIEWSTATEGENERATOR" value="F7061F0D" />
+exname: <span id="lexname">Label</span>  ekey:  <span id="lekey">Label</span>
+&nbsp;
+Resultado: <span id="resultado">Ocorreu algum erro a interpretar o parâmetro 'siacua_key'.</span>
+<br />
+
+    </form>
+exsiacua.py:  ['exsiacua.py: SomeExCodeMustBeHere']
+type(send_result)= <type 'list'>
+        """
+            
+        # Perfeito! Temos um novo exercício! id = 12
+        # Perfeito! Temos um novo exercício! id = 12
+        
+#                r"""
+#                data = response.read()
+
+        if verbose:
+            print "exsiacua.py: content.text=", content.text
+
+        if u"Muito bem, melhorou o exercício, parabéns!" in content.text:
+            akword = "Improved:"
+            choice_pattern = re.compile(r'id=(\d+)', re.DOTALL|re.UNICODE)
+        elif u"A chave não é válida" in content.text:
+            print "exsiacua.py: A chave MEGUA/SIACUA não é válida."
+            raise InvalidKeyError("Invalid key megua/siacua")
+        else:
+            choice_pattern = re.compile(r'id = (\d+)', re.DOTALL|re.UNICODE)
+            akword = "New:"
+
+        #print "exsiacua.py: data=",data
+        match_iter = re.finditer(choice_pattern,content.text) 
+        all_ids = [ "{} {}".format(akword,match.group(1)) for match in match_iter] #TODO: do this better
+
+#                """
+
+        return all_ids  #["exsiacua.py: SomeExCodeMustBeHere"]
+
+    elif content.status_code == 201:
+
+        if MEGUA_PLATFORM=='SMC':
+            sys.path.append('/cocalc/lib/python2.7/site-packages')
+            from smc_sagews.sage_salvus import salvus
+            salvus.html("<a href='%s'>%s</a><br/>" %  (content.headers['Location'],  content.headers['Location']))
+        elif MEGUA_PLATFORM=='DESKTOP':
+            print "Exsicua module say: firefox ",content.headers['Location']
+            subprocess.Popen(["firefox","-new-tab", content.headers['Location']])
+        else:
+            print "Exsiacua module say: MEGUA_PLATFORM must be properly configured at $HOME/.megua/conf.py"
+
+        return ["ok"]
+
+    else:
+
+        print "="*30
+        print "exsiacua.py: envio para base de dados não funcionou. Código:" + str(content.status_code)
+        print "="*30
+        raise SiacuaSendError("exsiacua.py: %s answered with code %d." % (targeturl,content.status_code), content.status_code)
+
+
+
+class SiacuaSendError(Exception):
+    r"""
+    siacua/pmate did not accept a post (``status_code`` is the http code).
+    """
+
+    def __init__(self, message, status_code=None):
+        Exception.__init__(self, message)
+        self.status_code = status_code
+
+
+def is_transient(error):
+    r"""
+    True if a post that failed with ``error`` could work later: no connection,
+    timeout or an error of the server (http codes 5xx).
+    """
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    if isinstance(error, SiacuaSendError):
+        return error.status_code is None or error.status_code >= 500
+    if isinstance(error, requests.HTTPError):
+        return error.response is None or error.response.status_code >= 500
+    return False
+
+
+def with_retries(function, args, retries=None, backoff=None, verbose=False):
+    r"""
+    Call ``function(*args)``. While it fails with a transient error (see ``is_transient``)
+    call it again, up to ``retries`` times, waiting ``backoff``, 2*``backoff``, 4*``backoff``, ... seconds.
+
+    None: ``MEGUA_SIACUA_RETRIES`` and ``MEGUA_SIACUA_BACKOFF`` in megoptions.
+    """
+    if retries is None:
+        retries = MEGUA_SIACUA_RETRIES
+    if backoff is None:
+        backoff = MEGUA_SIACUA_BACKOFF
+
+    attempt = 0
+    while True:
+        try:
+            return function(*args)
+        except Exception as e:
+            if attempt >= retries or not is_transient(e):
+                raise
+            delay = backoff * 2**attempt
+            if verbose:
+                print "exsiacua.py: %s Trying again in %.1f seconds." % (e,delay)
+            time.sleep(delay)
+            attempt += 1
+
+
+def siacua_imagename(course, fullpathname):
+    r"""Name of an image in siacua (see ``ExSiacua._adjust_images_url``)."""
+    return course+"_"+os.path.basename(fullpathname)
+
+
+def siacua_post_image(session, imagesurl, course, fullpathname, force=False, verbose=False, store=None):
+    r"""
+    Post image file ``fullpathname`` to ``imagesurl`` with ``session``.
+
+    The files accepted are recorded in ``store`` (None: ``siacua_store()``, see 
+    ``megua.siacuastore``): a file with the same name and contents is not sent 
+    again unless ``force`` is True.
+
+    OUTPUT:
+
+    - True if sent, False if not needed; raises ``requests.HTTPError`` if not accepted.
+    """
+
+    imagename = siacua_imagename(course,fullpathname)
+    sha256 = file_sha256(fullpathname)
+    if store is None:
+        store = siacua_store()
+    if not force and store.uploaded(course, imagesurl, imagename, sha256):
+        if verbose:
+            print "exsiacua.py: already sent:",fullpathname
+        return False
+
+    if verbose:
+        print "exsiacua.py: is going to send:",fullpathname
+
+    with open(fullpathname, 'rb') as f:
+        files = {'file': (imagename, f) }
+        r = session.post(imagesurl, files=files)
+
+    if verbose:
+        print "exsiacua.py: request response is =",r.ok
+        print "exsiacua.py: done, sending images."
+    r.raise_for_status()
+    store.record_upload(course, imagesurl, imagename, sha256)
+    return True
+
+
+
+class OutboxSender:
+    r"""
+    Posts rows of the outbox (see ``SiacuaStore.outbox_put``): the exercise and then
+    its images, each post tried again on transient errors (see ``with_retries``).
+
+    Rows are posted in a pool of ``max_uploads`` threads sharing one session (see
+    ``siacua_session``). A row sent is marked in the outbox as it arrives; a row that
+    failed stays there, with the error, to be sent by ``drain_outbox``.
+    """
+
+    def __init__(self, store, max_uploads=None, force=False, verbose=False):
+        if max_uploads is None:
+            max_uploads = MEGUA_SIACUA_UPLOADS
+        max_uploads = max(1,max_uploads)
+
+        self.store = store
+        self.force = force
+        self.verbose = verbose
+        self.session = siacua_session(max_uploads)
+        self.pool = ThreadPool(processes=max_uploads)
+        self.tasks = []
+        self.invalid_key = None
+
+
+    def submit(self, row, result=None):
+        r"""
+        Post outbox ``row`` in the pool. 
+
+        OUTPUT:
+
+        - the dictionary ``result`` (or a new one) where ``finish`` puts ``result`` (what 
+          siacua answered), ``images`` (sent), ``skipped`` (not needed), ``error`` and 
+          ``metrics`` (sizes of the payload, see ``siacua_post``).
+        """
+        if result is None:
+            result = dict(exname=row['exname'], ekey=row['ekey'], result=[], images=[], skipped=[], error=None, metrics=dict())
+
+        #An image already accepted (for other row) is skipped by the manifest (see siacua_post_image).
+        images = json.loads(row['images']) if row['imagesurl'] else []
+
+        self.tasks.append( (result, self.pool.apply_async(self._send_row,(row,images,result['metrics']))) )
+        return result
+
+
+    def _send_row(self, row, images, metrics):
+        r"""
+        Post one row (runs in the pool). Sizes of the payload go to ``metrics`` (see ``siacua_post``).
+        """
+        try:
+            if self.invalid_key:
+                raise self.invalid_key
+
+            send_dict = json.loads(row['send_dict'])
+            if self.verbose:
+                print "exsiacua.py: is going to send %s to siacua with ekey=%d."%(row['exname'],row['ekey'])
+            sent = with_retries(siacua_post, (self.session, row['target'], send_dict, self.verbose, metrics), verbose=self.verbose)
+            if self.verbose:
+                print "exsiacua.py: ",sent
+
+            sent_images = []
+            skipped = []
+            for f in images:
+                if with_retries(siacua_post_image, (self.session, row['imagesurl'], row['course'], f, self.force, self.verbose, self.store), verbose=self.verbose):
+                    sent_images.append(siacua_imagename(row['course'],f))
+                else:
+                    skipped.append(siacua_imagename(row['course'],f))
+
+        except InvalidKeyError as e:
+            self.invalid_key = e
+            self.store.outbox_failed(row['outbox_id'], str(e))
+            raise
+        except Exception:
+            self.store.outbox_failed(row['outbox_id'], traceback.format_exc())
+            raise
+
+        self.store.outbox_sent(row['outbox_id'], sent)
+        return (sent, sent_images, skipped)
+
+
+    def finish(self):
+        r"""
+        Wait for all posts.
+
+        OUTPUT:
+
+        - the list of ``result`` dictionaries (see ``submit``). Raises ``InvalidKeyError``
+          if siacua does not accept SIACUA_WEBKEY.
+        """
+        try:
+            for (result,task) in self.tasks:
+                try:
+                    (result['result'], result['images'], result['skipped']) = task.get()
+                except InvalidKeyError as e:
+                    result['error'] = str(e)
+                except Exception:
+                    result['error'] = traceback.format_exc()
+                    print "exsiacua.py: %s with ekey=%d could not be sent." % (result.get('exname',''),result['ekey'])
+        finally:
+            self.close()
+
+        if self.invalid_key:
+            raise self.invalid_key
+
+        return [result for (result,task) in self.tasks]
+
+
+    def close(self):
+        r"""
+        Wait for the posts already started and close the session.
+        """
+        self.pool.close()
+        self.pool.join()
+        self.session.close()
+
+
+
+def drain_outbox(store=None, target=None, exname=None, max_uploads=None, force=False, verbose=False, ids=None):
+    r"""
+    Post all rows waiting in the outbox (only of ``target``, exercise ``exname`` 
+    or with ``outbox_id`` in ``ids`` if given).
+
+    OUTPUT:
+
+    - list of results (see ``OutboxSender.submit``).
+
+    EXAMPLES:
+
+    Two instances with the same image sent to a local server (see ``megua.siacuaserver``)::
+
+        sage: from megua.exsiacua import drain_outbox
+        sage: from megua.siacuastore import SiacuaStore
+        sage: from megua.siacuaserver import SiacuaServer
+        sage: import tempfile, os
+        sage: d = tempfile.mkdtemp()
+        sage: store = SiacuaStore(os.path.join(d,"siacua.sqlite"))
+        sage: fn = os.path.join(d,"a.png")
+        sage: with open(fn,"w") as f: f.write("png data")
+        sage: server = SiacuaServer().start()
+        sage: for ekey in [10,11]:
+        ....:     row = store.outbox_put(server.url+"MeguaInsert.aspx", server.url+"MeguaInsert2.aspx", u"calculo3", 
+        ....:                            u"E12X34_name_001", ekey, {'exname': u'E12X34_name_001', 'ekey': str(ekey)}, [fn])
+        sage: [(r['ekey'], r['result'], r['images'], r['skipped'], r['error']) for r in drain_outbox(store, max_uploads=1)]
+        [(10, ['New: 1'], [u'calculo3_a.png'], [], None), (11, ['New: 2'], [], [u'calculo3_a.png'], None)]
+        sage: sorted(server.exercises), server.images, store.outbox_pending()
+        ([(u'E12X34_name_001', u'10'), (u'E12X34_name_001', u'11')], {'calculo3_a.png': 'png data'}, [])
+        sage: server.stop()
+    """
+    if store is None:
+        store = siacua_store()
+    sender = OutboxSender(store, max_uploads, force, verbose)
+    try:
+        for row in store.outbox_pending(target=target, exname=exname, ids=ids):
+            sender.submit(row)
+    except:
+        sender.close()
+        raise
+    return sender.finish()
+
+
+
+
 class ExSiacua(ExerciseBase):
 
     #TODO: is needed?
@@ -609,7 +1090,13 @@ class ExSiacua(ExerciseBase):
                #deprecated fields
                usernamesiacua="(no username)",
                siacuatest=None,
-               sendpost=True
+               sendpost=True,
+               #pipeline
+               targeturl=None,
+               workers=1,
+               max_uploads=None,
+               force=False,
+               bundle=None
               ):
         r"""
 
@@ -645,11 +1132,34 @@ class ExSiacua(ExerciseBase):
 
         - ``verbose``: (usually False) print the message received by siacua.
 
+        - ``targeturl``: (usually None) send to this url instead of the one of ``targetmachine``; 
+          images go to ``MeguaInsert2.aspx`` in the same place (see ``megua.siacuaserver`` for a local test server).
+
+        - ``workers``: (usually 1) number of processes generating the instances (see ``MegBook.iter_generate``).
+
+        - ``max_uploads``: maximum number of simultaneous uploads (None: ``MEGUA_SIACUA_UPLOADS`` in megoptions).
+
+        - ``force``: (usually False) send all images, even the ones the target machine already has (see ``megua.siacuastore``).
+
+        - ``bundle``: (usually None) filename (``.jsonl`` or ``.sqlite``) or open bundle where instances 
+          are written instead of being sent (see ``megua.siacuabundle`` and ``MegSiacua.siacua_replay``).
+
 
         OUTPUT:
 
         - this command prints the list of sended exercises for the siacua system.
 
+        - returns a list, in the order of ``ekeys``, of dictionaries with fields 
+          ``exname``, ``ekey``, ``result`` (what siacua answered), ``images`` (sent filenames), 
+          ``skipped`` (filenames not sent because the target machine has them), 
+          ``error`` (None or the error text) and ``metrics`` (sizes of the payload sent, see ``siacua_post``).
+
+        Each instance, as soon as it is generated (by ``workers`` processes), is kept in an outbox 
+        (see ``megua.siacuastore``) and the exercise and its images are posted in a pool
+        of ``max_uploads`` threads sharing one http session (so connections are kept alive 
+        and reused). Posts are tried again when the machine is not available (see ``with_retries``)
+        and what still could not be sent waits in the outbox for ``meg.siacua_resume()``.
+
         NOTE:
 
         - you can expotargetusernamert between 3 and 6 wrong options and 1 right.
@@ -711,55 +1221,171 @@ class ExSiacua(ExerciseBase):
             self.targetusername = "(no username)"
             self.targeturl = 'https://httpbin.org'
 
+        #Images (pmate has no url for them yet)
+        if self.targetmachine in ["siacua","siacuatest"]:
+            self.imagesurl = urlparse.urljoin(self.targeturl,'MeguaInsert2.aspx')
+        else:
+            self.imagesurl = None
+
+        if targeturl:
+            self.targeturl = targeturl
+            if self.targetmachine != "pmate":
+                self.imagesurl = urlparse.urljoin(targeturl,'MeguaInsert2.aspx')
+
 
         #Other functions might require this fields
         self.course = course
         self.verbose = verbose
         self.sendpost = sendpost
 
+        #NOTE: inside self.update (many lines above) there is
+        #extract parameters (old mode). This is the new mode:
+        self.siacua_parameters = dict(level=str(level), slip=str(slip), guess=str(guess),discr=str(discr),idtree=str(idtree))
+        self.siacua_concepts = concepts
+
+        send_fields = dict(self.siacua_parameters)
+        send_fields.update(dict({'targetusername': targetusername, 'grid2x2': grid2x2, 'targetmachine': targetmachine}))
+        send_fields.update(dict({'targetusername': targetusername, 'usernamesiacua': usernamesiacua}))
+
+        #Each instance goes to the outbox (see megua.siacuastore) and then it is posted: 
+        #what could not be sent is sent later by meg.siacua_resume().
+        #The sender (threads and http session) is created after the first instance: 
+        #with workers > 1 the processes are then already forked.
+        store = siacua_store()
+        sender = None
+
+        #Instances to a file, to be sent later.
+        writer = None
+        if bundle is not None:
+            writer = open_bundle(bundle,'a') if type(bundle) in (str,unicode) else bundle
+
+        results = []
+        queued = []
+        try:
+            for (e_number,payload,error) in self._siacua_payloads(ekeys,send_fields,workers):
+
+                result = dict(exname=self.unique_name(), ekey=e_number, result=[], images=[], skipped=[], error=error, metrics=dict())
+                results.append(result)
+                if error:
+                    print "exsiacua.py: %s with ekey=%d was not sent." % (self.unique_name(),e_number)
+                    continue
+
+                if writer:
+                    writer.add(self.targeturl, self.imagesurl, self.course, self.unique_name(), e_number,
+                               payload['send_dict'], payload['images'])
+                    continue
+
+                if not sendpost:
+                    result['result'] = self._siacua_send(payload['send_dict'])
+                    continue
+
+                row = store.outbox_put(self.targeturl, self.imagesurl, self.course, self.unique_name(), e_number,
+                                       payload['send_dict'], payload['images'])
+                if sender is None:
+                    sender = OutboxSender(store, max_uploads, force, verbose)
+                sender.submit(row,result)
+                queued.append(result)
+        except:
+            if sender:
+                sender.close()
+            raise
+        finally:
+            if writer is not None and writer is not bundle:
+                writer.close()
+
+        if writer:
+            print "exsiacua.py: %d instances of %s written to %s." % (len([r for r in results if not r['error']]),self.unique_name(),writer.filename)
+
+        if sender:
+            sender.finish()
+            not_sent = len([r for r in queued if r['error']])
+            if not_sent:
+                print "exsiacua.py: %d instances could not be sent; they wait in the outbox for meg.siacua_resume()." % not_sent
+
+        self.siacua_results = results
 
         all_answers = []
-
-        for e_number in ekeys:
-
-            #Create exercise instance
-            self.update_timed(ekey=e_number)
-
-            #NOTE: inside self.update (many lines above) there is
-            #extract parameters (old mode). This is the new mode:
-            self.siacua_parameters = dict(level=str(level), slip=str(slip), guess=str(guess),discr=str(discr),idtree=str(idtree))
-            self.siacua_concepts = concepts
-
-            assert(self.has_multiplechoicetag)
-            answer_list = self._collect_options_and_answer()
-
-            send_dict =  self._siacua_json(self.unique_name(), e_number, self._problem_whitoutmc(), answer_list, self.siacua_concepts)
-            send_dict.update(dict({'targetusername': targetusername, 'grid2x2': grid2x2, 'targetmachine': targetmachine}))
-            send_dict.update(self.siacua_parameters)
-
-            send_dict.update(dict({'targetusername': targetusername, 'usernamesiacua': usernamesiacua}))
-            if self.verbose:
-                print "exsiacua.py: is going to send %s to siacua with ekey=%d."%(self.unique_name(),e_number)
-            send_result = self._siacua_send(send_dict)
-            if self.verbose:
-                print "exsiacua.py: ",send_result
-            #print "type(send_result)=",type(send_result)
-            all_answers += send_result
-            self._send_images()
-
+        for result in results:
+            all_answers += result['result']
 
         #TODO: adaptar isto aos novos parâmetros de chamada.
         
         if all_answers:
             print 'Exercícios a consultar : ' + ', '.join(all_answers) + '.'
             if self.targetmachine != 'pmate' and sendpost:
-                if siacuatest:
+                if self.targetmachine == "siacuatest":
                     print "Abrir https://siacuatest.web.ua.pt depois de entrar no curso: Gestão Professor -- Botão 'Ler Questões'"
                 else:
                     print "Abrir https://siacua.web.ua.pt depois de entrar no curso: Gestão Professor -- Botão 'Ler Questões'"
 
+        return results
+
+
+    def _siacua_payloads(self,ekeys,send_fields,workers=1):
+        r"""
+        Generator of ``(ekey, payload, error)`` for ``siacua``: ``payload`` has
+        the ``send_dict`` and the ``images`` (full pathnames) of the instance
+        and ``error`` is None or the traceback text.
+
+        With ``workers`` > 1 instances are generated by ``MegBook.iter_generate``,
+        otherwise one at a time here. In both cases each one is given as soon as
+        it is ready (so sending starts with the first one).
+        """
+
+        if workers != 1 and self._megbook and len(ekeys)>1:
+            extract = functools.partial(_siacua_extract, self.course, self.siacua_concepts, send_fields)
+            pairs = [ (self.unique_name(),e_number) for e_number in ekeys ]
+            for r in self._megbook.iter_generate(pairs, workers=workers, extract=extract):
+                yield (r['ekey'], r['extract'], r['error'])
+        else:
+            for e_number in ekeys:
+                try:
+                    #Create exercise instance
+                    self.update_timed(ekey=e_number)
+                    payload = self._siacua_payload(send_fields)
+                except Exception:
+                    yield (e_number, None, traceback.format_exc())
+                else:
+                    yield (e_number, payload, None)
+
+
+    def _siacua_payload(self,send_fields):
+        r"""
+        What is sent to siacua for the current instance.
+        """
+
+        assert(self.has_multiplechoicetag)
+        answer_list = self._collect_options_and_answer()
+
+        send_dict =  self._siacua_json(self.unique_name(), self.ekey, self._problem_whitoutmc(), answer_list, self.siacua_concepts)
+        send_dict.update(send_fields)
+
+        return dict(send_dict=send_dict, images=sorted(self.image_fullpathnames))
+
 
-    def _send_images(self):
+    def _siacua_imagename(self,fullpathname):
+        r"""Name of the image in siacua (see ``_adjust_images_url``)."""
+        return siacua_imagename(self.course,fullpathname)
+
+
+    def _send_image(self,fullpathname,session=None,force=False):
+        r"""
+        Post one image file to ``self.imagesurl`` (see ``siacua_post_image``).
+
+        OUTPUT:
+
+        - True if sent, False if not needed; raises ``requests.HTTPError`` if not accepted.
+        """
+
+        if not (self.sendpost and self.imagesurl):
+            return False
+
+        if session is None:
+            session = requests
+        return siacua_post_image(session, self.imagesurl, self.course, fullpathname, force, self.verbose)
+
+
+    def _send_images(self,force=False):
         """Send images to siacua: now is to put them in a drpobox public folder
         # AttributeError: MegBookWeb instance has no attribute 'image_list'
         #for fn in self.image_list:
@@ -770,28 +1396,14 @@ class ExSiacua(ExerciseBase):
         print "exsiacua.py: _send_images(): This are the images to be sent:"
         print "end"
         """
-        import requests
 
         if self.verbose:
             print "exsiacua.py: self.image_fullpathnames", self.image_fullpathnames
             print "exsiacua.py: self.image_relativepathnames", self.image_relativepathnames
 
-        for f in self.image_fullpathnames:
-            if self.verbose:
-                print "exsiacua.py: is going to send:",f
-            files = {'file': (self.course+"_"+os.path.basename(f), open(f, 'rb')) }
-            if self.sendpost:
-                #TODO: pmate precisa de um URL especializado.
-                if self.targetmachine == "siacua":
-                    r = requests.post('https://siacua.web.ua.pt/MeguaInsert2.aspx', files=files)
-                    if self.verbose:
-                        print "exsiacua.py: request response is =",r.ok
-                        print "exsiacua.py: done, sending images."
-                if self.targetmachine == "siacuatest":
-                    r = requests.post('https://siacuatest.web.ua.pt/MeguaInsert2.aspx', files=files)
-                    if self.verbose:
-                        print "exsiacua.py: request response is =",r.ok
-                        print "exsiacua.py: done, sending images."
+        #TODO: pmate precisa de um URL especializado.
+        for f in sorted(self.image_fullpathnames):
+            self._send_image(f,force=force)
 
 
     def _adjust_images_url(self, input_text):
@@ -843,114 +1455,15 @@ class ExSiacua(ExerciseBase):
 
 
 
-    def _siacua_send(self, send_dict):
-
-        #Experiencia com Alex:
-        #como dito no email: json.dumps(texto , indent=4, sort_keys=True, ensure_ascii=False)
-        #Não deu? encoded_send_dict =  base64.b64encode( json.dumps(send_dict,ensure_ascii=True, encoding="utf-8") ) #,,  ensure_ascii=True dumps ) ) #string ASCII
-
-        json_send_dict =   json.dumps(send_dict, ensure_ascii=False, indent=4, sort_keys=True)
-        if self.verbose:
-            print "json_send_dict="
-            print json_send_dict
-        base64_send_dict =  base64.b64encode( json_send_dict  )
-        if self.verbose:
-            print "base64_json_send_dict="
-            print base64_send_dict
+    def _siacua_send(self, send_dict, session=None):
+        r"""
+        Post ``send_dict`` to ``self.targeturl`` (see ``siacua_post``).
+        """
 
         if self.sendpost:
-
-            import requests
-
-            s = requests.Session()
-
-            content = s.post(self.targeturl, data={'Base64': base64_send_dict} )
-
-            #Check content.
-            if content.status_code == 200:
-
-                if self.verbose:
-                    print "="*30
-                    print "exsiacua.py: Content has reached siacua with the following content:"
-                    print "="*30
-                    print dir(content) #content is has type: requests.models.Response
-                    print type(content)
-                    print "print content:"
-                    print content
-                    print "print content.headers:"
-                    print content.headers
-                    print "print content.text:"
-                    print content.text
-                    r"""
-Comentário:
-==============================
-exsiacua.py: Content has reached siacua with the following content:
-==============================
-['__attrs__', '__bool__', '__class__', '__delattr__', '__dict__', '__doc__', '__enter__', '__exit__', '__format__', '__getattribute__', '__getstate__', '__hash__', '__init__', '__iter__', '__module__', '__new__', '__nonzero__', '__reduce__', '__reduce_ex__', '__repr__', '__setattr__', '__setstate__', '__sizeof__', '__str__', '__subclasshook__', '__weakref__', '_content', '_content_consumed', '_next', 'apparent_encoding', 'close', 'connection', 'content', 'cookies', 'elapsed', 'encoding', 'headers', 'history', 'is_permanent_redirect', 'is_redirect', 'iter_content', 'iter_lines', 'json', 'links', 'next', 'ok', 'raise_for_status', 'raw', 'reason', 'request', 'status_code', 'text', 'url']
-<Response [200]>
-<form name="form1" method="post" action="./MeguaInsert.aspx" id="form1">
-<input type="hidden" name="__VIEWSTATE" id="__VIEWSTATE" value="/wEPDwULLTE1NDM3NzE5MDAPZBYCZg9kFgICBQ8PFgIeBFRleHQFO09jb3JyZXUgYWxndW0gZXJybyBhIGludGVycHJldGFyIG8gcGFyw6JtZXRybyAnc2lhY3VhX2tleScuZGRkpdRObJ5RADj/Mv9lwFaiyM40nR5duyt4BJas+6wM+Ig=" />
-
-<input type="hidden" name="__VIEWSTATEGENERATOR" id="__VIEWSTATEGENERATOR" value="F7061F0D" />
-        exname: <span id="lexname">Label</span>  ekey:  <span id="lekey">Label</span>
-        &nbsp;
-        Resultado: <span id="resultado">Ocorreu algum erro a interpretar o parâmetro 'siacua_key'.</span>
-        <br />
-
-    </form>
-exsiacua.py:  ['exsiacua.py: SomeExCodeMustBeHere']
-type(send_result)= <type 'list'>
-                """
-                    
-                # Perfeito! Temos um novo exercício! id = 12
-                # Perfeito! Temos um novo exercício! id = 12
-                
-#                r"""
-#                data = response.read()
-
-                if self.verbose:
-                    print "exsiacua.py: content.text=", content.text
-
-                if u"Muito bem, melhorou o exercício, parabéns!" in content.text:
-                    akword = "Improved:"
-                    choice_pattern = re.compile(r'id=(\d+)', re.DOTALL|re.UNICODE)
-                elif u"A chave não é válida" in content.text:
-                    print "exsiacua.py: A chave MEGUA/SIACUA não é válida."
-                    conn.close()
-                    raise Exception("Invalid key megua/siacua") #TODO: do this with raise exception.
-                else:
-                    choice_pattern = re.compile(r'id = (\d+)', re.DOTALL|re.UNICODE)
-                    akword = "New:"
-
-                #print "exsiacua.py: data=",data
-                match_iter = re.finditer(choice_pattern,content.text) 
-                all_ids = [ "{} {}".format(akword,match.group(1)) for match in match_iter] #TODO: do this better
-
-#                """
-
-                return all_ids  #["exsiacua.py: SomeExCodeMustBeHere"]
-
-            elif content.status_code == 201:
-
-                if MEGUA_PLATFORM=='SMC':
-                    sys.path.append('/cocalc/lib/python2.7/site-packages')
-                    from smc_sagews.sage_salvus import salvus
-                    salvus.html("<a href='%s'>%s</a><br/>" %  (content.headers['Location'],  content.headers['Location']))
-                elif MEGUA_PLATFORM=='DESKTOP':
-                    print "Exsicua module say: firefox ",content.headers['Location']
-                    subprocess.Popen(["firefox","-new-tab", content.headers['Location']])
-                else:
-                    print "Exsiacua module say: MEGUA_PLATFORM must be properly configured at $HOME/.megua/conf.py"
-
-                return ["ok"]
-
-            else:
-
-                print "="*30
-                print "exsiacua.py: envio para base de dados não funcionou. Código:" + str(content.status_code)
-                print "="*30
-                raise NameError
-
+            if session is None:
+                session = requests.Session()
+            return siacua_post(session, self.targeturl, send_dict, self.verbose)
         else:
             return ["not sent"]
 
@@ -1172,7 +1685,7 @@ type(send_result)= <type 'list'>
         #        discr   = 0.3,
         #)
 
-        html_string = self.template("print_instance_sql.html",
+        html_string = templates.render("print_instance_sql.html",
                 exname  = send_dict["exname"],
                 ekey    = send_dict["ekey"],
                 probtxt = send_dict["problem"],
@@ -1195,7 +1708,7 @@ type(send_result)= <type 'list'>
 
         for c in concept_list:
 
-            html_string = self.template("print_instance_sql2.html",
+            html_string = templates.render("print_instance_sql2.html",
                 conceptid  = c[0],
                 weight     = c[1],
             )
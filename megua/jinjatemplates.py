@@ -86,6 +86,7 @@ Solution using environment variables:
 
 #PYTHON modules
 import jinja2  #see notes on Jinj2 above.
+import hashlib
 #from os import environ
 
 #SAGE modules
@@ -134,5 +135,14 @@ class JinjaTemplate:
 
         return tmpl.render(**user_context)
 
+    def source_hash(self, templatefilename):
+        """
+        Hash (hexadecimal sha1) of the template source: it changes when the template file changes.
+
+        Templates included in ``templatefilename`` are not considered.
+        """
+        source = self.env.loader.get_source(self.env, templatefilename)[0]
+        return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
 
 templates = JinjaTemplate()
@@ -52,6 +52,10 @@ import sqlite3
 import os
 import re
 import shutil
+import hashlib
+import threading
+import functools
+import weakref
 
 
 
@@ -60,16 +64,217 @@ import shutil
 from megua.tounicode import to_unicode
 
 
-__VERSION__ = '0.2.1'
+__VERSION__ = '0.4.0'
 
 r"""
 Version description:
 
 - 0.2.1: added 'suggestive name' to %problem tag and a new column.
+- 0.3.0: added columns 'compiled_version', 'preparsed_text' and 'class_bytecode' (see MegBook.exerciseinstance).
+- 0.4.0: added columns 'content_hash', 'updated_at' and 'revision', column 'revision' in 
+  metameg and table 'removed' (see LocalStore.changed_since).
 """
 
 
+#Text columns where ``search`` looks for a regex (also mirrored in the full text index).
+TEXT_COLUMNS = ['sections_text', 'suggestive_name', 'summary_text', 'problem_text', 'answer_text', 'class_text']
+
+
+#All columns of table exercises (``iter_search`` only accepts these as ``columns``).
+EXERCISE_COLUMNS = ['problem_id', 'unique_name'] + TEXT_COLUMNS + ['compiled_version', 'preparsed_text', 'class_bytecode',
+                    'content_hash', 'updated_at', 'revision']
+
+#Change tracking (version 0.4.0). Each write increments metameg.revision and
+#the written exercises get that revision. Removed (or renamed) exercises are
+#recorded in table "removed".
+TRACKING_CREATE = [
+    "CREATE TABLE removed (unique_name TEXT, revision INTEGER, removed_at TEXT)",
+    "CREATE INDEX removed_revision ON removed (revision)",
+    "CREATE INDEX exercises_revision ON exercises (revision)",
+]
+
+#Condition "some text column matches a regex" (one ? for each column in TEXT_COLUMNS).
+REGEXP_CONDITION = u" OR ".join([u"exercises.%s REGEXP ?" % col for col in TEXT_COLUMNS])
+
+
+#Full text index over TEXT_COLUMNS (see LocalStore._ensure_fulltext).
+#It is an "external content" table: text is not duplicated, only indexed.
+FTS_CREATE = """CREATE VIRTUAL TABLE exercises_fts USING fts5( 
+            sections_text, suggestive_name, summary_text, problem_text, answer_text, class_text,
+            content='exercises', content_rowid='problem_id', tokenize='{0}')"""
+
+#Triggers keep exercises_fts in sync with insert, change, rename and remove_exercise.
+FTS_TRIGGERS = [
+    """CREATE TRIGGER exercises_fts_insert AFTER INSERT ON exercises BEGIN
+        INSERT INTO exercises_fts(rowid, sections_text, suggestive_name, summary_text, problem_text, answer_text, class_text)
+        VALUES (new.problem_id, new.sections_text, new.suggestive_name, new.summary_text, new.problem_text, new.answer_text, new.class_text);
+    END""",
+    """CREATE TRIGGER exercises_fts_delete AFTER DELETE ON exercises BEGIN
+        INSERT INTO exercises_fts(exercises_fts, rowid, sections_text, suggestive_name, summary_text, problem_text, answer_text, class_text)
+        VALUES ('delete', old.problem_id, old.sections_text, old.suggestive_name, old.summary_text, old.problem_text, old.answer_text, old.class_text);
+    END""",
+    """CREATE TRIGGER exercises_fts_update AFTER UPDATE OF sections_text, suggestive_name, summary_text, problem_text, answer_text, class_text ON exercises BEGIN
+        INSERT INTO exercises_fts(exercises_fts, rowid, sections_text, suggestive_name, summary_text, problem_text, answer_text, class_text)
+        VALUES ('delete', old.problem_id, old.sections_text, old.suggestive_name, old.summary_text, old.problem_text, old.answer_text, old.class_text);
+        INSERT INTO exercises_fts(rowid, sections_text, suggestive_name, summary_text, problem_text, answer_text, class_text)
+        VALUES (new.problem_id, new.sections_text, new.suggestive_name, new.summary_text, new.problem_text, new.answer_text, new.class_text);
+    END""",
+]
+FTS_TRIGGER_NAMES = ['exercises_fts_insert', 'exercises_fts_delete', 'exercises_fts_update']
+
+#Pragmas accepted in MEGUA_SQLITE_PRAGMAS (see LocalStore._connect).
+SQLITE_PRAGMAS = ['journal_mode', 'synchronous', 'mmap_size', 'cache_size', 'busy_timeout', 'temp_store']
+PRAGMA_VALUE = re.compile(r'^-?\w+$')
+
+
+#A regex without metacharacters: it can be searched as a substring.
+LITERAL_PATTERN = re.compile(r'^[^\\.^$*+?{}\[\]|()]*$', re.U)
+
+
+def select_list(columns):
+    """
+    SQL list of ``columns`` of table exercises (all if None). Names are checked against EXERCISE_COLUMNS.
+    """
+    if columns is None:
+        return u"exercises.*"
+    for col in columns:
+        if not col in EXERCISE_COLUMNS:
+            raise ValueError("localstore.py: unknown column '%s'." % col)
+    return u", ".join([u"exercises."+col for col in columns])
+
+
+def is_literal(regex):
+    """True if ``regex`` has no regular expression metacharacters."""
+    return LITERAL_PATTERN.match(regex) is not None
+
+
+def fts_phrase(text):
+    """Quote ``text`` as a single FTS5 phrase (``"`` are doubled)."""
+    return u'"' + text.replace(u'"',u'""') + u'"'
+
+
+#Section index (see LocalStore._ensure_sections): one row for each exercise and 
+#each prefix of its sections path. For '%summary Primitives; Imediate; Trigonometric'
+#the prefixes are 'Primitives', 'Primitives; Imediate' and 'Primitives; Imediate; Trigonometric'
+#(this one with leaf=1).
+SECTIONS_CREATE = [
+    """CREATE TABLE sections (
+        prefix TEXT,
+        level INTEGER,
+        unique_name TEXT,
+        leaf INTEGER )""",
+]
+
+#Covering indexes of ``sections``: queries of section_rows, section_counts and 
+#exercises_under are answered from the index only. Created when missing.
+SECTIONS_INDEXES = [
+    "DROP INDEX IF EXISTS sections_prefix", #replaced by sections_path
+    "CREATE INDEX IF NOT EXISTS sections_path ON sections (prefix, unique_name, level, leaf)",
+    "CREATE INDEX IF NOT EXISTS sections_unique_name ON sections (unique_name)",
+    "CREATE INDEX IF NOT EXISTS sections_level ON sections (level, prefix)",
+]
+
+#Separator of section names in ``sections.prefix``.
+SECTIONS_SEPARATOR = u"; "
+
+
+def str_to_list(s):
+    """
+    Convert::
+  
+       'section description; subsection description; subsubsection description'
+
+    into::
+
+       [ 'section description', 'subsection description', 'subsubsection description']
+
+    """
+    sl = s.split(';')
+    for i in range(len(sl)):
+        sl[i] = sl[i].strip()
+    return sl
+
+
+def first_part(s):
+    """
+    Usually exercise are named like `E12X34_name_001` and this routine extracts `E12X34` or `top` if no underscore is present.
+    """
+    p = s.find("_")
+    p = s.find("_",p+1)
+    if p!=-1:
+        s = s[:p]
+    if s=='':
+        s = 'top'
+    return s
+
+
+def section_path(unique_name,sections_text):
+    """
+    List of section names of an exercise: from the %summary line or, if empty, 
+    from the first part of ``unique_name`` (see ``first_part``).
+    """
+    sec_list = str_to_list(sections_text or u'')
+    if sec_list == [] or sec_list == [u'']:
+       sec_list = [ first_part(unique_name) ]
+    return sec_list
+
+
+def content_hash(row):
+    """
+    Hash (hexadecimal sha1) of ``unique_name`` and TEXT_COLUMNS of ``row``.
+
+    ``row`` can be a dictionary or a sqlite3.Row. Equal hashes mean that 
+    the exercise class built from the rows is the same.
+    """
+    h = hashlib.sha1()
+    for col in ['unique_name'] + TEXT_COLUMNS:
+        value = row[col]
+        if value is None:
+            value = u''
+        if type(value)==unicode:
+            value = value.encode('utf-8')
+        h.update(value)
+        h.update('\0')
+    return h.hexdigest()
+
+
+#Matchers of the regular expressions used by ``megregexp``: regex -> function(text).
+#The cache is cleared when it has REGEXP_CACHE_MAX entries.
+REGEXP_CACHE = dict()
+REGEXP_CACHE_MAX = 200
+
+
+def regex_matcher(regex):
+    r"""
+    Function ``f(text)`` that is True when ``regex`` is found in ``text`` (ignoring case).
+
+    A regex without metacharacters (see ``is_literal``) is searched as a 
+    substring of the lower case text: the regex engine is not used.
+
+    EXAMPLES::
+
+        sage: from megua.localstore import regex_matcher
+        sage: regex_matcher(u"Prim")(u"the primitive"), regex_matcher(u"prim.*ve$")(u"the primitive")
+        (True, True)
+    """
+    matcher = REGEXP_CACHE.get(regex)
+    if matcher is None:
+        if is_literal(regex):
+            folded = regex.lower()
+            matcher = lambda text: folded in text.lower()
+        else:
+            pattern = re.compile(regex,re.MULTILINE|re.DOTALL|re.IGNORECASE|re.U)
+            matcher = lambda text: pattern.search(text) is not None
+        if len(REGEXP_CACHE) >= REGEXP_CACHE_MAX:
+            REGEXP_CACHE.clear()
+        REGEXP_CACHE[regex] = matcher
+    return matcher
+
+
 def megregexp(regex,text):
+    """
+    Function REGEXP of the sqlite connections: 1 if ``regex`` is found in ``text`` (NULL is never matched).
+    """
 
     #if type(text)!=unicode:
     #    text = text.encode('utf-8')
@@ -94,12 +299,143 @@ def megregexp(regex,text):
     #    print i, '%04x' % ord(c), unicodedata.category(c),
     #    print unicodedata.name(c)
 
-    if re.search(regex,text,re.MULTILINE|re.DOTALL|re.IGNORECASE|re.U):
+    if text is None:
+        return 0
+    if regex_matcher(regex)(text):
         return 1
     else:
         return 0
 
 
+class LocalStoreError(Exception):
+    """
+    A database that LocalStore cannot use (for example, a version without conversion).
+    """
+    pass
+
+
+def migrate_0_2(c):
+    """
+    From version 0.2 to 0.2.1: add column 'suggestive_name'.
+    """
+    c.execute("ALTER TABLE exercises ADD COLUMN suggestive_name TEXT")
+
+
+def migrate_0_2_1(c):
+    """
+    From version 0.2.1 to 0.3.0: add columns for the compiled class.
+    """
+    c.execute("ALTER TABLE exercises ADD COLUMN compiled_version TEXT")
+    c.execute("ALTER TABLE exercises ADD COLUMN preparsed_text TEXT")
+    c.execute("ALTER TABLE exercises ADD COLUMN class_bytecode BLOB")
+
+
+def migrate_0_3_0(c):
+    """
+    From version 0.3.0 to 0.4.0: add change tracking columns. 
+
+    All exercises get their content hash and revision 1.
+    """
+    c.execute("ALTER TABLE exercises ADD COLUMN content_hash TEXT")
+    c.execute("ALTER TABLE exercises ADD COLUMN updated_at TEXT")
+    c.execute("ALTER TABLE exercises ADD COLUMN revision INTEGER")
+    c.execute("ALTER TABLE metameg ADD COLUMN revision INTEGER DEFAULT 0")
+    for statement in TRACKING_CREATE:
+        c.execute(statement)
+
+    c.execute("SELECT problem_id, %s FROM exercises" % ", ".join(['unique_name']+TEXT_COLUMNS))
+    rows = c.fetchall()
+    for i in range(0,len(rows),1000):
+        c.executemany("UPDATE exercises SET content_hash=?, updated_at=datetime('now'), revision=1 WHERE problem_id=?",
+            [ (content_hash(row), row['problem_id']) for row in rows[i:i+1000] ])
+        print "localstore.py: %d of %d exercises." % (min(i+1000,len(rows)),len(rows))
+    c.execute("UPDATE metameg SET revision=1")
+
+
+#Conversion steps in order: (from version, to version, function(cursor)).
+#A new version needs only a new step here (and the new schema in LocalStore._createdb).
+MIGRATIONS = [
+    ('0.2', '0.2.1', migrate_0_2),
+    ('0.2.1', '0.3.0', migrate_0_2_1),
+    ('0.3.0', '0.4.0', migrate_0_3_0),
+]
+
+
+def migration_steps(version):
+    """
+    Steps of MIGRATIONS that convert a database from ``version`` to __VERSION__.
+    """
+    steps = []
+    while version != __VERSION__:
+        step = [m for m in MIGRATIONS if m[0]==version]
+        if not step:
+            raise LocalStoreError("localstore.py: no conversion available from database version %s to %s." % 
+                                  (version,__VERSION__))
+        steps.append(step[0])
+        version = step[0][1]
+    return steps
+
+
+def backup_database(conn,filename):
+    """
+    Copy the database of connection ``conn`` to ``filename`` while it can be in use.
+
+    It uses the sqlite online backup API (``Connection.backup``, python 3.7) or
+    ``VACUUM INTO`` (sqlite 3.27) or, with older versions, a file copy holding
+    a lock that stops other processes from writing.
+    """
+    if os.path.exists(filename):
+        os.remove(filename)
+    if hasattr(conn,'backup'):
+        target = sqlite3.connect(filename)
+        conn.backup(target)
+        target.close()
+    elif sqlite3.sqlite_version_info >= (3,27,0):
+        conn.execute("VACUUM INTO ?", (filename,))
+    else:
+        source = conn.execute("PRAGMA database_list").fetchone()[2]
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            shutil.copyfile(source,filename)
+            if os.path.exists(source+'-wal'):
+                shutil.copyfile(source+'-wal',filename+'-wal')
+        finally:
+            conn.execute("ROLLBACK")
+
+
+def serialized(method):
+    """
+    Decorator of LocalStore methods that write: they run holding ``LocalStore.write_lock``.
+    """
+    @functools.wraps(method)
+    def locked(self,*args,**kwargs):
+        with self.write_lock:
+            return method(self,*args,**kwargs)
+    return locked
+
+
+class _ReaderConnection(object):
+    """
+    Read connection of a thread kept in a ``threading.local``: it is closed
+    when the thread ends (or by ``LocalStore.close``).
+    """
+
+    def __init__(self,conn):
+        self.conn = conn
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def __del__(self):
+        try:
+            self.close()
+        except sqlite3.Error:
+            pass
+
+
+
 class LocalStore:
 
     r"""
@@ -147,20 +483,49 @@ class LocalStore:
     sage: slist = lstore.search(u"\xe1\xe9") #unicode
     sage: print slist
     []
+    sage: [row['unique_name'] for row in lstore.fulltext_search(u"problem2")]
+    [u'keytwo']
+    sage: [row['unique_name'] for row in lstore.search(u"modified")]
+    [u'keyone']
+    sage: [row['unique_name'] for row in lstore.iter_search(u"", columns=['unique_name'], limit=1, after=u'keyone')]
+    [u'keytwo']
+    sage: from megua.localstore import ExIter
+    sage: [row['unique_name'] for row in ExIter(lstore, regex="problem[12]")]
+    [u'keyone', u'keytwo']
+    sage: LocalStore._debug = False
 
     """
 
     #Class variable to be available to ``megregexp`` function.
     _debug = False
 
-    def __init__(self,filename=None,natlang='pt_pt',markuplang='latex'):
+    #Exercise classes already built in this process (see MegBook.exerciseinstance):
+    #   unique_name -> (content_hash(row), class, code_string)
+    #Entries are removed when the exercise changes, is renamed or removed.
+    class_cache = {}
+
+    def __init__(self,filename=None,natlang='pt_pt',markuplang='latex',pragmas=None):
         """
         Create a local storage for exercises.
+
+        INPUT:
+
+        - ``pragmas`` -- dictionary of sqlite pragmas (see SQLITE_PRAGMAS) for each 
+          connection, for example ``{'journal_mode': 'WAL', 'synchronous': 'NORMAL'}``.
+          None means MEGUA_SQLITE_PRAGMAS (conf.py).
         """
 
         self.natural_language = natlang
         self.markup_language = markuplang
 
+        if pragmas is None:
+            from megua.megoptions import MEGUA_SQLITE_PRAGMAS
+            pragmas = MEGUA_SQLITE_PRAGMAS
+        for (name,value) in pragmas.items():
+            if not name in SQLITE_PRAGMAS or not PRAGMA_VALUE.match(str(value)):
+                raise ValueError("localstore.py: pragma %s=%s is not supported." % (name,value))
+        self.pragmas = pragmas
+
         # =================
         # 1. Get a filename 
         # =================
@@ -184,20 +549,11 @@ class LocalStore:
 
         elif version != __VERSION__:
 
-            #Move current database to a new filename "old_dbfilename"
-            old_dbfilename = self.local_store_filename + '.' + version
-            shutil.move( self.local_store_filename, old_dbfilename)
+            #Convert in place (see MIGRATIONS).
+            self._migrate(version)
 
-            #Create a new one.
-            self._createdb( self.local_store_filename )
-
-            #Open database to use (and receive exercises from old database)
+            #Open database to use
             self._open_to_use()
-            
-            #TODO: create this function.
-            #convertdb(old_dbfilename, self, version)
-
-            raise "localstore.py: no convertion available."
 
         else:
 
@@ -213,22 +569,205 @@ class LocalStore:
     def _open_to_use(self):
         """
         Open to use.
+
+        There is one writer connection (``self.conn``) used by all threads 
+        holding ``self.write_lock`` (see ``serialized``) and a read connection
+        for each thread (see ``reader``). In a forked process (for example,
+        ``MegBook.generate_many`` workers) connections are opened again.
         """
         if LocalStore._debug:
             print "Open MegBook %s to use." % self.local_store_filename
-        self.conn = sqlite3.connect(self.local_store_filename)
-        self.conn.create_function("regexp",2,megregexp)
-        self.conn.row_factory = sqlite3.Row
-        # self.conn.text_factory = str
+
+        self.write_lock = threading.RLock()
+        self._open_connections()
         
         if LocalStore._debug:
             sqlite3.enable_callback_tracebacks(True)
         else:
             sqlite3.enable_callback_tracebacks(True)#while in testing TODO
+
+        self._ensure_fulltext()
+        self._ensure_sections()
+
         if LocalStore._debug:
             print "....  ready."
 
 
+    def _connect(self):
+        """
+        New connection with function REGEXP, rows as sqlite3.Row and ``self.pragmas``.
+        """
+        conn = sqlite3.connect(self.local_store_filename,check_same_thread=False)
+        conn.create_function("regexp",2,megregexp)
+        conn.row_factory = sqlite3.Row
+        # conn.text_factory = str
+        for (name,value) in sorted(self.pragmas.items()):
+            conn.execute("PRAGMA %s=%s" % (name,value)).fetchall()
+        return conn
+
+
+    def _open_connections(self):
+        """
+        Open the writer connection in this process; read connections are opened when needed.
+        """
+        self._pid = os.getpid()
+        self._owner = threading.current_thread()
+        self.conn = self._connect()
+        self._readers = threading.local()
+        self._reader_set = weakref.WeakSet()
+
+
+    def writer(self):
+        """
+        The connection for writing (use it holding ``self.write_lock``).
+        """
+        if self._pid != os.getpid():
+            #sqlite connections cannot be used after fork
+            with self.write_lock:
+                if self._pid != os.getpid():
+                    self._open_connections()
+        return self.conn
+
+
+    def reader(self):
+        """
+        A connection for reading: one for each thread (also the thread that opened
+        the LocalStore), never the writer connection. Writes of other threads 
+        are seen when committed and commits do not reset the cursors of a reader.
+
+        The connection is closed when its thread ends. With ``journal_mode`` WAL 
+        readers do not wait for the writer.
+        """
+        self.writer()
+        holder = getattr(self._readers,'holder',None)
+        if holder is None:
+            holder = _ReaderConnection(self._connect())
+            self._readers.holder = holder
+            self._reader_set.add(holder)
+        return holder.conn
+
+
+    def close(self):
+        """
+        Close all connections of this process.
+        """
+        with self.write_lock:
+            for holder in list(self._reader_set):
+                holder.close()
+            self._reader_set = weakref.WeakSet()
+            self._readers = threading.local()
+            self.conn.close()
+
+
+    def _ensure_fulltext(self):
+        """
+        Create, if it does not exist, the FTS5 table ``exercises_fts`` that 
+        indexes the TEXT_COLUMNS of ``exercises``.
+
+        The index is kept in sync by triggers (see FTS_TRIGGERS) so insert, change,
+        rename and remove_exercise don't need to know about it. It is rebuilt from 
+        ``exercises`` when created: no new database version is needed.
+
+        Tokenizer ``trigram`` (sqlite >= 3.34) indexes substrings and then ``search`` 
+        can use the index to select candidates. With ``unicode61`` only 
+        ``fulltext_search`` uses the index. If sqlite has no FTS5 (or not the 
+        tokenizer of an existing index) then ``self.fulltext_tokenizer`` is None, 
+        searches use only REGEXP and the triggers are dropped so writes still work;
+        they are created again, and the index rebuilt, by a sqlite with FTS5.
+        """
+
+        c = self.conn.cursor()
+        c.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name='exercises_fts'")
+        row = c.fetchone()
+
+        if row:
+            try:
+                #fts5 and the tokenizer must be available in this sqlite
+                c.execute("SELECT rowid FROM exercises_fts LIMIT 1").fetchall()
+                self.fulltext_tokenizer = 'trigram' if 'trigram' in row['sql'] else 'unicode61'
+            except sqlite3.OperationalError:
+                self.fulltext_tokenizer = None
+
+            c.execute("SELECT name FROM sqlite_master WHERE type='trigger' AND name LIKE 'exercises_fts_%'")
+            triggers = set(r['name'] for r in c.fetchall())
+            if self.fulltext_tokenizer is None and triggers:
+                #Without the triggers, writes on exercises do not need fts5.
+                for name in triggers:
+                    c.execute("DROP TRIGGER %s" % name)
+                self.conn.commit()
+                if LocalStore._debug:
+                    print "Full text index not available in this sqlite: not kept in sync."
+            elif self.fulltext_tokenizer and len(triggers) < len(FTS_TRIGGER_NAMES):
+                #Dropped by a sqlite without fts5: the index is rebuilt.
+                for (name,trigger) in zip(FTS_TRIGGER_NAMES,FTS_TRIGGERS):
+                    if name not in triggers:
+                        c.execute(trigger)
+                c.execute("INSERT INTO exercises_fts(exercises_fts) VALUES('rebuild')")
+                self.conn.commit()
+            c.close()
+            return
+
+        self.fulltext_tokenizer = None
+        for tokenizer in ['trigram', 'unicode61']:
+            try:
+                c.execute(FTS_CREATE.format(tokenizer))
+                self.fulltext_tokenizer = tokenizer
+                break
+            except sqlite3.OperationalError:
+                pass #tokenizer or fts5 not available
+
+        if self.fulltext_tokenizer:
+            for trigger in FTS_TRIGGERS:
+                c.execute(trigger)
+            c.execute("INSERT INTO exercises_fts(exercises_fts) VALUES('rebuild')")
+            self.conn.commit()
+            if LocalStore._debug:
+                print "Full text index created with tokenizer", self.fulltext_tokenizer
+        c.close()
+
+
+    def _ensure_sections(self):
+        """
+        Create, if it does not exist, the table ``sections`` (see SECTIONS_CREATE)
+        and fill it from ``exercises``.
+
+        It is maintained by insert, change, rename and remove_exercise and used
+        by ``csection.SectionClassifier``, ``section_counts`` and ``exercises_under``
+        instead of parsing ``sections_text`` of all exercises.
+        """
+
+        c = self.conn.cursor()
+        c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='sections'")
+        created = c.fetchone() is None
+
+        if created:
+            for statement in SECTIONS_CREATE:
+                c.execute(statement)
+            c.execute("SELECT unique_name,sections_text FROM exercises")
+            for row in c.fetchall():
+                self._index_sections(c,row['unique_name'],row['sections_text'])
+
+        for statement in SECTIONS_INDEXES:
+            c.execute(statement)
+        self.conn.commit()
+        c.close()
+        if created and LocalStore._debug:
+            print "Section index created."
+
+
+    def _index_sections(self,c,unique_name,sections_text):
+        """
+        Replace the rows of ``unique_name`` in table ``sections`` using cursor ``c``
+        (the caller commits).
+        """
+        c.execute("DELETE FROM sections WHERE unique_name=?", (unique_name,))
+        sec_list = section_path(unique_name,sections_text)
+        c.executemany("INSERT INTO sections (prefix, level, unique_name, leaf) VALUES (?,?,?,?)",
+            [ (SECTIONS_SEPARATOR.join(sec_list[:level+1]), level, unique_name, int(level==len(sec_list)-1))
+              for level in range(len(sec_list)) ]
+        )
+
+
     def _database_version(self):
         """
         Check if a database exists.
@@ -297,28 +836,91 @@ class LocalStore:
             summary_text TEXT, 
             problem_text TEXT, 
             answer_text TEXT, 
-            class_text TEXT
+            class_text TEXT,
+            compiled_version TEXT,
+            preparsed_text TEXT,
+            class_bytecode BLOB,
+            content_hash TEXT,
+            updated_at TEXT,
+            revision INTEGER
             )'''
         )
 
         c.execute('''CREATE TABLE metameg (
-            natural_language TEXT, 
-            markup_language TEXT, 
-            version TEXT )'''
+            natural_language TEXT,
+            markup_language TEXT,
+            version TEXT,
+            revision INTEGER DEFAULT 0 )'''
         )
 
-        c.execute("""INSERT INTO metameg (natural_language, markup_language, version) VALUES (?,?,?)""", 
-            (self.natural_language, self.markup_language, __VERSION__) 
+        c.execute("""INSERT INTO metameg (natural_language, markup_language, version) VALUES (?,?,?)""",
+            (self.natural_language, self.markup_language, __VERSION__)
         )
 
-        #bytecode will not be used: see livro/pyinspect.py
+        for statement in TRACKING_CREATE:
+            c.execute(statement)
+
+        #bytecode of class_text is saved by set_compiled (see MegBook.exerciseinstance)
 
         conn.commit()
         c.close()
         conn.close()
 
 
+    def _migrate(self,version):
+        r"""
+        Convert the database from ``version`` to __VERSION__ in place.
+
+        A copy of the database is saved in ``<filename>.<version>.bak`` (see
+        ``backup_database``) and then all steps of MIGRATIONS run in a single 
+        transaction: if one fails the database is not changed.
+        """
+
+        steps = migration_steps(version)
+        backup_filename = self.local_store_filename + '.' + version + '.bak'
+
+        #isolation_level=None: transaction is managed here (ALTER TABLE would commit it).
+        conn = sqlite3.connect(self.local_store_filename,isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        c = conn.cursor()
+
+        try:
+            print "localstore.py: saving a copy of the database in", backup_filename
+            backup_database(conn,backup_filename)
+
+            c.execute("BEGIN IMMEDIATE")
+            try:
+                #Other process could have converted it meanwhile.
+                c.execute("SELECT version FROM metameg")
+                if c.fetchone()['version'] == version:
+                    for (n,(old_version,new_version,step)) in enumerate(steps):
+                        print "localstore.py: converting database from version %s to %s (step %d of %d)." % \
+                            (old_version,new_version,n+1,len(steps))
+                        step(c)
+                        c.execute("UPDATE metameg SET version=?", (new_version,))
+                c.execute("COMMIT")
+            except:
+                c.execute("ROLLBACK")
+                print "localstore.py: database was not converted (a copy is in %s)." % backup_filename
+                raise
+        finally:
+            c.close()
+            conn.close()
+
+        print "localstore.py: database converted to version", __VERSION__
+
+
+    def _next_revision(self,c):
+        """
+        Increment metameg.revision and return it (``c`` is a cursor of the writer; the caller commits).
+        """
+        c.execute("UPDATE metameg SET revision=revision+1")
+        c.execute("SELECT revision FROM metameg")
+        return c.fetchone()[0]
+
+
     #def insertchange(self,unique_name,sections,summary,problem,answer,class_text):
+    @serialized
     def insertchange(self,row):
         """
         Insert or change an entry in database with key ``unique_name``.
@@ -351,29 +953,30 @@ class LocalStore:
         unique_name = row['unique_name']
 
         #Check if unique_name already on database
-        c = self.conn.cursor()
-        c.execute("SELECT unique_name FROM exercises WHERE unique_name=?",(unique_name,))
-        do_insert = (c.fetchone()==None)
-        c.close()
-        if do_insert:
+        stored = self.get_columns(unique_name,['content_hash'])
+        if not stored:
             self.insert(row)
-        else:
+        elif stored['content_hash'] != content_hash(row):
             self.change(row)
+        elif LocalStore._debug:
+            print "Exercise '" + unique_name + "' did not change."
 
         #return the changed row
-        c = self.conn.cursor()
+        c = self.reader().cursor()
         c.execute("SELECT * FROM exercises WHERE unique_name=?",(unique_name,))
         row = c.fetchone()
         c.close()
         return row
 
+    @serialized
     def insert(self,row):
 
         #INSERT INTO Persons (P_Id, LastName, FirstName) VALUES (5, 'Tjessem', 'Jakob')
         #http://www.w3schools.com/sql/sql_insert.asp
 
 
-        c = self.conn.cursor()
+        c = self.writer().cursor()
+        revision = self._next_revision(c)
         c.execute("""INSERT INTO exercises \
             (unique_name, \
             sections_text, \
@@ -381,25 +984,33 @@ class LocalStore:
             summary_text, \
             problem_text, \
             answer_text, \
-            class_text) VALUES \
-            (?,?,?,?,?,?,?)""",  #ADD OR REMOVE ? for each new/removal columns
+            class_text, \
+            content_hash, \
+            updated_at, \
+            revision) VALUES \
+            (?,?,?,?,?,?,?,?,datetime('now'),?)""",  #ADD OR REMOVE ? for each new/removal columns
             (   row['unique_name'], 
                 row['sections_text'],
                 row['suggestive_name'],
                 row['summary_text'],
                 row['problem_text'],
                 row['answer_text'],
-                row['class_text']
+                row['class_text'],
+                content_hash(row),
+                revision
             )
         )
-        self.conn.commit()
+        self._index_sections(c,row['unique_name'],row['sections_text'])
+        self.writer().commit()
         c.close()
+        self.forget_class(row['unique_name'])
         if LocalStore._debug:
             print "Exercise '" + row['unique_name'] + "' inserted in database."
 
 
 
 
+    @serialized
     def change(self,row):
         """
 
@@ -408,7 +1019,8 @@ class LocalStore:
         #INSERT INTO Persons (P_Id, LastName, FirstName) VALUES (5, 'Tjessem', 'Jakob')
         #http://www.w3schools.com/sql/sql_insert.asp
 
-        c = self.conn.cursor()
+        c = self.writer().cursor()
+        revision = self._next_revision(c)
         r = c.execute("""UPDATE exercises \
             SET \
                 sections_text=?, \
@@ -416,7 +1028,13 @@ class LocalStore:
                 summary_text=?, \
                 problem_text=?, \
                 answer_text=?, \
-                class_text = ? \
+                class_text = ?, \
+                compiled_version=NULL, \
+                preparsed_text=NULL, \
+                class_bytecode=NULL, \
+                content_hash=?, \
+                updated_at=datetime('now'), \
+                revision=? \
              WHERE \
                 unique_name=? """,
             (   row['sections_text'],
@@ -425,14 +1043,150 @@ class LocalStore:
                 row['problem_text'],
                 row['answer_text'],
                 row['class_text'],
+                content_hash(row),
+                revision,
                 row['unique_name']
             )
         )
-        self.conn.commit()
+        self._index_sections(c,row['unique_name'],row['sections_text'])
+        self.writer().commit()
         c.close()
+        self.forget_class(row['unique_name'])
         if LocalStore._debug:
             print "Exercise '" + row['unique_name'] + "' changed in database."
 
+    @serialized
+    def bulk_upsert(self,rows):
+        r"""
+        Insert or change many exercises in a single transaction.
+
+        INPUT:
+
+        - ``rows`` -- list of data dictionaries (see ``insertchange``).
+
+        OUTPUT:
+
+        - list with 'inserted', 'changed' or 'unchanged' for each row.
+
+        Each ``unique_name`` can appear only once in ``rows`` (ValueError otherwise).
+
+        Rows whose ``content_hash`` is equal to the one in database are not written.
+        The others are written with ``executemany`` and one ``commit`` (using
+        ``INSERT ... ON CONFLICT(unique_name) DO UPDATE`` when sqlite >= 3.24).
+
+        EXAMPLES::
+
+            sage: from megua.localstore import LocalStore
+            sage: import os
+            sage: filename = r"/tmp/localstore_bulk.sqlite"
+            sage: if os.access(filename,os.F_OK):
+            ....:     os.remove(filename)
+            sage: lstore = LocalStore(filename,natlang='pt_pt',markuplang='latex')
+            sage: rows = [ {'unique_name': name, 'sections_text': u'Bulk', 'suggestive_name': u'', 'summary_text': u'', 
+            ....:           'problem_text': u'problem', 'answer_text': u'', 'class_text': u'class '+name} for name in [u'bulk1', u'bulk2'] ]
+            sage: lstore.bulk_upsert(rows)
+            ['inserted', 'inserted']
+            sage: rows[1]['problem_text'] = u'problem changed'
+            sage: lstore.bulk_upsert(rows)
+            ['unchanged', 'changed']
+            sage: lstore.bulk_upsert(rows + [rows[0]])
+            Traceback (most recent call last):
+            ...
+            ValueError: localstore.py: bulk_upsert rows have repeated unique_name: bulk1.
+        """
+
+        rows = [dict((col,to_unicode(row[col]) if type(row[col])==str else row[col]) for col in ['unique_name']+TEXT_COLUMNS)
+                for row in rows]
+
+        names = [row['unique_name'] for row in rows]
+        if len(set(names)) < len(names):
+            repeated = sorted(set(name for name in names if names.count(name)>1))
+            raise ValueError("localstore.py: bulk_upsert rows have repeated unique_name: %s." % ", ".join(repeated))
+
+        #Hashes of exercises already in database.
+        hashes = dict()
+        c = self.writer().cursor()
+        for i in range(0,len(names),500): #less than SQLITE_MAX_VARIABLE_NUMBER
+            chunk = names[i:i+500]
+            c.execute("SELECT unique_name, content_hash FROM exercises WHERE unique_name IN (%s)" % 
+                      ",".join("?"*len(chunk)), chunk)
+            for row in c.fetchall():
+                hashes[row['unique_name']] = row['content_hash']
+
+        status = []
+        written = [] #in the order of rows
+        to_insert = []
+        to_change = []
+        for row in rows:
+            row['content_hash'] = content_hash(row)
+            if not row['unique_name'] in hashes:
+                status.append('inserted')
+                to_insert.append(row)
+            elif hashes[row['unique_name']] == row['content_hash']:
+                status.append('unchanged')
+                continue
+            else:
+                status.append('changed')
+                to_change.append(row)
+            written.append(row)
+            hashes[row['unique_name']] = row['content_hash']
+
+        #All rows written by this call get the same revision.
+        columns = ['unique_name'] + TEXT_COLUMNS + ['content_hash', 'revision']
+        values = lambda rowlist: [ tuple(row[col] for col in columns) for row in rowlist ]
+        assignments = ", ".join(["%s=?" % col for col in columns[1:]])
+
+        try:
+            if written:
+                revision = self._next_revision(c)
+                for row in written:
+                    row['revision'] = revision
+
+            if sqlite3.sqlite_version_info >= (3,24,0):
+                c.executemany("""INSERT INTO exercises (%s, updated_at) VALUES (%s, datetime('now')) \
+                    ON CONFLICT(unique_name) DO UPDATE SET \
+                        %s, \
+                        updated_at=datetime('now'), \
+                        compiled_version=NULL, \
+                        preparsed_text=NULL, \
+                        class_bytecode=NULL""" % (
+                        ", ".join(columns), ",".join("?"*len(columns)),
+                        ", ".join(["%s=excluded.%s" % (col,col) for col in columns[1:]])),
+                    values(written))
+            else:
+                #Inserts first: a change of an exercise inserted by these rows updates it.
+                c.executemany("INSERT INTO exercises (%s, updated_at) VALUES (%s, datetime('now'))" % 
+                        (", ".join(columns), ",".join("?"*len(columns))),
+                    values(to_insert))
+                c.executemany("""UPDATE exercises \
+                    SET \
+                        %s, \
+                        updated_at=datetime('now'), \
+                        compiled_version=NULL, \
+                        preparsed_text=NULL, \
+                        class_bytecode=NULL \
+                    WHERE \
+                        unique_name=?""" % assignments,
+                    [ tuple(row[col] for col in columns[1:]+['unique_name']) for row in to_change ])
+            for row in written:
+                self._index_sections(c,row['unique_name'],row['sections_text'])
+            self.writer().commit()
+        except:
+            self.writer().rollback()
+            raise
+        finally:
+            c.close()
+
+        for row in written:
+            self.forget_class(row['unique_name'])
+
+        if LocalStore._debug:
+            print "Exercises: %d inserted, %d changed, %d unchanged." % \
+                (status.count('inserted'), status.count('changed'), status.count('unchanged'))
+
+        return status
+
+
     #See def search(...) below. 
     #
     #def row_contains(self,regexp):
@@ -445,6 +1199,7 @@ class LocalStore:
     #    return sum(l)
 
 
+    @serialized
     def rename(self,old_unique_name,unique_name,warn=False):
         """
 
@@ -454,90 +1209,470 @@ class LocalStore:
         #http://www.w3schools.com/sql/sql_insert.asp
         print "localstore.py: old_unique_name,unique_name=", old_unique_name, unique_name
             
-        row = self.get_classrow(unique_name)
-        if row:
+        if self.exists(unique_name):
             print "Exercise name already exists on database. Please choose a new one or rename with a different one."
             raise Exception("Exercise name already exists on database")
 
-        c = self.conn.cursor()
+        c = self.writer().cursor()
         c.execute("""UPDATE exercises \
             SET \
-                unique_name=? \
+                unique_name=?, \
+                compiled_version=NULL, \
+                preparsed_text=NULL, \
+                class_bytecode=NULL \
              WHERE \
                 unique_name=? """,
             (   unique_name,
                 old_unique_name
             )
         )
-        self.conn.commit()
+        #Exercises without sections are classified by the first part of unique_name.
+        c.execute("SELECT %s FROM exercises WHERE unique_name=?" % select_list(['unique_name']+TEXT_COLUMNS), (unique_name,))
+        renamed = c.fetchone()
+        c.execute("DELETE FROM sections WHERE unique_name=?", (old_unique_name,))
+        if renamed:
+            self._index_sections(c,unique_name,renamed['sections_text'])
+            #content_hash includes unique_name
+            revision = self._next_revision(c)
+            c.execute("UPDATE exercises SET content_hash=?, updated_at=datetime('now'), revision=? WHERE unique_name=?",
+                (content_hash(renamed), revision, unique_name))
+            c.execute("INSERT INTO removed (unique_name, revision, removed_at) VALUES (?,?,datetime('now'))",
+                (old_unique_name, revision))
+        self.writer().commit()
         c.close()
+        self.forget_class(old_unique_name)
+        self.forget_class(unique_name)
         if warn or LocalStore._debug:
-            print "Exercise '" + row['unique_name'] + "' changed in database."
+            print "Exercise '" + unique_name + "' changed in database."
+
+
+    @serialized
+    def set_compiled(self, unique_name, compiled_version, preparsed_text, class_bytecode):
+        """
+        Save the preparsed and compiled (``marshal.dumps``) class of ``unique_name``.
+
+        INPUT:
+
+        - ``compiled_version`` -- Sage and Python versions that compiled the code (see MegBook.exerciseinstance).
+        - ``preparsed_text`` -- Python code after Sage preparser.
+        - ``class_bytecode`` -- string with marshalled code object.
+
+        Columns are cleared by ``change`` and ``rename``.
+        """
+        unique_name = to_unicode(unique_name)
+        c = self.writer().cursor()
+        c.execute("""UPDATE exercises \
+            SET \
+                compiled_version=?, \
+                preparsed_text=?, \
+                class_bytecode=? \
+             WHERE \
+                unique_name=? """,
+            (   compiled_version,
+                preparsed_text,
+                sqlite3.Binary(class_bytecode),
+                unique_name
+            )
+        )
+        self.writer().commit()
+        c.close()
 
 
     def get_classrow(self, unique_name):
         unique_name = to_unicode(unique_name)
-        c = self.conn.cursor()
+        c = self.reader().cursor()
         c.execute("SELECT * FROM exercises WHERE unique_name=?", (unique_name,))
         row = c.fetchone()
         c.close()
         return row
 
 
+    def get_columns(self, unique_name, columns):
+        r"""
+        Row of ``unique_name`` with only ``columns`` (see EXERCISE_COLUMNS) or None.
+
+        Use it instead of ``get_classrow`` when the exercise texts are not needed.
+        """
+        unique_name = to_unicode(unique_name)
+        c = self.reader().cursor()
+        c.execute("SELECT %s FROM exercises WHERE unique_name=?" % select_list(columns), (unique_name,))
+        row = c.fetchone()
+        c.close()
+        return row
+
+
+    def exists(self, unique_name):
+        r"""
+        True if ``unique_name`` is in the database (only the unique_name index is read).
+
+        EXAMPLES::
+
+            sage: from megua.localstore import LocalStore
+            sage: import os
+            sage: filename = r"/tmp/localstore_exists.sqlite"
+            sage: if os.access(filename,os.F_OK):
+            ....:     os.remove(filename)
+            sage: lstore = LocalStore(filename,natlang='pt_pt',markuplang='latex')
+            sage: row = lstore.insertchange({'unique_name': u'keyone', 'sections_text': u'Section', 'suggestive_name': u'',
+            ....: 'summary_text': u'', 'problem_text': u'problem1', 'answer_text': u'', 'class_text': u'class keyone'})
+            sage: lstore.exists(u'keyone'), lstore.exists('nokey')
+            (True, False)
+        """
+        unique_name = to_unicode(unique_name)
+        c = self.reader().cursor()
+        c.execute("SELECT 1 FROM exercises WHERE unique_name=? LIMIT 1", (unique_name,))
+        found = c.fetchone() is not None
+        c.close()
+        return found
+
+
+    def names(self, regex=u"", limit=None, after=None):
+        r"""
+        Sorted list of unique names of exercises containing ``regex`` (all if empty).
+
+        Only ``unique_name`` is read from the rows (see ``iter_search`` for 
+        ``limit`` and ``after``).
+        """
+        return [row['unique_name'] for row in self.iter_search(regex,columns=['unique_name'],limit=limit,after=after)]
+
+
+    @serialized
     def remove_exercise(self, unique_name):
         unique_name = to_unicode(unique_name)
-        c = self.conn.cursor()
+        c = self.writer().cursor()
         c.execute("DELETE FROM exercises WHERE unique_name=?", (unique_name,))
-        self.conn.commit()
+        if c.rowcount > 0:
+            c.execute("INSERT INTO removed (unique_name, revision, removed_at) VALUES (?,?,datetime('now'))",
+                (unique_name, self._next_revision(c)))
+        c.execute("DELETE FROM sections WHERE unique_name=?", (unique_name,))
+        self.writer().commit()
         c.close()
+        self.forget_class(unique_name)
+
+
+    def forget_class(self, unique_name):
+        """
+        Remove ``unique_name`` from ``LocalStore.class_cache``.
+        """
+        LocalStore.class_cache.pop(unique_name, None)
 
     def search(self,regex):
         r"""
         Present headers from problems containing keywords from regex anywhere.
 
+        OUTPUT:
+
+        - list of rows ordered by unique_name (see ``iter_search`` to get them one by one).
+
         http://docs.python.org/release/2.6.4/library/sqlite3.html
         """
-        #Connect
-        #conn = sqlite3.connect(self.local_store_filename)
+        return list(self.iter_search(regex))
+
+
+    def iter_search(self,regex=u"",columns=None,limit=None,offset=None,after=None,batchsize=100):
+        r"""
+        Generator of rows (sqlite3.Row) of exercises containing ``regex`` in some text column.
+
+        INPUT:
+
+        - ``regex`` -- regular expression; empty matches all exercises.
+        - ``columns`` -- list of columns to fetch (see EXERCISE_COLUMNS) or None for all.
+          For example ``['unique_name']`` avoids reading the exercise texts.
+        - ``limit`` -- maximum number of rows or None.
+        - ``offset`` -- number of rows to skip or None.
+        - ``after`` -- only exercises with unique_name greater than this one 
+          (keyset pagination: give the last unique_name of the previous page).
+        - ``batchsize`` -- rows are fetched from sqlite this many at a time.
+
+        Rows are ordered by unique_name and fetched while the generator is consumed,
+        on the read connection of this thread (see ``reader``). Writes (insert, change, ...)
+        go through the writer connection and do not stop the iteration. With 
+        ``journal_mode`` WAL the iteration does not see them (it reads the database 
+        as it was when it started). With the default journal a write waits until the 
+        iteration ends and fails with "database is locked" after ``busy_timeout``: 
+        make a list first if the database is to be changed while iterating.
+
+        When the full text index uses the ``trigram`` tokenizer and ``regex`` is
+        a plain word (no metacharacters, 3 or more chars) only the rows found by
+        the index are checked with REGEXP. Otherwise, all rows are checked.
+        """
 
         if type(regex)==str:
             regex = unicode(regex,'utf-8')
+        if type(after)==str:
+            after = unicode(after,'utf-8')
+
+        select = select_list(columns)
 
-        #Debug unicode problems
-        #print "localstore.search(regex) ---------------"
-        #import unicodedata
-        #for i, c in enumerate(regex):
-        #    print i, '%04x' % ord(c), unicodedata.category(c),
-        #    print unicodedata.name(c)
+        conditions = []
+        parameters = []
 
+        if regex and self.fulltext_tokenizer == 'trigram' and is_literal(regex) and len(regex)>=3:
+            #First pass: candidates from the index. Second pass: REGEXP.
+            tables = u"exercises_fts JOIN exercises ON exercises.problem_id = exercises_fts.rowid"
+            conditions.append(u"exercises_fts MATCH ?")
+            parameters.append(fts_phrase(regex))
+        else:
+            tables = u"exercises"
+
+        if regex:
+            conditions.append(u"(" + REGEXP_CONDITION + u")")
+            parameters.extend( [regex]*len(TEXT_COLUMNS) )
+
+        if after is not None:
+            conditions.append(u"exercises.unique_name > ?")
+            parameters.append(after)
+
+        sql = u"SELECT %s FROM %s" % (select,tables)
+        if conditions:
+            sql += u" WHERE " + u" AND ".join(conditions)
+        sql += u" ORDER BY exercises.unique_name"
+        if limit is not None or offset is not None:
+            sql += u" LIMIT ? OFFSET ?"
+            parameters.extend( [-1 if limit is None else limit, offset or 0] )
+
+        c = self.reader().cursor()
+        try:
+            c.execute(sql,parameters)
+            while True:
+                rows = c.fetchmany(batchsize)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            c.close()
+
+
+    def fulltext_search(self,query,regex=None):
+        r"""
+        Search exercises using the full text index (see ``_ensure_fulltext``).
 
+        INPUT:
 
-        #if LocalStore._debug:
-        #    print "regex=",regex," with type ",type(regex)
+        - ``query`` -- a FTS5 query, for example ``primitive`` or ``integral AND trig*``.
+        - ``regex`` -- (optional) a regular expression checked only on the rows found by ``query``.
 
-        c = self.conn.cursor()
+        OUTPUT:
 
-        c.execute("""SELECT * FROM exercises  \
-            WHERE \
-                    sections_text REGEXP ? OR \
-                    suggestive_name REGEXP ? OR \
-                    summary_text REGEXP ? OR \
-                    problem_text REGEXP ? OR \
-                    answer_text REGEXP ? OR \
-                    class_text REGEXP ? \
-            ORDER BY unique_name \
-            """, (regex, regex, regex, regex, regex, regex,)
-        )
+        - list of rows, most relevant first.
 
-        #Build a list with all records
-        #TODO: can be an enourmous list.
-        row_list = c.fetchall()
+        If sqlite has no FTS5, ``query`` is searched as a literal text in all rows.
 
+        LINKS:
+
+        - https://www.sqlite.org/fts5.html
+        """
+
+        if type(query)==str:
+            query = unicode(query,'utf-8')
+        if type(regex)==str:
+            regex = unicode(regex,'utf-8')
+
+        if not self.fulltext_tokenizer:
+            row_list = self.search(re.escape(query))
+            if regex:
+                row_list = [row for row in row_list \
+                    if any(row[col] is not None and megregexp(regex,row[col]) for col in TEXT_COLUMNS)]
+            return row_list
+
+        c = self.reader().cursor()
+
+        if regex:
+            c.execute(u"""SELECT exercises.* FROM exercises_fts \
+                JOIN exercises ON exercises.problem_id = exercises_fts.rowid \
+                WHERE \
+                    exercises_fts MATCH ? AND \
+                    (""" + REGEXP_CONDITION + u""") \
+                ORDER BY exercises_fts.rank \
+                """, (query,) + (regex,)*len(TEXT_COLUMNS)
+            )
+        else:
+            c.execute("""SELECT exercises.* FROM exercises_fts \
+                JOIN exercises ON exercises.problem_id = exercises_fts.rowid \
+                WHERE exercises_fts MATCH ? \
+                ORDER BY exercises_fts.rank \
+                """, (query,)
+            )
+
+        row_list = c.fetchall()
         c.close()
 
         return row_list
 
 
+    def revision(self):
+        """
+        Current revision of the database: it increases with each insert, change, rename or removal.
+        """
+        c = self.reader().cursor()
+        c.execute("SELECT revision FROM metameg")
+        revision = c.fetchone()['revision']
+        c.close()
+        return revision
+
+
+    def changed_since(self,revision,columns=None):
+        r"""
+        Exercises inserted or changed after ``revision`` (see ``revision``).
+
+        INPUT:
+
+        - ``revision`` -- a revision got before (0 for all exercises).
+        - ``columns`` -- list of columns to fetch (see EXERCISE_COLUMNS) or None for all.
+
+        OUTPUT:
+
+        - list of rows ordered by revision and unique_name.
+
+        Exercises removed or renamed after ``revision`` are given by ``removed_since``.
+
+        EXAMPLES::
+
+            sage: from megua.localstore import LocalStore
+            sage: import os
+            sage: filename = r"/tmp/localstore_revision.sqlite"
+            sage: if os.access(filename,os.F_OK):
+            ....:     os.remove(filename)
+            sage: lstore = LocalStore(filename,natlang='pt_pt',markuplang='latex')
+            sage: row = lstore.insertchange({'unique_name': u'keyone', 'sections_text': u'Section', 'suggestive_name': u'',
+            ....: 'summary_text': u'', 'problem_text': u'problem1', 'answer_text': u'', 'class_text': u'class Ex1'})
+            sage: r = lstore.revision()
+            sage: r
+            1
+            sage: row = lstore.insertchange({'unique_name': u'keythree', 'sections_text': u'Section', 'suggestive_name': u'',
+            ....: 'summary_text': u'', 'problem_text': u'problem3', 'answer_text': u'', 'class_text': u'class Ex3'})
+            sage: [(row['unique_name'],row['revision']) for row in lstore.changed_since(r,columns=['unique_name','revision'])]
+            [(u'keythree', 2)]
+            sage: lstore.remove_exercise(u'keythree')
+            sage: lstore.changed_since(r), lstore.removed_since(r)
+            ([], [u'keythree'])
+        """
+        c = self.reader().cursor()
+        c.execute("SELECT %s FROM exercises WHERE revision > ? ORDER BY revision, unique_name" % select_list(columns),
+                  (revision,))
+        rows = c.fetchall()
+        c.close()
+        return rows
+
+
+    def removed_since(self,revision):
+        """
+        Unique names of exercises removed (or renamed) after ``revision`` and not in the database now.
+        """
+        c = self.reader().cursor()
+        c.execute("""SELECT DISTINCT removed.unique_name FROM removed \
+            LEFT JOIN exercises ON exercises.unique_name = removed.unique_name \
+            WHERE removed.revision > ? AND exercises.unique_name IS NULL \
+            ORDER BY removed.unique_name""", (revision,))
+        names = [row['unique_name'] for row in c.fetchall()]
+        c.close()
+        return names
+
+
+    def section_rows(self,max_level=None):
+        r"""
+        Exercises and their sections path (from table ``sections``).
+
+        INPUT:
+
+        - ``max_level`` -- sections deeper than ``max_level`` levels are ignored 
+          (the exercise is placed in the section at level ``max_level``).
+
+        OUTPUT:
+
+        - list of (list of section names, unique_name) sorted by sections path.
+        """
+        c = self.reader().cursor()
+        if max_level is None:
+            c.execute("SELECT prefix, unique_name FROM sections WHERE leaf=1 ORDER BY prefix, unique_name")
+        else:
+            c.execute("""SELECT prefix, unique_name FROM sections
+                WHERE (leaf=1 AND level<?) OR level=?
+                ORDER BY prefix, unique_name""", (max_level,max_level-1))
+        rows = [ (row['prefix'].split(SECTIONS_SEPARATOR), row['unique_name']) for row in c.fetchall() ]
+        c.close()
+        return rows
+
+
+    def section_counts(self,level=None):
+        r"""
+        Number of exercises in each section, including those in subsections.
+
+        INPUT:
+
+        - ``level`` -- only sections of this level (0 for chapters) or all sections if None.
+
+        OUTPUT:
+
+        - dictionary: section path (names separated by "; ") -> number of exercises.
+
+        EXAMPLES::
+
+            sage: from megua.localstore import LocalStore
+            sage: import os
+            sage: filename = r"/tmp/localstore_sections.sqlite"
+            sage: if os.access(filename,os.F_OK):
+            ....:     os.remove(filename)
+            sage: lstore = LocalStore(filename,natlang='pt_pt',markuplang='latex')
+            sage: for (name,sections) in [(u'keyone', u'Section; SubSection; Subsubsection'),
+            ....:                         (u'keytwo', u'Section; SubSection'), (u'keythree', u'Other')]:
+            ....:     row = lstore.insertchange({'unique_name': name, 'sections_text': sections, 'suggestive_name': u'',
+            ....:         'summary_text': u'', 'problem_text': u'problem', 'answer_text': u'', 'class_text': u'class '+name})
+            sage: sorted(lstore.section_counts(level=0).items())
+            [(u'Other', 1), (u'Section', 2)]
+            sage: lstore.section_counts(level=1)
+            {u'Section; SubSection': 2}
+        """
+        c = self.reader().cursor()
+        if level is None:
+            c.execute("SELECT prefix, COUNT(*) AS n FROM sections GROUP BY prefix")
+        else:
+            c.execute("SELECT prefix, COUNT(*) AS n FROM sections WHERE level=? GROUP BY prefix", (level,))
+        counts = dict( (row['prefix'],row['n']) for row in c.fetchall() )
+        c.close()
+        return counts
+
+
+    def exercises_under(self,sections):
+        r"""
+        Exercises in a section or in its subsections.
+
+        INPUT:
+
+        - ``sections`` -- a list of section names or a text like "Section; Subsection".
+
+        OUTPUT:
+
+        - sorted list of unique names.
+
+        EXAMPLES::
+
+            sage: from megua.localstore import LocalStore
+            sage: import os
+            sage: filename = r"/tmp/localstore_sections.sqlite"
+            sage: if os.access(filename,os.F_OK):
+            ....:     os.remove(filename)
+            sage: lstore = LocalStore(filename,natlang='pt_pt',markuplang='latex')
+            sage: for (name,sections) in [(u'keyone', u'Section; SubSection; Subsubsection'),
+            ....:                         (u'keytwo', u'Section; SubSection'), (u'keythree', u'Other')]:
+            ....:     row = lstore.insertchange({'unique_name': name, 'sections_text': sections, 'suggestive_name': u'',
+            ....:         'summary_text': u'', 'problem_text': u'problem', 'answer_text': u'', 'class_text': u'class '+name})
+            sage: lstore.exercises_under(u"Section; SubSection")
+            [u'keyone', u'keytwo']
+            sage: lstore.exercises_under([u"Section", u"SubSection", u"Subsubsection"])
+            [u'keyone']
+        """
+        if type(sections) in (str,unicode):
+            sections = str_to_list(to_unicode(sections))
+        prefix = SECTIONS_SEPARATOR.join([to_unicode(s) for s in sections])
+        c = self.reader().cursor()
+        c.execute("SELECT unique_name FROM sections WHERE prefix=? ORDER BY unique_name", (prefix,))
+        names = [row['unique_name'] for row in c.fetchall()]
+        c.close()
+        return names
+
+
     def print_all(self):
         """
         Helper function to print each exercise.
@@ -584,11 +1719,17 @@ class ExIter:
     """
     ExIter is an iterator over the exercises in the LocalStore.
 
+    INPUT:
+
+    - ``localstore`` -- a LocalStore.
+    - ``regex`` -- only exercises containing ``regex`` (see ``LocalStore.iter_search``) or None for all.
+    - ``columns`` -- list of columns to fetch or None for all.
+
     LINK:
     - http://stackoverflow.com/questions/19151/build-a-basic-python-iterator
     """
 
-    def __init__(self, localstore, regex=None):
+    def __init__(self, localstore, regex=None, columns=None):
         """
 
         """
@@ -600,29 +1741,7 @@ class ExIter:
         else:
             self.regex = regex
 
-        self.cur = self._get_cursor()
-
-
-    def _get_cursor(self):
-
-        if self.regex is None:
-            c = self.localstore.conn.cursor()
-            c.execute("""SELECT * FROM exercises""")
-        else:
-            regex = self._unicode(regex)
-            c = self.localstore.conn.cursor()
-
-            c.execute("""SELECT * FROM exercises  \
-                WHERE \
-                    sections_text REGEXP ? OR \
-                    suggestive_name REGEXP ? OR \
-                    summary_text REGEXP ? OR \
-                    problem_text REGEXP ? OR \
-                    answer_text REGEXP ? OR \
-                    class_text REGEXP ? \
-                ORDER BY unique_name \
-                """, (regex, regex, regex, regex, regex,) )
-        return c
+        self.rows = localstore.iter_search(self.regex or u"", columns)
 
 
     def __iter__(self):
@@ -630,10 +1749,5 @@ class ExIter:
 
 
     def next(self):
-        row = self.cur.fetchone()
-        if row == None:
-            raise StopIteration
-        else:
-            return row
-
+        return self.rows.next()
 
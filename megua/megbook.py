@@ -269,6 +269,12 @@ import codecs
 import random as randomlib #random is imported as a funtion somewhere
 import warnings
 import httplib, urllib
+import sys
+import hashlib
+import marshal
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import traceback
 
 
 #For sagews files:
@@ -281,7 +287,8 @@ MARKERS = {'cell':u"\uFE20", 'output':u"\uFE21"}
 
 #SAGE modules
 from sage.all import * #needed in exec (see exerciseinstance)
-#from sage.repl.preparse import preparse_file,preparse
+from sage.repl.preparse import preparse_file
+from sage.version import version as sage_version
 #sage_eval does not work with class definitions?
 #from sage.misc.sage_eval import sage_eval
 
@@ -298,13 +305,14 @@ from megua.mathcommon import *
 from megua.exbase import ExerciseBase
 from megua.exlatex import ExLatex
 from megua.exsiacua import ExSiacua
-from megua.localstore import LocalStore
+from megua.localstore import LocalStore, content_hash
 from megua.parse_ex import parse_ex
 from megua.tounicode import to_unicode
 from megua.jinjatemplates import templates
 from megua.megsiacua import MegSiacua
 from megua.csection import SectionClassifier
-from megua.platex import pcompile, latexunderscore
+from megua.platex import pcompile, latexunderscore, print_latex_error, LatexError
+from megua.diskcache import megua_cache
 #from xmoodle import MoodleExporter
 #from xsphinx import SphinxExporter
 #from xlatex import * #including PDFLaTeXExporter
@@ -360,6 +368,9 @@ class MegBook(MegSiacua):
         #see: set_current_exercise()
         self._current_unique_name = None
 
+        #True in a worker process of generate_many.
+        self._worker = False
+
         ExerciseBase._megbook = self
         #print self.__repr__()
 
@@ -944,6 +955,150 @@ class MegBook(MegSiacua):
 
         ex_instance.print_instance()
 
+
+    def generate_many(self, pairs, workers=None, extract=None):
+        r"""
+        Creates many exercise instances using a pool of Sage processes.
+
+        INPUT:
+
+         - ``pairs`` -- list of ``(unique_name, ekey)`` or ``(unique_name, ekey, edict)``.
+         - ``workers`` -- number of processes (None: number of cpus). With 1 everything runs in this process.
+         - ``extract`` -- (optional) a module level function ``extract(ex_instance)`` called in the worker;
+           its (picklable) result is kept in field ``extract``.
+
+        OUTPUT:
+            A list of dictionaries, in the same order as ``pairs``, with fields:
+            ``unique_name``, ``ekey``, ``summary``, ``problem``, ``answer``, 
+            ``suggestive_name``, ``images`` (full pathnames), ``bases`` (names of the 
+            base classes), ``extract`` and ``error`` (None or the traceback text).
+
+        If ``ekey`` is None a random one is chosen here (so it is known in the result).
+        Equal pairs are generated only once.
+
+        Each worker opens its own MegBook on the same database and works in its own 
+        directory (``MEGUA_WORKDIR_FULLPATH/_workers/<pid>``). Exercise classes are
+        built here, before starting the workers, so workers find them in
+        ``LocalStore.class_cache`` and do not write the same .sage file or the 
+        database at the same time. Random generators are 
+        started by ``ur.start_at(ekey)`` in the worker, so an instance depends only on 
+        ``(unique_name, ekey, edict)``. Images go to the exercise directory as usual: 
+        their names have the ekey.
+
+        Examples:
+
+            results = meg.generate_many([("E12X34_name_001",10), ("E12X34_name_001",20)], workers=2)
+            print results[1]["problem"]
+
+        """
+
+        return list(self.iter_generate(pairs, workers, extract))
+
+
+    def iter_generate(self, pairs, workers=None, extract=None):
+        r"""
+        Like ``generate_many`` but an iterator: each result, in the order of ``pairs``,
+        is given as soon as it is ready (so it can be used while others are generated).
+
+        The pool of processes is started when the first result is asked for. 
+        Stopping the iteration before the end stops the workers.
+
+        Examples:
+
+            for r in meg.iter_generate([("E12X34_name_001",ekey) for ekey in range(100)], workers=4):
+                print r["ekey"], r["error"]
+
+        """
+
+        jobs = []
+        for p in pairs:
+            unique_name, ekey = p[0], p[1]
+            edict = p[2] if len(p)>2 else None
+            if ekey is None:
+                ekey = randomlib.randint(0,1000)
+            jobs.append( (unique_name, int(ekey), edict, extract) )
+
+        #Generate each different job only once.
+        unique_jobs = []
+        job_index = dict()
+        for job in jobs:
+            key = (job[0], job[1], repr(job[2]))
+            if key not in job_index:
+                job_index[key] = len(unique_jobs)
+                unique_jobs.append(job)
+
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        workers = max(1, min(workers, len(unique_jobs)))
+
+        pool = None
+        if workers == 1:
+            unique_results = (self._generate_result(*job) for job in unique_jobs)
+        else:
+            self._generate_classes(set(job[0] for job in unique_jobs))
+            pool = multiprocessing.Pool(processes=workers,
+                initializer=_generate_init,
+                initargs=(self.local_store_filename, 
+                          self.megbook_store.natural_language, 
+                          self.megbook_store.markup_language))
+            unique_results = pool.imap(_generate_one, unique_jobs, chunksize=1)
+
+        #Results come in the order of unique_jobs: the first of each job comes before its copies.
+        results = []
+        try:
+            for job in jobs:
+                k = job_index[(job[0], job[1], repr(job[2]))]
+                while len(results) <= k:
+                    results.append(next(unique_results))
+                yield dict(results[k])
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+
+
+    def _generate_classes(self, unique_names):
+        r"""
+        Build the classes of ``unique_names`` before forking workers (see ``generate_many``).
+
+        Errors are left to the workers: they are reported in the result of each instance.
+        """
+        for unique_name in sorted(unique_names):
+            row = self.megbook_store.get_classrow(unique_name)
+            if row:
+                try:
+                    self.exerciseclass(row)
+                except Exception:
+                    pass
+
+
+    def _generate_result(self, unique_name, ekey, edict=None, extract=None):
+        r"""
+        One instance for ``generate_many`` (runs in the worker process).
+        """
+
+        result = { 'unique_name': unique_name, 'ekey': ekey, 
+                   'summary': None, 'problem': None, 'answer': None, 'suggestive_name': None,
+                   'images': [], 'bases': [], 'extract': None, 'error': None }
+        try:
+            ex = self.new(unique_name, ekey=ekey, edict=edict, returninstance=True)
+            if ex is None:
+                result['error'] = "%s cannot be accessed on database" % unique_name
+                return result
+            result['summary'] = ex.summary()
+            result['problem'] = ex.problem()
+            result['answer'] = ex.answer()
+            result['suggestive_name'] = ex.suggestive_name()
+            result['images'] = sorted(ex.image_fullpathnames)
+            result['bases'] = [b.__name__ for b in ex.__class__.__bases__]
+            if extract:
+                result['extract'] = extract(ex)
+        except (Exception, AlarmInterrupt):
+            result['error'] = traceback.format_exc()
+            print 'MegBook.py say: exercise "%s" with ekey=%d could not be generated.' % (unique_name,ekey)
+        return result
+
+
     def exerciseinstance(self, row, ekey=None, edict=None):
         r"""
         This function creates an instance of a class named in parameter row["unique_name"]. 
@@ -957,6 +1112,10 @@ class MegBook(MegSiacua):
         OUTPUT:
             An instance of class named ``unique_namestring``.
 
+        The class is built only when ``row`` text is new or changed (see 
+        ``exerciseclass``). Other calls just build a new instance. The
+        class code is compiled once and kept in the database (see ``_exerciseclass_code``).
+
         FIELDS in row:
 
         - row['unique_name']
@@ -1000,41 +1159,72 @@ class MegBook(MegSiacua):
 
         """
 
-        code_string = templates.render("megbook_instance_new.sage",
-            unique_name=row["unique_name"],
-            class_text=row["class_text"],
-            sumtxt=row['summary_text'],
-            probtxt=row['problem_text'],
-            anstxt=row['answer_text'],
-            suggestivename=row['suggestive_name'],
-            ekey = ekey,
-            edict = edict
-         )
+        with warnings.catch_warnings(record=True) as wlist:
+            exclass, code_string = self.exerciseclass(row)
+
+            ex_instance = exclass(ekey=ekey,edict=edict)
+
+            if len(wlist)>0:
+                print 'MegBook.py say: exercise "%s" needs review! See below:' % row['unique_name']
+            for w in wlist:
+                #print warnings.showwarning(w)
+                #Simple way of showing an warning: 
+                #print w
+                display_warning(w,code_string) #find in this file
+            if len(wlist)>0:
+                print '======= end of warning list =========='
+
+        return ex_instance
+
+
+    def exerciseclass(self, row):
+        r"""
+        The class of exercise ``row`` (see ``exerciseinstance``).
+
+        OUTPUT:
+
+        - pair ``(exclass, code_string)`` where ``code_string`` is the rendered "megbook_class_new.sage".
+
+        The class is built (render, write to ``<unique_name>.sage`` and exec) only when 
+        ``row`` text is new or changed; then it is kept in ``LocalStore.class_cache``.
+        In a ``generate_many`` worker the .sage file is written in the worker directory.
+        """
 
         #Create if not exist: exercise working directory (images, latex,...)
         working_dir = os.path.join(MEGUA_WORKDIR_FULLPATH,row["unique_name"])
         if not os.path.exists(working_dir):
             os.makedirs(working_dir)
 
-        cfilename = os.path.join(working_dir,row["unique_name"]+'.sage')
+        if self._worker:
+            #own directory (see _generate_init)
+            cfilename = os.path.join(os.getcwd(),row["unique_name"]+'.sage')
+        else:
+            cfilename = os.path.join(working_dir,row["unique_name"]+'.sage')
+
+        #The class is built (render, write and load) only once for each row text.
+        #Other instances, for other ekeys, are created from the cached class.
+        row_hash = content_hash(row)
+        cached = LocalStore.class_cache.get(row["unique_name"])
+        if cached and cached[0]==row_hash:
+            return cached[1], cached[2]
+
+        code_string = templates.render("megbook_class_new.sage",
+            unique_name=row["unique_name"],
+            class_text=row["class_text"],
+            sumtxt=row['summary_text'],
+            probtxt=row['problem_text'],
+            anstxt=row['answer_text'],
+            suggestivename=row['suggestive_name']
+         )
 
         with codecs.open(cfilename, encoding='utf-8', mode='w') as f:
             f.write(code_string)
 
         try:
-            with warnings.catch_warnings(record=True) as wlist:
-                #See important notes about coding the contents of cfilename.
-                load(cfilename) #sagemath load command
-
-                if len(wlist)>0:
-                    print 'MegBook.py say: exercise "%s" needs review! See below:' % row['unique_name']
-                for w in wlist:
-                    #print warnings.showwarning(w)
-                    #Simple way of showing an warning: 
-                    #print w
-                    display_warning(w,code_string) #find in this file
-                if len(wlist)>0:
-                    print '======= end of warning list =========='
+            #See important notes about coding the contents of cfilename.
+            exec self._exerciseclass_code(row,code_string,cfilename) in globals()
+            exclass = ex_class #the value of ex_class is created in exec
+            LocalStore.class_cache[row["unique_name"]] = (row_hash, exclass, code_string)
 
         except SyntaxError as s:
             print 'MegBook.py say: exercise "%s" causes a syntatical error and needs review! See below.' % row['unique_name']
@@ -1043,9 +1233,54 @@ class MegBook(MegSiacua):
                 display_syntaxerror(s,code_string)
             raise s
 
+        return exclass, code_string
+
+
+    def _exerciseclass_code(self, row, code_string, cfilename):
+        r"""
+        Code object that defines the class in ``code_string`` (see ``exerciseinstance``).
+
+        INPUT:
+
+        - ``row`` -- the exercise row; only rows from the database keep the compiled code.
+        - ``code_string`` -- the rendered "megbook_class_new.sage" template.
+        - ``cfilename`` -- the .sage file with ``code_string`` (for error messages).
+
+        OUTPUT:
+
+        - a code object ready for ``exec``.
+
+        Code compiled in a previous session is used when it was compiled
+        from the same ``code_string`` and by the same Sage and Python versions.
+        Otherwise, ``code_string`` is preparsed and compiled (like sage ``load``)
+        and saved with ``LocalStore.set_compiled``.
+        """
+
+        #As in sage load(), the code is an utf-8 str (see notes in exerciseinstance).
+        code_string = code_string.encode('utf-8')
+
+        compiled_version = "sage %s; python %s; %s" % (
+            sage_version,
+            '.'.join([str(v) for v in sys.version_info[:3]]),
+            hashlib.sha1(code_string).hexdigest())
 
+        from_db = 'compiled_version' in row.keys()
 
-        return ex_instance #the value of ex_instance is created in load()
+        if from_db and row['compiled_version'] == compiled_version:
+            try:
+                return marshal.loads(str(row['class_bytecode']))
+            except (ValueError, EOFError, TypeError):
+                return compile(row['preparsed_text'].encode('utf-8'), cfilename, 'exec')
+
+        preparsed_text = preparse_file(code_string)
+        code = compile(preparsed_text, cfilename, 'exec')
+
+        #Workers of generate_many do not write the database (see generate_many).
+        if from_db and not self._worker:
+            self.megbook_store.set_compiled(row['unique_name'], compiled_version,
+                unicode(preparsed_text,'utf-8'), marshal.dumps(code))
+
+        return code
 
 
 
@@ -1075,7 +1310,7 @@ class MegBook(MegSiacua):
         """
         if regex is None:
             regex=""
-        exlist = [row[1] for row in self.megbook_store.search(regex)] #row[0] is unique_name
+        exlist = self.megbook_store.names(regex)
         #print exlist
         if addkeys:
             pairs = [ (e,random.randint(0,1000)) for e in exlist]
@@ -1102,8 +1337,7 @@ class MegBook(MegSiacua):
         .. _Regular Expression: http://docs.python.org/release/2.6.7/library/re.html
         """
 
-        exlist = self.megbook_store.search(regex)
-        for row in exlist:
+        for row in self.megbook_store.iter_search(regex,columns=['unique_name','problem_text']):
             self.search_print_row(row)
 
 
@@ -1360,21 +1594,43 @@ class MegBook(MegSiacua):
 
 
 
-    def catalog(self,what='all',export='latex'):
+    def catalog(self,what='all',export='latex',workers=None,split=None):
         r"""
         Writes exercises in an ordered fashion by sections.
         
         WARNING: Only working is what="all" and export="latex" for now.
+
+        INPUT:
+
+        - ``workers`` -- number of processes making instances (see ``generate_many``).
+        - ``split`` -- None (one LaTeX document) or 'chapter': each chapter is 
+          compiled in its own document (in parallel) and the pdf files are joined
+          in catalog.pdf. A LaTeX error only affects the chapter where it happens.
+
+        The latex of each exercise (instance with ekey=0) is kept in ``megua_cache()`` 
+        (see diskcache.py) with a key made from the exercise text, the template 
+        "megbook_catalog_instance.tex" and the sections. Only exercises that 
+        changed since the last catalog are instanced again.
         """
 
         self.sc = SectionClassifier(self.megbook_store)
         section_iterator = self.sc.section_iterator()
 
+        cache = megua_cache()
+        template_key = templates.source_hash("megbook_catalog_instance.tex")
+
+        img_dir = os.path.join(MEGUA_EXERCISE_CATALOGS,"IMG")
+        if not os.path.exists(img_dir):
+            os.makedirs(img_dir)
+
         #ver templates: megbook_catalog_latex
-        lts = u'' #exerciseinstanceslatex
+        #Parts of exerciseinstanceslatex: text or a dict for exercises not in cache.
+        parts = []
+        missing = []
+        chapters = [] #(index in parts, chapter name, number of exercises)
+
+        section = subsection = subsubsection = r""
 
-        #Instance creation
-        print "MegBook.py say: making instances of the exercises."
         for s in section_iterator:
 
             #Section creation
@@ -1383,104 +1639,92 @@ class MegBook(MegSiacua):
                 subsection = r""
                 subsubsection = r""
                 sname = latexunderscore(s.sec_name) #if exist _ => \_
-                lts += u'\n\n\chapter{{{0} ({1})}}\n\n'.format(sname,len(s.exercises))
+                chapters.append( (len(parts),sname,len(s.exercises)) )
+                parts.append( u'\n\n\chapter{{{0} ({1})}}\n\n'.format(sname,len(s.exercises)) )
             elif s.level==1:
                 subsection = latexunderscore(s.sec_name)
                 subsubsection = r""
                 sname = latexunderscore(s.sec_name) #if exist _ => \_
-                lts += u'\n\n\section{{{0} ({1})}}\n\n'.format(sname,len(s.exercises))
+                parts.append( u'\n\n\section{{{0} ({1})}}\n\n'.format(sname,len(s.exercises)) )
             elif s.level==2:
                 subsubsection = latexunderscore(s.sec_name)
                 sname = latexunderscore(s.sec_name) #if exist _ => \_
-                lts += u'\n\n\subsection{{{0} ({1})}}\n\n'.format(sname,len(s.exercises))
+                parts.append( u'\n\n\subsection{{{0} ({1})}}\n\n'.format(sname,len(s.exercises)) )
             else:
                 sname = latexunderscore(s.sec_name) #if exist _ => \_
-                lts += u'\n\n\subsubsection{{{0} ({1})}}\n\n'.format(sname,len(s.exercises))
+                parts.append( u'\n\n\subsubsection{{{0} ({1})}}\n\n'.format(sname,len(s.exercises)) )
 
             #Get the instances, if they exist on this section, subsection or subsubsection
             #TODO: image render mode to "filenameimage"
-            lts += u'\n\nThis section has {0} exercises.\n\n'.format(len(s.exercises)) # {{ => }
+            parts.append( u'\n\nThis section has {0} exercises.\n\n'.format(len(s.exercises)) ) # {{ => }
             for unique_name in s.exercises:
-                print "megbook.py say: producing %s" % unique_name
-                try:
-                    ex = self.new(unique_name,ekey=0,returninstance=True)
-
-                    #Copy images to CATALOG/IMG directory
-                    for fp in ex.image_fullpathnames:
-                        shutil.copy(fp,os.path.join(MEGUA_EXERCISE_CATALOGS,"IMG")) #TODO: autom. create IMG
-
-                    if ExLatex in ex.__class__.__bases__:
-                        #TODO: incluir tipo no template e na section acima
-                        ex_str = templates.render("megbook_catalog_instance.tex",
-                                    exformat="latex",
-                                    unique_name=unique_name,
-                                    unique_name_noslash = latexunderscore(unique_name),
-                                    summary = ex.summary(),
-                                    section=section,
-                                    subsection=subsection,
-                                    subsubsection=subsubsection,
-                                    suggestive_name = ex.suggestive_name(),
-                                    problem = ex.problem(),
-                                    answer = ex.answer()
-                        )
-                    elif ExSiacua in ex.__class__.__bases__:
-                        #TODO: incluir tipo no template e na section acima
-                        ex_str = templates.render("megbook_catalog_instance.tex",
-                                    exformat="siacua",
-                                    unique_name=unique_name,
-                                    unique_name_noslash = latexunderscore(unique_name),
-                                    summary = ex.summary(),
-                                    section=section,
-                                    subsection=subsection,
-                                    subsubsection=subsubsection,
-                                    suggestive_name = ex.suggestive_name(),
-                                    problem = ExSiacua.to_latex(ex.problem()), #u'\\begin{verbatim}\n'+ex.problem()+'\n\\end{verbatim}\n',
-                                    answer = ExSiacua.to_latex(ex.answer()) #u'\\begin{verbatim}\n'+ex.answer()+'\n\\end{verbatim}\n'
-                        )
-                    else:
-                        #TODO: incluir tipo no template e na section acima
-                        ex_str = templates.render("megbook_catalog_instance.tex",
-                                    exformat="textual (exbase)",
-                                    unique_name_noslash = latexunderscore(unique_name),
-                                    summary = ex.summary(),
-                                    section=section,
-                                    subsection=subsection,
-                                    subsubsection=subsubsection,
-                                    suggestive_name = ex.suggestive_name(),
-                                    problem = u'\\begin{verbatim}\n'+ex.problem()+'\n\\end{verbatim}\n',
-                                    answer = u'\\begin{verbatim}\n'+ex.answer()+'\n\\end{verbatim}\n'
-                        )
-                except:
-                    ex_str = "Check problem with %s. It was not generated." % unique_name
+
+                row = self.megbook_store.get_columns(unique_name,['content_hash'])
+                if not row:
                     print "megbook.py: exercise %s was not generated for catalog. Please check it." % unique_name
+                    parts.append( u"Check problem with %s. It was not generated." % unique_name )
+                    continue
 
+                fragment_key = cache.key("catalog", row['content_hash'], template_key, 
+                                         section, subsection, subsubsection, unique_name)
 
-                lts += ex_str
+                ex_str = cache.read_text(fragment_key,'.tex')
+                images = cache.read_text(fragment_key,'.img')
+                if ex_str is not None and images is not None and \
+                   all(os.path.isfile(os.path.join(img_dir,fn)) for fn in images.split()):
+                    parts.append(ex_str)
+                else:
+                    item = dict(unique_name=unique_name, section=section, subsection=subsection,
+                                subsubsection=subsubsection, fragment_key=fragment_key)
+                    parts.append(item)
+                    missing.append(item)
 
-                #Only for latex (was first version)
-                #lts += u'\\bigskip\n\\textbf{{Unique Name {0}}} with ekey=0\n'.format(unique_name.replace("_","\_"))
-                #lts += u'%{0}\n\n'.format(unique_name)
-                #lts += u'\\textbf{{Summary}}\n\n\\begin{{verbatim}}\n{0}\n\\end{{verbatim}}\n\n'.format(ex.summary())
-                #lts += u'\\textbf{{Problem {0}}}\n\n{1}\n\n'.format(
-                #    ex.suggestive_name(),
-                #    ex.problem())
-                #lts += u'\\textbf{{Answer}}\n\n{0}\n\n'.format(ex.answer())
+        #Instance creation
+        print "MegBook.py say: making instances of %d exercises (the others did not change)." % len(missing)
+        results = self.generate_many([(item['unique_name'],0) for item in missing], workers=workers)
 
+        for (item,result) in zip(missing,results):
 
-        print "MegBook.py say: compiling latex file containing the instances of the exercises."
+            unique_name = item['unique_name']
+            print "megbook.py say: producing %s" % unique_name
 
-        latex_text =  templates.render("megbook_catalog_latex.tex",
-                         exerciseinstanceslatex=lts)
+            try:
+                if result['error']:
+                    print result['error']
+                    raise Exception(result['error'])
+
+                #Copy images to CATALOG/IMG directory
+                for fp in result['images']:
+                    shutil.copy(fp,img_dir)
+
+                item['ex_str'] = self._catalog_fragment(item,result)
+            except:
+                item['ex_str'] = u"Check problem with %s. It was not generated." % unique_name
+                print "megbook.py: exercise %s was not generated for catalog. Please check it." % unique_name
+                continue
+
+            cache.write_text(item['fragment_key'],'.tex',item['ex_str'])
+            cache.write_text(item['fragment_key'],'.img',
+                             u"\n".join([os.path.basename(fp) for fp in result['images']]))
+
+        parts = [ p['ex_str'] if type(p)==dict else p for p in parts ]
+
+        if split=='chapter':
+            print "MegBook.py say: compiling a latex file for each chapter."
+            latex_text = self._catalog_chapters(parts,chapters,workers)
+        else:
+            print "MegBook.py say: compiling latex file containing the instances of the exercises."
+            latex_text =  templates.render("megbook_catalog_latex.tex",
+                             exerciseinstanceslatex=u''.join(parts))
 
 
         CATALOG_TEX_PATHNAME = os.path.join(MEGUA_EXERCISE_CATALOGS,"catalog.tex")
         CATALOG_PDF_PATHNAME = os.path.join(MEGUA_EXERCISE_CATALOGS,"catalog.pdf")
 
 
-        #Compile two times because of TableOfContents  \toc
+        #pcompile runs LaTeX again while TableOfContents \toc changes
         try:
             pcompile(latex_text, MEGUA_EXERCISE_CATALOGS, "catalog.tex")
-            pcompile(latex_text, MEGUA_EXERCISE_CATALOGS, "catalog.tex")
         except:
             print "="*30
             print "megbook.py: file catalog.tex need to be edited."
@@ -1509,6 +1753,126 @@ class MegBook(MegSiacua):
 
 
 
+    def _catalog_chapters(self,parts,chapters,workers=None):
+        r"""
+        Compile each chapter of the catalog and return the LaTeX that joins the pdf files.
+
+        INPUT:
+
+        - ``parts`` -- latex of the catalog (headings and exercises).
+        - ``chapters`` -- list of (index in ``parts``, chapter name, number of exercises).
+        - ``workers`` -- number of pdflatex running at the same time (None: number of cpus).
+
+        Chapter ``n`` is the file catalog-chapter-NN.tex in MEGUA_EXERCISE_CATALOGS. 
+        Chapters whose LaTeX has errors are reported and left out of catalog.pdf.
+        """
+
+        #Text before the first chapter
+        first = 1 if not chapters or chapters[0][0]>0 else 0
+        if first:
+            chapters = [(0,u"",0)] + chapters
+
+        jobs = []
+        for (n,(start,sname,nex)) in enumerate(chapters):
+            end = chapters[n+1][0] if n+1<len(chapters) else len(parts)
+            latex_text = templates.render("megbook_catalog_chapter.tex",
+                                          chapter_counter=max(0,n-first), #\chapter adds 1
+                                          exerciseinstanceslatex=u''.join(parts[start:end]))
+            jobs.append( ("catalog-chapter-%02d" % (n+1), sname, nex, latex_text) )
+
+        def compile_chapter(job):
+            try:
+                pcompile(job[3], MEGUA_EXERCISE_CATALOGS, job[0]+".tex", verbose=False)
+            except LatexError as err:
+                return err
+            return None
+
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        pool = ThreadPool(max(1,min(workers,len(jobs))))
+        try:
+            errors = pool.map(compile_chapter,jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+        includes = []
+        for (job,err) in zip(jobs,errors):
+            (basename,sname,nex,latex_text) = job
+            if err:
+                print "="*30
+                print "megbook.py: file %s.tex need to be edited." % basename
+                print_latex_error(err.output, latex_text, err.filename)
+                print "="*30
+                continue
+            if sname:
+                #Table of contents of catalog.pdf: one entry for each chapter pdf
+                includes.append( u"\\includepdf[pages=-,addtotoc={{1,chapter,0,{{{0} ({1})}},{2}}}]{{{2}.pdf}}".format(sname,nex,basename) )
+            else:
+                includes.append( u"\\includepdf[pages=-]{{{0}.pdf}}".format(basename) )
+
+        return templates.render("megbook_catalog_merge.tex",
+                                includepdflatex=u"\n\n".join(includes))
+
+
+
+    def _catalog_fragment(self,item,result):
+        r"""
+        Latex of an exercise in the catalog.
+
+        INPUT:
+
+        - ``item`` -- dict with ``unique_name`` and sections of the exercise.
+        - ``result`` -- instance fields (see ``generate_many``).
+        """
+
+        unique_name = item['unique_name']
+
+        if 'ExLatex' in result['bases']:
+            #TODO: incluir tipo no template e na section acima
+            ex_str = templates.render("megbook_catalog_instance.tex",
+                        exformat="latex",
+                        unique_name=unique_name,
+                        unique_name_noslash = latexunderscore(unique_name),
+                        summary = result['summary'],
+                        section=item['section'],
+                        subsection=item['subsection'],
+                        subsubsection=item['subsubsection'],
+                        suggestive_name = result['suggestive_name'],
+                        problem = result['problem'],
+                        answer = result['answer']
+            )
+        elif 'ExSiacua' in result['bases']:
+            #TODO: incluir tipo no template e na section acima
+            ex_str = templates.render("megbook_catalog_instance.tex",
+                        exformat="siacua",
+                        unique_name=unique_name,
+                        unique_name_noslash = latexunderscore(unique_name),
+                        summary = result['summary'],
+                        section=item['section'],
+                        subsection=item['subsection'],
+                        subsubsection=item['subsubsection'],
+                        suggestive_name = result['suggestive_name'],
+                        problem = ExSiacua.to_latex(result['problem']), #u'\\begin{verbatim}\n'+ex.problem()+'\n\\end{verbatim}\n',
+                        answer = ExSiacua.to_latex(result['answer']) #u'\\begin{verbatim}\n'+ex.answer()+'\n\\end{verbatim}\n'
+            )
+        else:
+            #TODO: incluir tipo no template e na section acima
+            ex_str = templates.render("megbook_catalog_instance.tex",
+                        exformat="textual (exbase)",
+                        unique_name_noslash = latexunderscore(unique_name),
+                        summary = result['summary'],
+                        section=item['section'],
+                        subsection=item['subsection'],
+                        subsubsection=item['subsubsection'],
+                        suggestive_name = result['suggestive_name'],
+                        problem = u'\\begin{verbatim}\n'+result['problem']+'\n\\end{verbatim}\n',
+                        answer = u'\\begin{verbatim}\n'+result['answer']+'\n\\end{verbatim}\n'
+            )
+
+        return ex_str
+
+
     def latex_document(self, latexdocument, exercisetemplate=None, ofilename='latex_document.tex', ekey=None):
         r"""
         Create LaTeX documents. Exercises are obtained with  `{{ put_here(...) }}` commands.
@@ -1624,7 +1988,7 @@ class MegBook(MegSiacua):
 
         #Get summary, problem and answer and class_text
         #Field row['class_text'] is needed to render the template. See below.
-        row = self.megbook_store.get_classrow(unique_name)        
+        row = self.megbook_store.get_columns(unique_name,['class_text'])
         if not row:
             #TODO: passar a raise Error
             print "%s cannot be accessed on database" % unique_name
@@ -1879,11 +2243,11 @@ class MegBook(MegSiacua):
         f.write(latex_string)
         f.close()
 
-        #TODO: convert all os.system to subprocess.call or subprocess.Popen
-        #os.system("cd '%s'; pdflatex -interaction=nonstopmode %s 1> /dev/null" % (MEGUA_EXERCISE_CATALOGS,"exam.tex") )
-        #os.system("cd '%s'; pdflatex -interaction=nonstopmode %s 1> /dev/null" % (MEGUA_EXERCISE_CATALOGS,"exam.tex") )
-        os.system("pdflatex -interaction=nonstopmode %s 1> /dev/null" % "exam.tex" )
-        os.system("pdflatex -interaction=nonstopmode %s 1> /dev/null" % "exam.tex" )
+        #pcompile runs LaTeX again only when needed
+        try:
+            pcompile(latex_string, os.getcwd(), EXAM_TEX_PATHNAME)
+        except UserWarning:
+            print "megbook.py: file %s need to be edited." % EXAM_TEX_PATHNAME
 
 
         if MEGUA_PLATFORM=='SMC':
@@ -1918,6 +2282,26 @@ def m_get_sections(sectionstxt):
     return s.replace(";","/") #possible case without space: ";" by "/"
 
 
+#MegBook of each worker process in MegBook.generate_many.
+_generate_megbook = None
+
+def _generate_init(filename,natlang,markuplang):
+    """Start a worker process of MegBook.generate_many."""
+    global _generate_megbook
+    _generate_megbook = MegBook(filename,natlang=natlang,markuplang=markuplang)
+    _generate_megbook._worker = True
+
+    #Own directory for files written with relative paths.
+    worker_dir = os.path.join(MEGUA_WORKDIR_FULLPATH,'_workers',str(os.getpid()))
+    if not os.path.exists(worker_dir):
+        os.makedirs(worker_dir)
+    os.chdir(worker_dir)
+
+def _generate_one(job):
+    """Generate one job of MegBook.generate_many in a worker process."""
+    return _generate_megbook._generate_result(*job)
+
+
 def display_warning(w,code_string):
     print w.message
     #print "Around line:",w.lineno #<-could be on runtime without line
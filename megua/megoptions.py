@@ -114,6 +114,43 @@ else: #MEGUA setup is in $HOME/.megua/conf.py
 
 #print "MEGUA_PLATFORM=",MEGUA_PLATFORM
 
+
+# ==================================
+# OPTIONAL (can be set in conf.py)
+# ==================================
+
+#Cache of generated files like latex images (see diskcache.py).
+if not 'MEGUA_CACHE_DIR' in locals():
+    MEGUA_CACHE_DIR = path.join(MEGUA_WORKDIR_FULLPATH,"_cache")
+if not 'MEGUA_CACHE_MAXSIZE' in locals():
+    MEGUA_CACHE_MAXSIZE = 500*1024*1024 #bytes
+
+#Compile LaTeX with a TeX format of the preamble (see platex.latex_format).
+if not 'MEGUA_LATEX_FORMATS' in locals():
+    MEGUA_LATEX_FORMATS = False
+
+#Pragmas of the database connections (see localstore.SQLITE_PRAGMAS). Empty: sqlite defaults.
+if not 'MEGUA_SQLITE_PRAGMAS' in locals():
+    MEGUA_SQLITE_PRAGMAS = {}
+
+#Simultaneous posts to siacua/pmate in ExSiacua.siacua (exercises and images).
+if not 'MEGUA_SIACUA_UPLOADS' in locals():
+    MEGUA_SIACUA_UPLOADS = 4
+
+#Posts to siacua/pmate are tried again MEGUA_SIACUA_RETRIES times waiting 1, 2, 4, ... times MEGUA_SIACUA_BACKOFF seconds.
+if not 'MEGUA_SIACUA_RETRIES' in locals():
+    MEGUA_SIACUA_RETRIES = 4
+if not 'MEGUA_SIACUA_BACKOFF' in locals():
+    MEGUA_SIACUA_BACKOFF = 1.0
+
+#Send compact (and gzip) payloads to servers that accept them (see exsiacua.siacua_encoding).
+if not 'MEGUA_SIACUA_COMPACT' in locals():
+    MEGUA_SIACUA_COMPACT = True
+
+#What siacua/pmate already has and what waits to be sent (see siacuastore.py).
+if not 'MEGUA_SIACUA_STORE' in locals():
+    MEGUA_SIACUA_STORE = path.join(MEGUA_WORKDIR_FULLPATH,"_siacua.sqlite")
+
 #===================
 # Check directories
 #===================
@@ -23,6 +23,15 @@ TESTS: check MegBook
 #*****************************************************************************
   
 
+#PYTHON modules
+import urlparse
+
+#MEGUA modules
+from megua.exsiacua import drain_outbox
+from megua.siacuastore import siacua_store
+from megua.siacuabundle import open_bundle
+
+
 
 class MegSiacua:
     r"""
@@ -54,12 +63,20 @@ class MegSiacua:
                #old fields
                usernamesiacua="(no username)",
                siacuatest=None,
-               sendpost=True
+               sendpost=True,
+               #pipeline
+               targeturl=None,
+               workers=1,
+               max_uploads=None,
+               force=False,
+               bundle=None
               ):
         r"""
 
         INPUT:
 
+        See ``ExSiacua.siacua``.
+
 
         OUTPUT:
 
@@ -113,12 +130,111 @@ class MegSiacua:
                #old fields
                usernamesiacua,
                siacuatest,
-               sendpost
+               sendpost,
+               targeturl=targeturl,
+               workers=workers,
+               max_uploads=max_uploads,
+               force=force,
+               bundle=bundle
             )
 
         #done
             
 
+    def siacua_resume(self,targeturl=None,unique_name=None,max_uploads=None,force=False,verbose=False):
+        r"""
+        Send the instances that ``siacua`` could not send (they wait in an outbox, 
+        see ``megua.siacuastore``). Instances are not generated again.
+
+        INPUT:
+
+        - ``targeturl``: (usually None) only instances for this url (see ``ExSiacua.siacua``).
+
+        - ``unique_name``: (usually None) only instances of this exercise.
+
+        - ``max_uploads``, ``force`` and ``verbose``: see ``ExSiacua.siacua``.
+
+        OUTPUT:
+
+        - this command prints what was sent and what is still waiting.
+
+        EXAMPLE:
+
+            sage: meg.siacua_resume() # not tested
+
+        """
+
+        results = drain_outbox(siacua_store(), target=targeturl, exname=unique_name,
+                               max_uploads=max_uploads, force=force, verbose=verbose)
+        self._print_siacua_results(results)
+
+
+    def siacua_replay(self,bundle,targeturl=None,max_uploads=None,force=False,verbose=False):
+        r"""
+        Send the instances written to a bundle by ``siacua(..., bundle=...)`` (see ``megua.siacuabundle``).
+
+        Instances go to the outbox and then only they are posted, like in ``siacua``: what could 
+        not be sent is sent later by ``siacua_resume``. Images are written to directory 
+        ``<bundle>.images`` (kept while waiting in the outbox).
+
+        INPUT:
+
+        - ``bundle``: filename (``.jsonl`` or ``.sqlite``).
+
+        - ``targeturl``: (usually None) send to this url instead of the one chosen when the bundle was written.
+
+        - ``max_uploads``, ``force`` and ``verbose``: see ``ExSiacua.siacua``.
+
+        OUTPUT:
+
+        - this command prints what was sent and what is still waiting.
+
+        EXAMPLE:
+
+            sage: meg.siacua(ekeys=range(1,51), targetmachine="siacua", bundle="calculo3.jsonl") # not tested
+            sage: meg.siacua_replay("calculo3.jsonl") # not tested
+
+        """
+
+        store = siacua_store()
+        reader = open_bundle(bundle)
+        try:
+            paths = reader.extract_images(bundle + ".images")
+            ids = []
+            for e in reader.exercises():
+                target = targeturl or e['target']
+                imagesurl = e['imagesurl']
+                if targeturl and imagesurl:
+                    imagesurl = urlparse.urljoin(targeturl,'MeguaInsert2.aspx')
+                row = store.outbox_put(target, imagesurl, e['course'], e['exname'], e['ekey'], e['send_dict'],
+                                       [paths[tuple(i)] for i in e['images']])
+                ids.append(row['outbox_id'])
+        finally:
+            reader.close()
+
+        if verbose:
+            print "megsiacua module: %d instances from %s are in the outbox." % (len(ids),bundle)
+
+        #Only the rows of this bundle (other rows wait for siacua_resume).
+        results = drain_outbox(store, ids=ids, max_uploads=max_uploads, force=force, verbose=verbose)
+        self._print_siacua_results(results)
+
+
+    def _print_siacua_results(self,results):
+        r"""
+        Print results of ``drain_outbox``.
+        """
+        if not results:
+            print "megsiacua module: nothing waits to be sent."
+            return
+
+        for r in results:
+            if r['error']:
+                print "%s ekey=%d: not sent (%s)" % (r['exname'], r['ekey'], r['error'].strip().splitlines()[-1])
+            else:
+                print "%s ekey=%d: %s" % (r['exname'], r['ekey'], ', '.join(r['result']))
+
+
     def siacuapreview(self,ekeys,unique_name=None):
         r"""
 
@@ -112,6 +112,7 @@ FUTURE. Evaluate if any of this forms is really useful::
 
 # PYTHON modules
 import re
+from collections import OrderedDict
 
 
 
@@ -161,10 +162,23 @@ DEFAULT_OUTPUT_METHOD = EXPR2LATEX
 
 
 #Avoid this members in exercise
-AVOID_KEYWORDS = ['self', 'imagedirectory', 'image_relativepathnames', 'image_fullpathnames', 'has_instance', 'ekey', 'dpi', 'dimy', 'dimx', 'working_dir','TO_LATEX', '__class__', '__delattr__', '__dict__', '__doc__', '__format__', '__getattribute__', '__hash__', '__init__', '__module__', '__new__', '__reduce__', '__reduce_ex__', '__repr__', '__setattr__', '__sizeof__', '__str__', '__subclasshook__', '__weakref__', '_adjust_images_url', '_answer_text', '_answer_whitoutmc', '_ascii_art_', '_axiom_', '_axiom_init_', '_build_ekeys', '_cache_key', '_collect_options_and_answer', '_current_answer', '_current_problem', '_fricas_', '_fricas_init_', '_gap_', '_gap_init_', '_giac_', '_giac_init_', '_gp_', '_gp_init_', '_interface_', '_interface_init_', '_interface_is_cached_', '_kash_', '_kash_init_', '_macaulay2_', '_macaulay2_init_', '_magma_init_', '_maple_', '_maple_init_', '_mathematica_', '_mathematica_init_', '_maxima_', '_maxima_init_', '_maxima_lib_', '_maxima_lib_init_', '_megbook', '_octave_', '_octave_init_', '_pari_', '_pari_init_', '_problem_text', '_problem_whitoutmc', '_r_init_', '_remove_multiplechoicetag', '_render', '_rendermethod', '_repr_', '_sage_', '_send_images', '_showone_possibilities', '_siacua_extractparameters', '_siacua_json', '_siacua_send', '_siacua_sqlprint', '_siacua_wronganswerdict', '_singular_', '_singular_init_', '_suggestive_name', '_summary_text', '_test_category', '_test_new', '_test_not_implemented_methods', '_test_pickling', '_tester', '_unicode_art_', '_unique_name', '_update_multiplechoice', 'all_choices', 'answer', 'category', 'dpi', 'dump', 'dumps', 'ekey', 'get_ekey', 'has_instance', 'has_multiplechoicetag', 'image_fullpathnames', 'image_relativepathnames', 'latex_render', 'make_random', 'paperx_cm', 'papery_cm', 'parent', 'print_instance', 'problem', 'rename', 'render_method', 'reset_name', 'rewrite', 'sage_graphic', 'save', 'screen_x', 'screen_y', 'search_replace', 'show_one', 'siacua', 'siacuapreview', 'static_image', 'suggestive_name', 'summary', 'to_latex', 'try_random_updates', 'unique_name', 'update', 'update_dict', 'update_timed', 'wd_fullpath', 'wd_relative']
+AVOID_KEYWORDS = frozenset(['self', 'imagedirectory', 'image_relativepathnames', 'image_fullpathnames', 'has_instance', 'ekey', 'dpi', 'dimy', 'dimx', 'working_dir','TO_LATEX', '__class__', '__delattr__', '__dict__', '__doc__', '__format__', '__getattribute__', '__hash__', '__init__', '__module__', '__new__', '__reduce__', '__reduce_ex__', '__repr__', '__setattr__', '__sizeof__', '__str__', '__subclasshook__', '__weakref__', '_adjust_images_url', '_answer_text', '_answer_whitoutmc', '_ascii_art_', '_axiom_', '_axiom_init_', '_build_ekeys', '_cache_key', '_collect_options_and_answer', '_current_answer', '_current_problem', '_fricas_', '_fricas_init_', '_gap_', '_gap_init_', '_giac_', '_giac_init_', '_gp_', '_gp_init_', '_interface_', '_interface_init_', '_interface_is_cached_', '_kash_', '_kash_init_', '_macaulay2_', '_macaulay2_init_', '_magma_init_', '_maple_', '_maple_init_', '_mathematica_', '_mathematica_init_', '_maxima_', '_maxima_init_', '_maxima_lib_', '_maxima_lib_init_', '_megbook', '_octave_', '_octave_init_', '_pari_', '_pari_init_', '_problem_text', '_problem_whitoutmc', '_r_init_', '_remove_multiplechoicetag', '_render', '_rendermethod', '_repr_', '_sage_', '_send_images', '_showone_possibilities', '_siacua_extractparameters', '_siacua_json', '_siacua_send', '_siacua_sqlprint', '_siacua_wronganswerdict', '_singular_', '_singular_init_', '_suggestive_name', '_summary_text', '_test_category', '_test_new', '_test_not_implemented_methods', '_test_pickling', '_tester', '_unicode_art_', '_unique_name', '_update_multiplechoice', 'all_choices', 'answer', 'category', 'dpi', 'dump', 'dumps', 'ekey', 'get_ekey', 'has_instance', 'has_multiplechoicetag', 'image_fullpathnames', 'image_relativepathnames', 'latex_render', 'make_random', 'paperx_cm', 'papery_cm', 'parent', 'print_instance', 'problem', 'rename', 'render_method', 'reset_name', 'rewrite', 'sage_graphic', 'save', 'screen_x', 'screen_y', 'search_replace', 'show_one', 'siacua', 'siacuapreview', 'static_image', 'suggestive_name', 'summary', 'to_latex', 'try_random_updates', 'unique_name', 'update', 'update_dict', 'update_timed', 'wd_fullpath', 'wd_relative'])
 
 
 
+#Kinds of placeholders in a substitution plan (see substitution_plan).
+PLAN_PARENTESIS = 1 #name@()
+PLAN_FORMAT     = 2 #name@f{2.3g}
+PLAN_FUNCTION   = 3 #name@s{R15}
+PLAN_CHOICE     = 4 #name@c{"text0","text1"}
+PLAN_NAME       = 5 #name
+
+#Cache of substitution plans: (inputtext, keys) -> plan
+#Like in python "re" module, it is cleared when full.
+PLAN_CACHE = {}
+PLAN_CACHE_MAX = 500
+
+
 def parameter_change(inputtext,datadict):
     """
     Substitution on a given input text with names acting as placeholders by their values on a provided dict.
@@ -179,12 +193,108 @@ def parameter_change(inputtext,datadict):
     - text where names where replaced by values.
 
     See examples at top of the file.
-    Implementation details below.
+    Implementation details in ``substitution_plan``: the text is only parsed 
+    once for the same names in ``datadict``. Here placeholders are evaluated.
+
+    """
+
+    #TODO: maybe this should be above.
+    #print "type=",type(inputtext)
+    if type(inputtext) == str:
+        inputtext = unicode(inputtext,'utf-8')
+
+    keys = frozenset([ v for v in datadict.keys() if v not in AVOID_KEYWORDS])
+    plan = substitution_plan(inputtext,keys)
+
+    output_list = []
+
+    for (literal_text, kind, keyname, argument) in plan:
+
+        output_list.append(literal_text)
+
+        if kind is None: #end of text
+            continue
+
+        try:
+
+            data_value = datadict[keyname]
+
+            if kind == PLAN_PARENTESIS:
+
+                #CASE: name@()
+                output_list.append( output_value(data_value,DEFAULT_OUTPUT_METHOD,parentesis=True) )
+
+            elif kind == PLAN_FORMAT:
+
+                #CASE: name@f{0.2g}
+                #argument is "%0.2g"
+                output_list.append( argument % data_value )
+
+            elif kind == PLAN_FUNCTION:
+
+                #CASE: name@s{RealField15}
+                sage_command = argument + '(' + str(data_value) +')'
+                ev = eval(sage_command,globals())
+                output_list.append( str(ev) )
+
+            elif kind == PLAN_CHOICE:
+
+                #CASE: name@c{"text0","text1"}
+                #argument is the list ["text0","text1"]
+                str_value = argument[data_value]
+                if type(str_value) == str:
+                    str_value = unicode(str_value,'utf-8')
+                output_list.append( str_value )
+
+            else: 
+
+                #CASE: name wihtout formating
+                if type(data_value) is str:
+                    output_list.append( unicode(data_value,'utf8') )
+                elif type(data_value) is unicode:
+                    output_list.append( data_value )
+                else:
+                    output_list.append( output_value(data_value,DEFAULT_OUTPUT_METHOD) )
+
+        except KeyError:
+
+            output_list.append( keyname )
+
+    return u"".join(output_list)
+
 
+
+def substitution_plan(inputtext,keys):
     """
+    Parse ``inputtext`` into literal text and placeholders.
+
+    INPUT:
+
+    - ``inputtext``-- unicode text containing an exercise template with named placeholders.
+    - ``keys`` -- frozenset with names that can be placeholders (without ``AVOID_KEYWORDS``).
+
+    OUTPUT:
+
+    - list of tuples ``(literal_text, kind, keyname, argument)`` where kind is
+      one of PLAN_* constants or None for the last literal text.
+
+    Plans are kept in PLAN_CACHE because the same text is used 
+    for many instances (ekeys) of an exercise.
+
+    Example::
+
+        sage: from megua.parse_param import substitution_plan
+        sage: substitution_plan(u' a@() or b@f{.2f}',frozenset(['a','b']))
+        [(u' ', 1, u'a', None), (u' or ', 2, u'b', u'%.2f'), (u'', None, None, None)]
+
+    """
+
+    cache_key = (inputtext,keys)
+    if cache_key in PLAN_CACHE:
+        return PLAN_CACHE[cache_key]
 
     #Create regex using datadict names
-    keys_no_keyword = [ v for v in datadict.keys() if v not in AVOID_KEYWORDS]
+    keys_no_keyword = list(keys)
 
     #Reverse: why is important.
     #This reversed sort guarantees that 'onb1' is first changed and only then 'onb'.
@@ -193,13 +303,6 @@ def parameter_change(inputtext,datadict):
     c_dict_keys = "|".join( keys_no_keyword ) #see use below.
     re_str = BASE_REGEX + ur'\W({0})'.format(c_dict_keys)
 
-
-    #TODO: maybe this should be above.
-    #print "type=",type(inputtext)
-    if type(inputtext) == str:
-        inputtext = unicode(inputtext,'utf-8')
-
-
     #re.MULTILINE|re.DOTALL|re.IGNORECASE|re.|
     match_iter = re.finditer(re_str,inputtext,re.UNICODE|re.LOCALE)
 
@@ -211,119 +314,107 @@ def parameter_change(inputtext,datadict):
     #    print i, '%04x' % ord(c), unicodedata.category(c),
     #    print unicodedata.name(c)
 
-    outputtext = u""
+    plan = []
 
     text_last = 0
 
     for match in match_iter:
         
-        
-        #if type(inputext) == unicode:
-        #    print "Full match group(0) is: " + unicode(match.group(0))
-        #    print "Groups(1..n) in this match: " + match.groups())
+        #Text before the placeholder (including the \W character).
+        literal_text = inputtext[text_last:match.start()+1]
 
-        try:
+        if match.group(1) is not None:
 
-            if match.group(1) is not None:
+            #CASE: name@()
+            plan.append( (literal_text, PLAN_PARENTESIS, match.group(1), None) )
 
-                #CASE: name@()
-                #Get data from dict for this match
-                keyname = match.group(1)
-                data_value = datadict[keyname]    #; print "data_value=",data_value
-                outputtext += inputtext[text_last:match.start()+1]
-                outputtext += output_value(data_value,DEFAULT_OUTPUT_METHOD,parentesis=True)
+        elif match.group(2) is not None and match.group(3) is not None:
 
-            elif match.group(2) is not None and match.group(3) is not None:
+            #CASE: name@f{0.2g}
+            format_text = r"%" + match.group(3)
+            plan.append( (literal_text, PLAN_FORMAT, match.group(2), format_text) )
 
-                #CASE: name@f{0.2g}
-                keyname = match.group(2)
-                data_value = datadict[keyname]
-                format_text = r"%" + match.group(3)
-                formated_argument = format_text % data_value
-                outputtext += inputtext[text_last:match.start()+1] + formated_argument
+        elif match.group(4) is not None and match.group(5) is not None:
 
-            elif match.group(4) is not None and match.group(5) is not None:
+            #CASE: name@s{RealField15}
+            plan.append( (literal_text, PLAN_FUNCTION, match.group(4), match.group(5)) )
 
-                #CASE: name@s{RealField15}
-                keyname = match.group(4)
-                data_value = datadict[keyname]
-                sage_command = match.group(5) + '(' + str(data_value) +')'
-                ev = eval(sage_command,globals())
-                outputtext += inputtext[text_last:match.start()+1] + str(ev)
-
-            elif match.group(6) is not None and match.group(7) is not None:
-
-                #print """parse_param.py: CASE: name@c{"text0","text1"}"""
-                #print "match.group(6)=",match.group(6)
-                #print "match.group(7)=",match.group(7)
-                
-                try:
-                    #create list with user given strings:
-                    #name@c{"text0","text1"} --> ["text0","text1"]
-                    str_uni = u"[" + match.group(7) + u"]"
-                    #print "parse_param.py: str_uni =",str_uni
-                    str_list = eval( str_uni )
-                    
-                    #get value of 'name'
-                    keyname = match.group(6)
-                    data_value = datadict[keyname]
-                    #print "parse_param.py: data_value = datadict[keyname] => data_value = ", data_value
-                    #get string from the list
-                    str_value = str_list[data_value]
-
-                    #TODO: Check if rmeove this is ok
-                    #if str_value in datadict:
-                    #    data = datadict[str_value]
-                    #    if type(data) == str:
-                    #        str_value = unicode(datadict[str_value],'utf-8')
-                    #    else:
-                    #        str_value = data
-                    #else:
-                    #    if type(str_value) == str:
-                    #        str_value = unicode(str_value,'utf-8')
-
-                except SyntaxError as e:
-                    #value = keyname
-                    print """parse_param.py: syntax problem on name@c{"text0","text1"}. Text say: %s.""" % match.group(7)
-                    raise SyntaxError(e)
-                except NameError as e:
-                    #value = keyname
-                    print "parse_param.py: use double quotes even on names (case: %s in '%s')." % (e,match.group(7))
-                    raise NameError(e)
-                #print type(str_value), " ", str_value
-                if type(str_value) == str:
-                    str_value = unicode(str_value,'utf-8')
-                outputtext += inputtext[text_last:match.start()+1] + str_value
-                
-            else: #same as if match.group(5) is not None
+        elif match.group(6) is not None and match.group(7) is not None:
+
+            #print """parse_param.py: CASE: name@c{"text0","text1"}"""
+            #print "match.group(6)=",match.group(6)
+            #print "match.group(7)=",match.group(7)
             
-                #CASE: name wihtout formating
-                keyname = match.group(8)
-                data_value = datadict[keyname]
-                #print "data_value = datadict[keyname]; data_value = ", data_value,"type(data_value)=",type(data_value)
-                
-                if type(data_value) is str:
-                    outputtext += inputtext[text_last:match.start()+1] + unicode(data_value,'utf8')
-                elif type(data_value) is unicode:
-                    outputtext += inputtext[text_last:match.start()+1] + data_value
-                else:
-                    outputtext += inputtext[text_last:match.start()+1] 
-                    outputtext += output_value(data_value,DEFAULT_OUTPUT_METHOD)
-                    
-        except KeyError:
+            try:
+                #create list with user given strings:
+                #name@c{"text0","text1"} --> ["text0","text1"]
+                str_uni = u"[" + match.group(7) + u"]"
+                #print "parse_param.py: str_uni =",str_uni
+                str_list = eval( str_uni )
+            except SyntaxError as e:
+                #value = keyname
+                print """parse_param.py: syntax problem on name@c{"text0","text1"}. Text say: %s.""" % match.group(7)
+                raise SyntaxError(e)
+            except NameError as e:
+                #value = keyname
+                print "parse_param.py: use double quotes even on names (case: %s in '%s')." % (e,match.group(7))
+                raise NameError(e)
+
+            plan.append( (literal_text, PLAN_CHOICE, match.group(6), str_list) )
+
+        else: #same as if match.group(5) is not None
             
-                #outputtext += inputtext[text_last:match.start()+1] + unicode(keyname,'utf-8')
-                outputtext += inputtext[text_last:match.start()+1] + keyname
+            #CASE: name wihtout formating
+            plan.append( (literal_text, PLAN_NAME, match.group(8), None) )
 
         text_last = match.end()            
 
-    outputtext += inputtext[text_last:]
+    plan.append( (inputtext[text_last:], None, None, None) )
+
+    if len(PLAN_CACHE) >= PLAN_CACHE_MAX:
+        PLAN_CACHE.clear()
+    PLAN_CACHE[cache_key] = plan
 
-    return outputtext
+    return plan
 
 
 
 
+#LRU cache of output_value: (what identifies the value, output_method, parentesis) -> unicode string
+#(see _output_cache_key).
+OUTPUT_CACHE = OrderedDict()
+OUTPUT_CACHE_MAX = 2000
+OUTPUT_CACHE_STATS = {'hits': 0, 'misses': 0}
+OUTPUT_CACHE_STRMAX = 200
+
+
+def _output_cache_key(expr):
+    r"""
+    What identifies the output of ``expr`` in OUTPUT_CACHE or None (not kept).
+
+    - numbers: type and repr (for real numbers also the precision);
+    - symbolic expressions: repr and ``latex(expr)`` (a variable with ``latex_name`` 
+      has the repr of other), and the domain of the variables and the assumptions 
+      because ``real()``, ``imag()`` and the sign depend on them. The latex is computed 
+      for each value; the cache saves the ``real()``, ``imag()`` and ``has()`` work;
+    - short strings.
+
+    Not matrices (big ones are printed as "20 x 20 dense matrix ...") or polynomials.
+    """
+    if isinstance(expr, (int, long, float, Integer, Rational)):
+        return (type(expr), repr(expr))
+    if isinstance(expr, sage.rings.real_mpfr.RealNumber):
+        return (type(expr), expr.prec(), repr(expr))
+    if type(expr)==sage.symbolic.expression.Expression:
+        variables = expr.variables()
+        return (type(expr), repr(expr), latex(expr),
+                tuple(v.is_real() for v in variables),
+                repr(assumptions()) if variables else None)
+    if isinstance(expr, basestring) and len(expr) <= OUTPUT_CACHE_STRMAX:
+        return (type(expr), expr)
+    return None
+
+
 def output_value(expr,output_method=None,parentesis=False):
     r"""Return a unicode string with the 
         value or expression ``s`` 
@@ -338,9 +429,80 @@ def output_value(expr,output_method=None,parentesis=False):
     OUTPUT:
     
     - an unicode utf8 string appropriatedly formated.
+
+    Results for numbers, symbolic expressions and short strings are kept in 
+    OUTPUT_CACHE (the last OUTPUT_CACHE_MAX used values) because the same values 
+    appear many times in a text and in other ekeys. See ``_output_cache_key`` 
+    and ``output_value_cache_info``.
+
+    Example::
+
+        sage: from megua.parse_param import output_value, output_value_cache_info, output_value_cache_clear
+        sage: output_value_cache_clear()
+        sage: output_value(-3/4,parentesis=True,output_method=1), output_value(-3/4,parentesis=True,output_method=1)
+        (u'(-\\frac{3}{4})', u'(-\\frac{3}{4})')
+        sage: sorted(output_value_cache_info().items())
+        [('hits', 1), ('maxsize', 2000), ('misses', 1), ('size', 1)]
+
+    Symbolic expressions are kept; matrices are not::
+
+        sage: output_value_cache_clear()
+        sage: e = sqrt(2) + 3*I
+        sage: output_value(e,output_method=1) == output_value(e,output_method=1)
+        True
+        sage: A = matrix(ZZ, 21, 21, 1); B = matrix(ZZ, 21, 21, 2)
+        sage: repr(A) == repr(B), output_value(A,output_method=1) == output_value(B,output_method=1)
+        (True, False)
+        sage: sorted(output_value_cache_info().items())
+        [('hits', 1), ('maxsize', 2000), ('misses', 1), ('size', 1)]
     
     """
 
+    value_key = _output_cache_key(expr)
+    if value_key is None:
+        return _output_value(expr,output_method,parentesis)
+
+    cache_key = (value_key, output_method, parentesis)
+
+    if cache_key in OUTPUT_CACHE:
+        OUTPUT_CACHE_STATS['hits'] += 1
+        expr_str = OUTPUT_CACHE.pop(cache_key)
+        OUTPUT_CACHE[cache_key] = expr_str #now the most recent
+        return expr_str
+
+    OUTPUT_CACHE_STATS['misses'] += 1
+    expr_str = _output_value(expr,output_method,parentesis)
+    OUTPUT_CACHE[cache_key] = expr_str
+    if len(OUTPUT_CACHE) > OUTPUT_CACHE_MAX:
+        OUTPUT_CACHE.popitem(last=False) #the least recent
+
+    return expr_str
+
+
+def output_value_cache_info():
+    """
+    Hits, misses and size of the output_value cache.
+    """
+    return {'hits': OUTPUT_CACHE_STATS['hits'], 
+            'misses': OUTPUT_CACHE_STATS['misses'],
+            'size': len(OUTPUT_CACHE),
+            'maxsize': OUTPUT_CACHE_MAX}
+
+
+def output_value_cache_clear():
+    """
+    Empty the output_value cache and reset counters (for example, after changing latex options).
+    """
+    OUTPUT_CACHE.clear()
+    OUTPUT_CACHE_STATS['hits'] = 0
+    OUTPUT_CACHE_STATS['misses'] = 0
+
+
+def _output_value(expr,output_method,parentesis):
+    """
+    Computes output_value (without cache).
+    """
+
     #old def ulatex(...)
     #TODO: var@l => force latex(var)
     #TODO: improve this function
@@ -68,6 +68,9 @@ import re
 import os
 import subprocess
 import codecs
+import hashlib
+import threading
+import time
 
 
 # SAGE modules
@@ -76,10 +79,54 @@ from sage.misc.latex import have_pdflatex
 
 # MEGUA modules
 from megua.tounicode import to_unicode
+from megua.megoptions import MEGUA_WORKDIR_FULLPATH, MEGUA_LATEX_FORMATS
 
 
+#Where TeX formats (.fmt) with preambles are kept (see latex_format).
+#Not under MEGUA_CACHE_DIR: DiskCache.evict and clear would remove them.
+LATEX_FORMATS_DIR = os.path.join(MEGUA_WORKDIR_FULLPATH,"_texformats")
 
-def pcompile(latex_text, workdir, filename):
+#Seconds before building again a format that failed (see latex_format).
+LATEX_FORMAT_RETRY = 3600
+
+
+
+class LatexError(UserWarning):
+    """
+    Raised by ``pcompile`` when pdflatex fails.
+
+    - ``output`` -- the pdflatex output (log).
+    - ``filename`` -- the full pathname of the .tex file.
+    """
+    def __init__(self, message, output=u"", filename=None):
+        UserWarning.__init__(self, message)
+        self.output = output
+        self.filename = filename
+
+
+
+#Files that LaTeX reads in the next pass (see pcompile).
+AUX_EXTENSIONS = ['.aux', '.toc', '.lof', '.lot', '.out']
+
+#Warnings asking for another pass (LaTeX kernel, hyperref/rerunfilecheck, longtable, ...).
+RERUN_PATTERN = re.compile(r"(Rerun to get|Rerun LaTeX|Please rerun|has changed\.\s+Rerun)",re.I)
+
+
+def aux_hashes(workdir, filename):
+    """
+    Hashes of the auxiliary files (AUX_EXTENSIONS) of ``filename`` (without extension).
+    """
+    hashes = dict()
+    for ext in AUX_EXTENSIONS:
+        pathname = os.path.join(workdir, filename+ext)
+        if os.path.isfile(pathname):
+            with open(pathname,'rb') as f:
+                hashes[ext] = hashlib.sha1(f.read()).hexdigest()
+    return hashes
+
+
+
+def pcompile(latex_text, workdir, filename, verbose=True, useformat=None, maxpasses=3):
     r"""
 
     INPUT:
@@ -87,13 +134,22 @@ def pcompile(latex_text, workdir, filename):
     - ``latex_text'': source LaTeX *text* in `utf8` or `str` type.
     - ``workdir'': directory where compilation is going to occur.
     - ``filename'': where to store the latex_text (with or without extension .tex).
+    - ``verbose'': print error diagnostics (when False the caller reports them).
+    - ``useformat'': compile with a TeX format containing the preamble (see ``latex_format``).
+      None means the value of MEGUA_LATEX_FORMATS (conf.py).
+    - ``maxpasses'': maximum number of pdflatex runs.
 
     OUTPUT:
 
     - No output.
 
     It compiles and in case of bad compilation the managment is left to
-    calling procedure.
+    calling procedure: ``LatexError`` (a ``UserWarning``) is raised.
+
+    Like latexmk, pdflatex runs again only while LaTeX asks for it (RERUN_PATTERN)
+    or the table of contents files (.toc, .lof, .lot, .out) change. Auxiliary 
+    files are kept in ``workdir`` so a document that did not change since the 
+    last build usually needs only one pass.
 
     """
 
@@ -117,22 +173,39 @@ def pcompile(latex_text, workdir, filename):
     with codecs.open(fullpath,encoding='utf-8', mode='w+') as f:
         f.write(latex_text)
 
-    lt = ['pdflatex', '-interaction', 'nonstopmode', filename]
+    if useformat is None:
+        useformat = MEGUA_LATEX_FORMATS
+    fmtname = latex_format(latex_text) if useformat else None
+
+    if fmtname:
+        lt = ['pdflatex', '-interaction', 'nonstopmode', '-fmt', fmtname, filename]
+        env = dict(os.environ, TEXFORMATS=LATEX_FORMATS_DIR+os.pathsep)
+    else:
+        lt = ['pdflatex', '-interaction', 'nonstopmode', filename]
+        env = None
+
+    basename = filename[:-4]
     try:
-        output = subprocess.check_output(lt,cwd=workdir) #return output in a string
-
-        # rerun?
-        # http://tex.stackexchange.com/questions/265744/how-to-know-if-a-latex-file-needs-another-compilation-pass
-        if "LaTeX Warning: Label(s) may have changed. Rerun to get cross-references right." in output:
-            print "="*20
-            print "platex.py say: Running laTeX a second time."
-            print "="*20
-            output = subprocess.check_output(lt,cwd=workdir) #return output in a string
-            if "LaTeX Warning: Label(s) may have changed. Rerun to get cross-references right." in output:
+
+        for npass in range(1,maxpasses+1):
+
+            if npass>1 and verbose:
                 print "="*20
-                print "platex.py say: Running laTeX a third and last time"
+                print "platex.py say: Running LaTeX again (pass %d)." % npass
                 print "="*20
-                output = subprocess.check_output(lt,cwd=workdir) #return output in a string
+
+            before = aux_hashes(workdir, basename)
+            output = subprocess.check_output(lt,cwd=workdir,env=env) #return output in a string
+            after = aux_hashes(workdir, basename)
+
+            # rerun?
+            # http://tex.stackexchange.com/questions/265744/how-to-know-if-a-latex-file-needs-another-compilation-pass
+            # .aux changes are reported by LaTeX warnings ("Label(s) may have changed") but
+            # the table of contents is not.
+            toc_changed = any( before.get(ext) != after.get(ext) for ext in AUX_EXTENSIONS if ext!='.aux' )
+            if not RERUN_PATTERN.search(output) and not toc_changed:
+                break
+
     except subprocess.CalledProcessError as err:
         #Try to show the message to user
         #print "Error:",err
@@ -140,45 +213,152 @@ def pcompile(latex_text, workdir, filename):
         #print "output:",err.output
         #print "================"
 
-        #Try to get line information from latex output errors and messages
-        latex_error_pattern = re.compile(r"!.*?l\.(\d+)(.*?)$",re.DOTALL|re.M)
-        match = latex_error_pattern.search(err.output) #create an iterator
-        if match:
-            #Try to get a debug mark
-            lines = latex_text.split('\n')
-            error_line = int(match.group(1))-2 #see above
-
-            #Find exercise name.
-            #Note that tex file must have tags:
-            #     %LATEX DEBUG START {{unique_name}}
-            #     %LATEX DEBUG END {{unique_name}}
-            #in order to extract its name. 
-            for i in xrange(error_line-1,len(lines)):
-                if lines[i].find(r"%LATEX DEBUG END")>-1:
-                    #First the "end" mark to get 
-                    m_end = re.search("%LATEX DEBUG END (.+)",lines[i])
-                    ex_unique_name = m_end.group(1)
-                    print "\nExercise with name '{}' has a LaTeX compilation error.".format(ex_unique_name)
-                    break
-
-            #Print lines where the error could be.
-            print "\n"
-            for dk in xrange(-4,0):
-                print "| :",lines[error_line+dk]
-            print "> :", lines[error_line]
-            for dk in xrange(1,5):
-                print "| :",lines[error_line+dk]
-
-
-        print "\n\nYou can inspect\n  %s\nand use your LaTeX "\
-              "editor to help find the error in exercise source code.\n" % fullpath
-
-        if match:
-            #print LaTeX error style "l.9 ........"
-            print match.group(0) 
+        if fmtname:
+            #Errors are reported without the format.
+            return pcompile(latex_text, workdir, filename, verbose, useformat=False, maxpasses=maxpasses)
+
+        if verbose:
+            print_latex_error(err.output, latex_text, fullpath)
+
+        raise LatexError("Check exercise for LaTeX errors", err.output, fullpath)
 
+
+
+def print_latex_error(output, latex_text, fullpath):
+    r"""
+    Print the LaTeX error in ``output`` (of pdflatex) and the lines of ``latex_text`` around it.
+
+    INPUT:
+
+    - ``output'': pdflatex output (see ``LatexError.output``).
+    - ``latex_text'': the compiled LaTeX text.
+    - ``fullpath'': the .tex file (to be inspected by the user).
+    """
+
+    #Try to get line information from latex output errors and messages
+    latex_error_pattern = re.compile(r"!.*?l\.(\d+)(.*?)$",re.DOTALL|re.M)
+    match = latex_error_pattern.search(output) #create an iterator
+    if match:
+        #Try to get a debug mark
+        lines = latex_text.split('\n')
+        error_line = int(match.group(1))-2 #see above
+
+        #Find exercise name.
+        #Note that tex file must have tags:
+        #     %LATEX DEBUG START {{unique_name}}
+        #     %LATEX DEBUG END {{unique_name}}
+        #in order to extract its name. 
+        for i in xrange(error_line-1,len(lines)):
+            if lines[i].find(r"%LATEX DEBUG END")>-1:
+                #First the "end" mark to get 
+                m_end = re.search("%LATEX DEBUG END (.+)",lines[i])
+                ex_unique_name = m_end.group(1)
+                print "\nExercise with name '{}' has a LaTeX compilation error.".format(ex_unique_name)
+                break
+
+        #Print lines where the error could be.
         print "\n"
-        raise UserWarning("Check exercise for LaTeX errors")
+        for dk in xrange(-4,0):
+            print "| :",lines[error_line+dk]
+        print "> :", lines[error_line]
+        for dk in xrange(1,5):
+            print "| :",lines[error_line+dk]
+
+
+    print "\n\nYou can inspect\n  %s\nand use your LaTeX "\
+          "editor to help find the error in exercise source code.\n" % fullpath
+
+    if match:
+        #print LaTeX error style "l.9 ........"
+        print match.group(0) 
+
+    print "\n"
+
+
+
+#==========================
+# TeX formats with preambles
+#==========================
+
+#First line of "pdflatex --version": a format only works with the same engine.
+_pdflatex_version = None
+
+def latex_format(latex_text):
+    r"""
+    Name of a TeX format (.fmt) with the preamble of ``latex_text`` or None.
+
+    The format is a dump, made by package ``mylatexformat``, of pdflatex state after 
+    reading the preamble (all before ``\begin{document}``). Compiling with it 
+    (``pdflatex -fmt <name>``) skips loading the packages again. 
+
+    Formats are kept in LATEX_FORMATS_DIR with a name given by the hash of the preamble 
+    and of pdflatex version: a changed template makes a new format. If the format cannot
+    be built (for example, ``mylatexformat`` is not installed) None is returned 
+    and the document is compiled as usual. A ``.failed`` marker avoids trying again 
+    in each compilation; it expires after LATEX_FORMAT_RETRY seconds.
+
+    LINKS:
+
+    - https://www.ctan.org/pkg/mylatexformat
+    """
+    global _pdflatex_version
+
+    latex_text = to_unicode(latex_text)
+    position = latex_text.find(u'\\begin{document}')
+    if position < 0:
+        return None
+    preamble = latex_text[:position]
+
+    if _pdflatex_version is None:
+        try:
+            _pdflatex_version = subprocess.check_output(['pdflatex','--version']).split('\n')[0]
+        except (subprocess.CalledProcessError,OSError):
+            _pdflatex_version = ''
+
+    h = hashlib.sha1(_pdflatex_version)
+    h.update(preamble.encode('utf-8'))
+    fmtname = 'megua-' + h.hexdigest()[:20]
+
+    fmtpath = os.path.join(LATEX_FORMATS_DIR, fmtname)
+    if os.path.isfile(fmtpath+'.fmt'):
+        return fmtname
+    if os.path.isfile(fmtpath+'.failed'):
+        try:
+            if time.time() - os.path.getmtime(fmtpath+'.failed') < LATEX_FORMAT_RETRY:
+                return None
+        except OSError:
+            pass #removed by other process
+
+    if not os.path.exists(LATEX_FORMATS_DIR):
+        try:
+            os.makedirs(LATEX_FORMATS_DIR)
+        except OSError:
+            pass #other process created it
+
+    #Other processes or threads could be building the same format.
+    jobname = '%s-%d-%d' % (fmtname, os.getpid(), threading.current_thread().ident)
+    with codecs.open(os.path.join(LATEX_FORMATS_DIR,jobname+'.tex'),encoding='utf-8', mode='w') as f:
+        f.write(preamble + u'\\begin{document}\n\\end{document}\n')
+
+    lt = ['pdflatex', '-ini', '-interaction', 'nonstopmode', '-jobname='+jobname, 
+          '&pdflatex', 'mylatexformat.ltx', jobname+'.tex']
+    try:
+        subprocess.check_output(lt,cwd=LATEX_FORMATS_DIR,stderr=subprocess.STDOUT)
+        os.rename(os.path.join(LATEX_FORMATS_DIR,jobname+'.fmt'), fmtpath+'.fmt')
+    except (subprocess.CalledProcessError,OSError) as err:
+        print "platex.py say: could not build a TeX format for this preamble (is mylatexformat installed?)."
+        print "platex.py say: compiling without it. See %s.log" % os.path.join(LATEX_FORMATS_DIR,jobname)
+        with open(fmtpath+'.failed','w') as f:
+            f.write(getattr(err,'output','') or str(err))
+        return None
+
+    for ext in ['.tex','.log']:
+        if os.path.exists(os.path.join(LATEX_FORMATS_DIR,jobname+ext)):
+            os.remove(os.path.join(LATEX_FORMATS_DIR,jobname+ext))
+    if os.path.exists(fmtpath+'.failed'):
+        os.remove(fmtpath+'.failed')
+
+    return fmtname
 
 
 
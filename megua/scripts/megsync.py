@@ -37,7 +37,7 @@ from megua.megoptions import PROJECT_DATABASE_NAME,PROJECT_DATABASE_FULLPATH, ME
 from megua.parse_ex import parse_ex
 from megua.tounicode import to_unicode
 from megua.all import meg
-from megua.localstore import ExIter
+from megua.localstore import ExIter, content_hash
 
 def inputfiles_status():
     """
@@ -89,9 +89,12 @@ def inputfiles_status():
                 continue
 
             #print row["unique_name"]
-            
-            if not meg.megbook_store.get_classrow(row["unique_name"]):
+
+            stored = meg.megbook_store.get_columns(row["unique_name"],['content_hash'])
+            if not stored:
                 print row["unique_name"],"is not in",PROJECT_DATABASE_NAME
+            elif stored['content_hash'] != content_hash(row):
+                print row["unique_name"],"in",fn,"has changed since it was saved in",PROJECT_DATABASE_NAME
                 
         else:
             print "\n",fn,"does not have 'save' command (it seems it does not have an exercise).\n"
@@ -102,7 +105,7 @@ def inputfiles_status():
     print "="*23+"\n"
 
     #Check db for records and verify if they exist as a file
-    for row in ExIter(meg.megbook_store):
+    for row in ExIter(meg.megbook_store,columns=['unique_name']):
         if MEGUA_PLATFORM=="SMC":
             fn = os.path.join(MEGUA_EXERCISE_INPUT,row['unique_name']+'.sagews')
         else:
@@ -138,6 +141,9 @@ def inputfiles_add():
     #to search exercise code
     re_save = re.compile(ur'save\(r\'\'\'(.+?)\'\'\'\)',re.IGNORECASE|re.U|re.M|re.S)
         
+    #New exercises are saved together (see LocalStore.bulk_upsert)
+    new_rows = []
+
     for fn in glob.glob(search_pattern):
 
         with open(fn,"r") as f:
@@ -157,18 +163,27 @@ def inputfiles_add():
                 print "Check",fn,"(cannot save the exercise)."
                 continue
             
-            if not meg.megbook_store.get_classrow(row["unique_name"]):
+            if row["unique_name"] in [r["unique_name"] for r in new_rows]:
+                print "Check",fn,"(exercise",row["unique_name"],"is also in other file)."
+                continue
+
+            if not meg.megbook_store.exists(row["unique_name"]):
                 #meg.save(uexercise)        
                 ex_instance = meg.exerciseinstance(row,ekey=0)
-                #After all that, save it on database:                        
-                meg.megbook_store.insertchange(row)
+                #After all that, save it on database (below).
+                new_rows.append(row)
                 
         else:
             print fn,"does not have 'save' command (it seems it does not have an exercise)."
+
+    if new_rows:
+        status = meg.megbook_store.bulk_upsert(new_rows)
+        print status.count('inserted'),"exercises added to",PROJECT_DATABASE_FULLPATH
             
 
     #Check db for records and verify if they exist as a file
-    for row in ExIter(meg.megbook_store):
+    #(a list: rename below changes the database while iterating)
+    for row in list(ExIter(meg.megbook_store,columns=['unique_name'])):
         if MEGUA_PLATFORM=="SMC":
             pathname = os.path.join(MEGUA_EXERCISE_INPUT,row['unique_name']+'.sagews')
         else:
@@ -0,0 +1,272 @@
+# coding=utf-8
+
+r"""
+siacuabundle -- instances prepared for siacua/pmate kept in a file to be sent later.
+
+``ExSiacua.siacua(..., bundle="course.jsonl")`` writes the payloads (the json that
+would be posted) and the image files of each instance to a bundle instead of sending
+them. Instances can then be generated in a big machine and ``meg.siacua_replay("course.jsonl")``
+(see ``MegSiacua.siacua_replay``) sends them from other machine, without Sage
+generating them again.
+
+A bundle is opened by ``open_bundle`` and its format is given by the file extension:
+
+- ``.jsonl``: one json record in each line, ``{"type": "exercise", ...}`` or
+  ``{"type": "image", "filename": ..., "sha256": ..., "data": <base64>}``;
+- ``.sqlite``: tables ``exercises`` and ``images`` (see BUNDLE_CREATE).
+
+Each image (same name and contents) is kept once. Bundles are opened for appending:
+many ``siacua`` calls (one for each exercise of a course) go to the same file.
+
+EXAMPLES::
+
+    sage: from megua.siacuabundle import open_bundle
+    sage: import tempfile, os
+    sage: d = tempfile.mkdtemp()
+    sage: fn = os.path.join(d,"a.png")
+    sage: with open(fn,"w") as f: f.write("png data")
+    sage: for ext in ['.jsonl','.sqlite']:
+    ....:     bundle = open_bundle(os.path.join(d,"course"+ext), 'a')
+    ....:     bundle.add(u"http://localhost/MeguaInsert.aspx", None, u"calculo3", u"E12X34_name_001", 10, {'ekey': '10'}, [fn])
+    ....:     bundle.add(u"http://localhost/MeguaInsert.aspx", None, u"calculo3", u"E12X34_name_001", 11, {'ekey': '11'}, [fn])
+    ....:     bundle.close()
+    ....:     bundle = open_bundle(os.path.join(d,"course"+ext))
+    ....:     paths = bundle.extract_images(os.path.join(d,"images"+ext))
+    ....:     print [(e['ekey'], [os.path.basename(paths[tuple(i)]) for i in e['images']]) for e in bundle.exercises()]
+    ....:     bundle.close()
+    [(10, [u'a.png']), (11, [u'a.png'])]
+    [(10, [u'a.png']), (11, [u'a.png'])]
+
+"""
+
+
+#*****************************************************************************
+#  Distributed under the terms of the GNU General Public License (GPL)
+#                  http://www.gnu.org/licenses/
+#*****************************************************************************
+
+
+#PYTHON modules
+import os
+import json
+import base64
+import sqlite3
+
+#MEGUA modules
+from megua.siacuastore import file_sha256
+
+
+BUNDLE_CREATE = [
+    """CREATE TABLE IF NOT EXISTS exercises (
+        bundle_id INTEGER PRIMARY KEY,
+        target TEXT,
+        imagesurl TEXT,
+        course TEXT,
+        exname TEXT,
+        ekey INTEGER,
+        send_dict TEXT,
+        images TEXT )""",
+    """CREATE TABLE IF NOT EXISTS images (
+        filename TEXT,
+        sha256 TEXT,
+        data BLOB,
+        PRIMARY KEY (filename, sha256) )""",
+]
+
+
+def open_bundle(filename, mode='r'):
+    r"""
+    Open a bundle for reading (``mode='r'``) or appending (``mode='a'``).
+
+    The format is given by the extension of ``filename``: ``.jsonl`` or ``.sqlite``.
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == '.jsonl':
+        return JsonlBundle(filename, mode)
+    elif extension in ['.sqlite', '.db']:
+        return SqliteBundle(filename, mode)
+    else:
+        raise ValueError("siacuabundle.py: bundle '%s' must be .jsonl or .sqlite." % filename)
+
+
+
+class SiacuaBundle:
+    r"""
+    Common part of JsonlBundle and SqliteBundle.
+
+    Exercise records are dictionaries with fields ``target``, ``imagesurl``, ``course``,
+    ``exname``, ``ekey``, ``send_dict`` and ``images`` (list of ``[filename, sha256]``).
+    """
+
+    def __init__(self, filename, mode='r'):
+        if mode not in ['r','a']:
+            raise ValueError("siacuabundle.py: mode must be 'r' or 'a'.")
+        self.filename = filename
+        self.mode = mode
+        self.images_kept = set() # (filename, sha256) already in bundle
+
+
+    def __repr__(self):
+        return "%s('%s')" % (self.__class__.__name__, self.filename)
+
+
+    def add(self, target, imagesurl, course, exname, ekey, send_dict, images):
+        r"""
+        Append an instance: ``send_dict`` is the payload (see ``ExSiacua._siacua_json``)
+        and ``images`` the full pathnames of its image files.
+        """
+        assert self.mode == 'a'
+        image_keys = []
+        for pathname in sorted(images):
+            key = (os.path.basename(pathname), file_sha256(pathname))
+            if key not in self.images_kept:
+                with open(pathname,'rb') as f:
+                    self._write_image(key[0], key[1], f.read())
+                self.images_kept.add(key)
+            image_keys.append(list(key))
+
+        self._write_exercise(dict(target=target, imagesurl=imagesurl, course=course,
+                                  exname=exname, ekey=int(ekey), send_dict=send_dict, images=image_keys))
+
+
+    def extract_images(self, directory):
+        r"""
+        Write the images to ``directory/<sha256>/<filename>`` (each directory for one content).
+
+        OUTPUT:
+
+        - dictionary ``(filename, sha256)`` -> full pathname.
+        """
+        paths = dict()
+        for (filename, sha256, data) in self._iter_images():
+            pathname = os.path.join(directory, sha256, filename)
+            if not os.path.exists(pathname):
+                if not os.path.exists(os.path.dirname(pathname)):
+                    os.makedirs(os.path.dirname(pathname))
+                with open(pathname,'wb') as f:
+                    f.write(data)
+            paths[(filename, sha256)] = pathname
+        return paths
+
+
+    def exercises(self):
+        r"""
+        Iterator of the exercise records in the order they were added.
+        """
+        return self._iter_exercises()
+
+
+
+class JsonlBundle(SiacuaBundle):
+    r"""
+    Bundle in a text file with a json record in each line (see module documentation).
+    """
+
+    def __init__(self, filename, mode='r'):
+        SiacuaBundle.__init__(self, filename, mode)
+        if mode == 'a':
+            if os.path.exists(filename):
+                for record in self._iter_records('image'):
+                    self.images_kept.add( (record['filename'], record['sha256']) )
+            self.f = open(filename, 'a')
+        else:
+            self.f = None
+
+
+    def _write(self, record):
+        self.f.write(json.dumps(record, sort_keys=True) + '\n')
+        self.f.flush()
+
+
+    def _write_image(self, filename, sha256, data):
+        self._write(dict(type='image', filename=filename, sha256=sha256, data=base64.b64encode(data)))
+
+
+    def _write_exercise(self, record):
+        record = dict(record)
+        record['type'] = 'exercise'
+        self._write(record)
+
+
+    def _iter_records(self, record_type):
+        with open(self.filename, 'r') as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    if record['type'] == record_type:
+                        yield record
+
+
+    def _iter_images(self):
+        for record in self._iter_records('image'):
+            yield (record['filename'], record['sha256'], base64.b64decode(record['data']))
+
+
+    def _iter_exercises(self):
+        for record in self._iter_records('exercise'):
+            del record['type']
+            yield record
+
+
+    def close(self):
+        if self.f:
+            self.f.close()
+            self.f = None
+
+
+
+class SqliteBundle(SiacuaBundle):
+    r"""
+    Bundle in a sqlite database (see BUNDLE_CREATE).
+    """
+
+    def __init__(self, filename, mode='r'):
+        SiacuaBundle.__init__(self, filename, mode)
+        if mode == 'r' and not os.path.exists(filename):
+            raise IOError("siacuabundle.py: bundle '%s' does not exist." % filename)
+        self.conn = sqlite3.connect(filename)
+        if mode == 'a':
+            for statement in BUNDLE_CREATE:
+                self.conn.execute(statement)
+            self.conn.commit()
+            for row in self.conn.execute("SELECT filename, sha256 FROM images"):
+                self.images_kept.add( (row[0], row[1]) )
+
+
+    def _write_image(self, filename, sha256, data):
+        self.conn.execute("INSERT OR IGNORE INTO images (filename, sha256, data) VALUES (?,?,?)",
+            (filename, sha256, sqlite3.Binary(data)))
+        self.conn.commit()
+
+
+    def _write_exercise(self, record):
+        self.conn.execute("""INSERT INTO exercises (target, imagesurl, course, exname, ekey, send_dict, images)
+            VALUES (?,?,?,?,?,?,?)""",
+            (record['target'], record['imagesurl'], record['course'], record['exname'], record['ekey'],
+             json.dumps(record['send_dict'], sort_keys=True), json.dumps(record['images'])))
+        self.conn.commit()
+
+
+    def _iter_images(self):
+        c = self.conn.cursor()
+        c.execute("SELECT filename, sha256, data FROM images")
+        for row in c:
+            yield (row[0], row[1], str(row[2]))
+        c.close()
+
+
+    def _iter_exercises(self):
+        c = self.conn.cursor()
+        c.execute("""SELECT target, imagesurl, course, exname, ekey, send_dict, images
+            FROM exercises ORDER BY bundle_id""")
+        for row in c:
+            yield dict(target=row[0], imagesurl=row[1], course=row[2], exname=row[3], ekey=row[4],
+                       send_dict=json.loads(row[5]), images=json.loads(row[6]))
+        c.close()
+
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
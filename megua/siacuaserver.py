@@ -0,0 +1,260 @@
+# coding=utf-8
+
+r"""
+siacuaserver -- a local stand-in for the siacua pages used by ``ExSiacua.siacua``.
+
+``SiacuaServer`` answers, like siacua, to:
+
+- ``MeguaInsert.aspx``: form field ``Base64`` with the exercise json (see ``ExSiacua._siacua_send``).
+  The first time an ``(exname, ekey)`` arrives the answer is "Perfeito! Temos um novo exercício! id = N",
+  next times "Muito bem, melhorou o exercício, parabéns! id=N". If the server has a ``key``
+  and ``siacua_key`` is other the answer is "A chave não é válida".
+- ``MeguaInsert2.aspx``: an image file in field ``file`` (see ``ExSiacua._send_image``).
+
+A server with ``encodings`` (like ``['compact','gzip']``) says so in header ``X-Megua-Encoding``
+of its answers and then accepts payloads with field ``Encoding`` and bodies in http chunks
+(see ``exsiacua.siacua_encoding``). Siacua now sends no such header.
+
+What arrives is kept in fields ``exercises`` and ``images``. Field ``connections`` counts
+the accepted connections (with keep-alive it is less than the number of posts). The next
+``failures`` posts are answered with http code 500 (to test posts tried again).
+
+EXAMPLES::
+
+    sage: from megua.siacuaserver import SiacuaServer
+    sage: import requests, base64, json
+    sage: server = SiacuaServer().start()
+    sage: d = {'exname': 'E12X34_name_001', 'ekey': '10', 'siacua_key': 'k'}
+    sage: s = requests.Session()
+    sage: r = s.post(server.url + 'MeguaInsert.aspx', data={'Base64': base64.b64encode(json.dumps(d))})
+    sage: 'novo' in r.text and 'id = 1' in r.text
+    True
+    sage: r = s.post(server.url + 'MeguaInsert.aspx', data={'Base64': base64.b64encode(json.dumps(d))})
+    sage: 'melhorou' in r.text and 'id=1' in r.text
+    True
+    sage: r = s.post(server.url + 'MeguaInsert2.aspx', files={'file': ('calculo3_a.png', 'png data')})
+    sage: server.images
+    {'calculo3_a.png': 'png data'}
+    sage: server.connections
+    1
+    sage: s.close()
+    sage: server.stop()
+
+A server accepting compact payloads::
+
+    sage: import zlib
+    sage: server = SiacuaServer(encodings=['compact','gzip']).start()
+    sage: c = zlib.compressobj(9, zlib.DEFLATED, 31)
+    sage: data = c.compress(json.dumps(d)) + c.flush()
+    sage: r = requests.post(server.url + 'MeguaInsert.aspx', data={'Encoding': 'gzip', 'Base64': base64.b64encode(data)})
+    sage: r.headers['X-Megua-Encoding']
+    'compact, gzip'
+    sage: server.exercises[(u'E12X34_name_001', u'10')][0]
+    1
+    sage: server.stop()
+
+Sending an exercise::
+
+    sage: server = SiacuaServer().start()
+    sage: meg.siacua(ekeys=[1,2,3], targetmachine="siacuatest", targeturl=server.url + 'MeguaInsert.aspx') # not tested
+    sage: server.stop()
+
+"""
+
+
+#*****************************************************************************
+#  Distributed under the terms of the GNU General Public License (GPL)
+#                  http://www.gnu.org/licenses/
+#*****************************************************************************
+
+
+#PYTHON modules
+import BaseHTTPServer
+import SocketServer
+import threading
+import socket
+import base64
+import json
+import cgi
+import zlib
+import urlparse
+
+
+PAGE = u"""<form name="form1" method="post" action="./MeguaInsert.aspx" id="form1">
+        exname: <span id="lexname">{exname}</span>  ekey:  <span id="lekey">{ekey}</span>
+        &nbsp;
+        Resultado: <span id="resultado">{resultado}</span>
+        <br />
+    </form>"""
+
+
+
+class SiacuaHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    r"""
+    Requests to ``SiacuaServer``.
+    """
+
+    #Keep-alive like IIS.
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+            self.server.open_sockets.add(self.connection)
+
+
+    def finish(self):
+        with self.server.lock:
+            self.server.open_sockets.discard(self.connection)
+        BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+
+
+    def do_POST(self):
+        if self.headers.get('Transfer-Encoding','').lower() == 'chunked':
+            form = dict( (k,v[0]) for (k,v) in urlparse.parse_qs(self.read_chunked()).items() )
+        else:
+            fields = cgi.FieldStorage(fp=self.rfile, headers=self.headers,
+                                      environ={'REQUEST_METHOD': 'POST',
+                                               'CONTENT_TYPE': self.headers['Content-Type']})
+            form = dict( (k,fields[k]) for k in fields.keys() )
+            for (k,v) in form.items():
+                if not v.filename:
+                    form[k] = v.value
+        if self.server.fail():
+            self.reply(500, u"Server Error")
+            return
+        page = self.path.split('?')[0].rsplit('/',1)[-1]
+        if page == 'MeguaInsert.aspx' and 'Base64' in form:
+            self.reply(200, self.server.insert(form['Base64'], form.get('Encoding')))
+        elif page == 'MeguaInsert2.aspx' and 'file' in form:
+            item = form['file']
+            self.server.insert_image(item.filename, item.value)
+            self.reply(200, u"ok")
+        else:
+            self.reply(404, u"Not found")
+
+
+    def read_chunked(self):
+        r"""Body sent with http chunked transfer."""
+        chunks = []
+        while True:
+            size = int(self.rfile.readline().split(';')[0].strip(), 16)
+            if size == 0:
+                while self.rfile.readline().strip(): #trailer
+                    pass
+                return ''.join(chunks)
+            chunks.append(self.rfile.read(size))
+            self.rfile.readline() #CRLF
+
+
+    def reply(self, code, text):
+        body = text.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        if self.server.encodings:
+            self.send_header('X-Megua-Encoding', ', '.join(self.server.encodings))
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        pass #quiet
+
+
+
+class SiacuaServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    r"""
+    Local http server answering like siacua (see module documentation).
+    """
+
+    daemon_threads = True
+
+    def __init__(self, port=0, key=None, encodings=None):
+        r"""
+        INPUT:
+
+        - ``port`` -- (usually 0: any free port) port on localhost.
+        - ``key`` -- None (any ``siacua_key`` is valid) or the valid ``siacua_key``.
+        - ``encodings`` -- None (like siacua) or payload encodings accepted besides the original ("compact", "gzip").
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), SiacuaHandler)
+        self.key = key
+        self.encodings = encodings or []
+        self.lock = threading.Lock()
+        self.exercises = dict() # (exname,ekey) -> (id, send_dict)
+        self.images = dict() # filename -> contents
+        self.connections = 0
+        self.open_sockets = set()
+        self.failures = 0
+        self.thread = None
+
+
+    @property
+    def url(self):
+        return "http://%s:%d/" % self.server_address
+
+
+    def start(self):
+        r"""Serve in a thread. Returns the server."""
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        with self.lock:
+            #connections kept alive
+            for sock in self.open_sockets:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+
+    def fail(self):
+        r"""True if this post must fail (see ``failures``)."""
+        with self.lock:
+            if self.failures > 0:
+                self.failures -= 1
+                return True
+        return False
+
+
+    def insert(self, base64_send_dict, encoding=None):
+        r"""
+        Keep an exercise and return siacua message.
+        """
+        data = base64.b64decode(base64_send_dict)
+        if encoding == 'gzip':
+            data = zlib.decompress(data, 16+zlib.MAX_WBITS)
+        send_dict = json.loads(data)
+        exname = send_dict.get('exname', u'')
+        ekey = send_dict.get('ekey', u'')
+
+        if self.key is not None and send_dict.get('siacua_key') != self.key:
+            resultado = u"A chave não é válida."
+        else:
+            with self.lock:
+                if (exname,ekey) in self.exercises:
+                    exid = self.exercises[(exname,ekey)][0]
+                    resultado = u"Muito bem, melhorou o exercício, parabéns! id=%d" % exid
+                else:
+                    exid = len(self.exercises)+1
+                    resultado = u"Perfeito! Temos um novo exercício! id = %d" % exid
+                self.exercises[(exname,ekey)] = (exid, send_dict)
+
+        return PAGE.format(exname=exname, ekey=ekey, resultado=resultado)
+
+
+    def insert_image(self, filename, contents):
+        with self.lock:
+            self.images[filename] = contents
+
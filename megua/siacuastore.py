@@ -0,0 +1,274 @@
+# coding=utf-8
+
+r"""
+siacuastore -- what was already accepted by siacua/pmate and what waits to be sent.
+
+A ``SiacuaStore`` is a small sqlite database, apart from the exercise database,
+because it records the state of the remote machines and not of the exercises.
+
+Table ``uploads`` is the manifest of images: for each ``(course, target, filename)``
+the sha256 of the file accepted by the server. ``siacua_post_image`` (see exsiacua.py)
+does not post a file whose hash is already there (unless ``force=True``).
+``target`` is the url where images are posted so siacua, siacuatest and a local
+test server (see ``siacuaserver``) have separate manifests.
+
+Table ``outbox`` keeps the exercise instances prepared by ``ExSiacua.siacua``
+(the json sent and the image files) until the server accepts them. There is one row
+for each ``(target, exname, ekey)``: preparing the same instance again replaces the
+row and sending it again is harmless (siacua answers "melhorou"). Rows that could
+not be sent stay ``pending`` and ``MegSiacua.siacua_resume`` sends them without
+generating the instances again.
+
+EXAMPLES::
+
+    sage: from megua.siacuastore import SiacuaStore, file_sha256
+    sage: import tempfile, os
+    sage: store = SiacuaStore(os.path.join(tempfile.mkdtemp(),"siacua.sqlite"))
+    sage: fn = os.path.join(tempfile.mkdtemp(),"a.png")
+    sage: with open(fn,"w") as f: f.write("png data")
+    sage: h = file_sha256(fn)
+    sage: store.uploaded(u"calculo3", u"http://localhost/MeguaInsert2.aspx", u"calculo3_a.png", h)
+    False
+    sage: store.record_upload(u"calculo3", u"http://localhost/MeguaInsert2.aspx", u"calculo3_a.png", h)
+    sage: store.uploaded(u"calculo3", u"http://localhost/MeguaInsert2.aspx", u"calculo3_a.png", h)
+    True
+    sage: store.forget_uploads(course=u"calculo3")
+    1
+    sage: row = store.outbox_put(u"http://localhost/MeguaInsert.aspx", None, u"calculo3", u"E12X34_name_001", 10, {'ekey': '10'}, [])
+    sage: row = store.outbox_put(u"http://localhost/MeguaInsert.aspx", None, u"calculo3", u"E12X34_name_001", 10, {'ekey': '10'}, [])
+    sage: [(r['exname'], r['ekey'], r['status']) for r in store.outbox_pending()]
+    [(u'E12X34_name_001', 10, u'pending')]
+    sage: [r['ekey'] for r in store.outbox_pending(ids=[row['outbox_id']])], store.outbox_pending(ids=[])
+    ([10], [])
+    sage: store.outbox_sent(row['outbox_id'], ["New: 1"])
+    sage: store.outbox_pending()
+    []
+
+"""
+
+
+#*****************************************************************************
+#  Distributed under the terms of the GNU General Public License (GPL)
+#                  http://www.gnu.org/licenses/
+#*****************************************************************************
+
+
+#PYTHON modules
+import os
+import json
+import sqlite3
+import hashlib
+import threading
+
+
+UPLOADS_CREATE = """CREATE TABLE IF NOT EXISTS uploads (
+    course TEXT,
+    target TEXT,
+    filename TEXT,
+    sha256 TEXT,
+    uploaded_at TEXT,
+    PRIMARY KEY (course, target, filename) )"""
+
+#Status: 'pending' (waits to be sent) or 'sent'. ``send_dict`` and ``images`` (full pathnames) in json.
+OUTBOX_CREATE = """CREATE TABLE IF NOT EXISTS outbox (
+    outbox_id INTEGER PRIMARY KEY,
+    target TEXT,
+    exname TEXT,
+    ekey INTEGER,
+    imagesurl TEXT,
+    course TEXT,
+    send_dict TEXT,
+    images TEXT,
+    status TEXT,
+    attempts INTEGER DEFAULT 0,
+    last_error TEXT,
+    result TEXT,
+    queued_at TEXT,
+    sent_at TEXT,
+    UNIQUE (target, exname, ekey) )"""
+
+
+def file_sha256(pathname):
+    """
+    Hexadecimal sha256 of the contents of file ``pathname``.
+    """
+    h = hashlib.sha256()
+    with open(pathname,'rb') as f:
+        for block in iter(lambda: f.read(65536), ''):
+            h.update(block)
+    return h.hexdigest()
+
+
+
+class SiacuaStore:
+    r"""
+    Manifest of uploads and outbox of siacua/pmate (see module documentation).
+
+    One connection shared by all threads (``ExSiacua.siacua`` posts in a
+    pool of threads) with ``self.lock``.
+    """
+
+    def __init__(self,filename):
+        self.filename = filename
+        dirname = os.path.dirname(filename)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(filename,check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self.lock:
+            self.conn.execute(UPLOADS_CREATE)
+            self.conn.execute(OUTBOX_CREATE)
+            self.conn.commit()
+
+
+    def __repr__(self):
+        return "SiacuaStore('%s')" % self.filename
+
+
+    def uploaded(self,course,target,filename,sha256):
+        """
+        True if file ``filename`` with hash ``sha256`` was accepted by ``target``.
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT sha256 FROM uploads WHERE course=? AND target=? AND filename=?",
+                (course,target,filename)).fetchone()
+        return row is not None and row['sha256'] == sha256
+
+
+    def record_upload(self,course,target,filename,sha256):
+        """
+        Keep that ``target`` accepted ``filename`` with hash ``sha256``.
+        """
+        with self.lock:
+            self.conn.execute("""INSERT OR REPLACE INTO uploads (course, target, filename, sha256, uploaded_at)
+                VALUES (?,?,?,?,datetime('now'))""", (course,target,filename,sha256))
+            self.conn.commit()
+
+
+    def forget_uploads(self,course=None,target=None):
+        """
+        Remove records of uploads (all or of a ``course`` and/or ``target``) so files are sent again.
+
+        OUTPUT:
+
+        - number of records removed.
+        """
+        conditions = []
+        values = []
+        if course is not None:
+            conditions.append("course=?")
+            values.append(course)
+        if target is not None:
+            conditions.append("target=?")
+            values.append(target)
+        sql = "DELETE FROM uploads"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        with self.lock:
+            n = self.conn.execute(sql,values).rowcount
+            self.conn.commit()
+        return n
+
+
+    def outbox_put(self,target,imagesurl,course,exname,ekey,send_dict,images):
+        """
+        Keep an instance to be sent to ``target`` (replacing the one with same ``exname`` and ``ekey``).
+
+        OUTPUT:
+
+        - the outbox row.
+        """
+        key = (target,exname,int(ekey))
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("INSERT OR IGNORE INTO outbox (target, exname, ekey) VALUES (?,?,?)", key)
+            c.execute("""UPDATE outbox SET imagesurl=?, course=?, send_dict=?, images=?, status='pending', 
+                attempts=0, last_error=NULL, result=NULL, queued_at=datetime('now'), sent_at=NULL 
+                WHERE target=? AND exname=? AND ekey=?""",
+                (imagesurl, course, json.dumps(send_dict, sort_keys=True), json.dumps(sorted(images))) + key)
+            c.execute("SELECT * FROM outbox WHERE target=? AND exname=? AND ekey=?", key)
+            row = c.fetchone()
+            self.conn.commit()
+            c.close()
+        return row
+
+
+    def outbox_pending(self,target=None,exname=None,ids=None):
+        """
+        Rows waiting to be sent (only to ``target``, of exercise ``exname`` or with
+        ``outbox_id`` in list ``ids`` if given) in the order they came.
+        """
+        conditions = ["status='pending'"]
+        values = []
+        if target is not None:
+            conditions.append("target=?")
+            values.append(target)
+        if exname is not None:
+            conditions.append("exname=?")
+            values.append(exname)
+        with self.lock:
+            rows = self.conn.execute("SELECT * FROM outbox WHERE %s ORDER BY outbox_id" % " AND ".join(conditions),
+                values).fetchall()
+        if ids is not None:
+            #not in sql: a bundle could have more rows than sqlite parameters
+            ids = set(ids)
+            rows = [row for row in rows if row['outbox_id'] in ids]
+        return rows
+
+
+    def outbox_sent(self,outbox_id,result):
+        """
+        Row ``outbox_id`` was accepted; ``result`` is what the server answered (a list).
+        """
+        with self.lock:
+            self.conn.execute("""UPDATE outbox SET status='sent', attempts=attempts+1, last_error=NULL, 
+                result=?, sent_at=datetime('now') WHERE outbox_id=?""", (json.dumps(result),outbox_id))
+            self.conn.commit()
+
+
+    def outbox_failed(self,outbox_id,error):
+        """
+        Row ``outbox_id`` could not be sent (it stays pending).
+        """
+        with self.lock:
+            self.conn.execute("UPDATE outbox SET attempts=attempts+1, last_error=? WHERE outbox_id=?",
+                (error,outbox_id))
+            self.conn.commit()
+
+
+    def outbox_forget(self,status='sent'):
+        """
+        Remove rows of the outbox with ``status`` (all if None).
+
+        OUTPUT:
+
+        - number of rows removed.
+        """
+        with self.lock:
+            if status is None:
+                n = self.conn.execute("DELETE FROM outbox").rowcount
+            else:
+                n = self.conn.execute("DELETE FROM outbox WHERE status=?", (status,)).rowcount
+            self.conn.commit()
+        return n
+
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+
+_default_store = None
+
+def siacua_store():
+    """
+    The SiacuaStore in MEGUA_SIACUA_STORE (see megoptions).
+    """
+    global _default_store
+    if _default_store is None:
+        from megua.megoptions import MEGUA_SIACUA_STORE
+        _default_store = SiacuaStore(MEGUA_SIACUA_STORE)
+    return _default_store
+
@@ -67,6 +67,23 @@ MEGUA_EXERCISE_CATALOGS=os.path.join(os.environ["HOME"],"CATALOGOS")
 MEGUA_WORKDIR  = ".OUTPUT"
 MEGUA_WORKDIR_FULLPATH = os.path.join(os.environ["HOME"],MEGUA_EXERCISE_INPUT,MEGUA_WORKDIR)
 
+# Cache of generated files (latex images, ...). Optional: these are the defaults.
+#MEGUA_CACHE_DIR = os.path.join(MEGUA_WORKDIR_FULLPATH,"_cache")
+#MEGUA_CACHE_MAXSIZE = 500*1024*1024 #bytes
+
+# Compile LaTeX with preambles preloaded in TeX formats (needs package mylatexformat).
+#MEGUA_LATEX_FORMATS = True
+
+# Database connections: WAL lets catalogs, previews and searches read while other process writes.
+#MEGUA_SQLITE_PRAGMAS = {'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'mmap_size': 268435456, 'cache_size': -20000}
+
+# Simultaneous posts (exercises and images) when sending to siacua/pmate.
+#MEGUA_SIACUA_UPLOADS = 4
+#MEGUA_SIACUA_RETRIES = 4
+#MEGUA_SIACUA_BACKOFF = 1.0 #seconds
+#MEGUA_SIACUA_COMPACT = False #always the original payload format
+#MEGUA_SIACUA_STORE = os.path.join(MEGUA_WORKDIR_FULLPATH,"_siacua.sqlite")
+
 """
 ####################
 # Use only when "siacua" system http://siacua.web.ua.pt/ is used.     
@@ -175,7 +175,8 @@ from sage.all import * #All Sage Graphics
 
 #MEGUA modules
 from megua.jinjatemplates import templates
-from megua.platex import pcompile
+from megua.platex import pcompile, LatexError
+from megua.diskcache import megua_cache
 
 #PYTHON modules
 #import io
@@ -189,6 +190,12 @@ import PIL.Image
 
 import re
 import subprocess
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+
+#Maximum number of <latex> blocks compiled at the same time (see latex_render).
+LATEX_RENDER_WORKERS = multiprocessing.cpu_count()
 
 
 
@@ -419,6 +426,50 @@ class UnifiedGraphics:
         return self._render(gfilename,paper_cm,scr_pixels)
 
 
+    def _latex_image(self,job):
+        """
+        Make the png image of one <latex> block (see ``latex_render``). 
+
+        INPUT:
+
+        - `job` -- (gfilename_base, gfilename, resize, latex_document)
+
+        OUTPUT:
+
+        - None or the ``LatexError`` (reported by ``latex_render``).
+        """
+
+        (gfilename_base, gfilename, resize, latex_document) = job
+
+        #The same document and resize give the same image (see diskcache.py).
+        cache = megua_cache()
+        cache_key = cache.key("latex_render",latex_document,resize)
+        pathname = os.path.join(self.wd_fullpath,gfilename)
+
+        if cache.fetch(cache_key,'.png',pathname):
+            return None
+
+        try:
+            pcompile(latex_document,self.wd_fullpath,gfilename,verbose=False)
+        except LatexError as err:
+            return err
+
+        #An old png could be a hard link to a cached file: convert must not write on it.
+        if os.path.exists(pathname):
+            os.remove(pathname)
+
+        cmd = "cd {2};convert -density 100x100 '{0}.pdf' -quality 95 -resize {1} '{0}.png' 2>/dev/null".format(
+            gfilename_base,resize,self.wd_fullpath)
+
+        #TODO: check that "convert" is installed
+        os.system(cmd)
+
+        if os.path.exists(pathname):
+            cache.store(cache_key,'.png',pathname)
+
+        return None
+
+
     def latex_render(self,input_text):
         """Returns a new text obtained by transforming `input_text`: 
         * all tag pairs <latex percent%> ... </latex> that 
@@ -436,6 +487,8 @@ class UnifiedGraphics:
         NOTE:
 
         - Dimensions are specifyed in each <latex tag> and not in dimx=150,dimy=150.
+        - Images are kept in ``megua_cache()`` (see diskcache.py): a document already 
+          compiled, with the same resize, is not compiled again.
 
         DEVELOPER NOTES:
 
@@ -475,73 +528,59 @@ class UnifiedGraphics:
         latex_pattern = re.compile(r'<\s*latex\s+(\d+%)\s*>(.+?)<\s*/latex\s*>', re.DOTALL|re.UNICODE)
         latex_error_pattern = re.compile(r"!.*?l\.(\d+)(.*?)$",re.DOTALL|re.M)
 
-        #Cycle through existent latex code and produce pdf and png files.
-        graphic_number = 0
+        #Each <latex> block is a job: (gfilename_base, gfilename, resize, latex_document).
+        jobs = []
         match_iter = re.finditer(latex_pattern,input_text)#create an iterator
         for match in match_iter:
             #Graphic filename
+            graphic_number = len(jobs)
             gfilename_base = '%s-%d-%02d'%(self.unique_name(),self.get_ekey(),graphic_number)
             gfilename      = '%s-%d-%02d.png'%(self.unique_name(),self.get_ekey(),graphic_number)
 
             #Compile what is inside <latex>...</latex> to a image
             latex_source = match.group(2)
 
-            try:
-
-                latex_document = templates.render("standalone_latex.tex",
-                                gfilename=gfilename,
-                                latex_source=latex_source)
-                pcompile(latex_document,self.wd_fullpath,gfilename)
-
-                cmd = "cd {2};convert -density 100x100 '{0}.pdf' -quality 95 -resize {1} '{0}.png' 2>/dev/null".format(
-                    gfilename_base,match.group(1),self.wd_fullpath)
-
-
-                #TODO: check that "convert" is installed
-                os.system(cmd)
+            latex_document = templates.render("standalone_latex.tex",
+                            gfilename=gfilename,
+                            latex_source=latex_source)
 
-                graphic_number += 1
+            jobs.append( (gfilename_base, gfilename, match.group(1), latex_document) )
 
-            except subprocess.CalledProcessError as err:
-
-                # ==============================
-                #TODO: modify this for standalone package:
-                # ==============================
-
-                #Try to show the message to user
-                #print "Error:",err
-                #print "returncode:",err.returncode
-                #print "output:",err.output
-                #print "================"
-                match = latex_error_pattern.search(err.output) #create an iterator
-                if match:
-                    print match.group(0)
-                else:
-                    print "There was a problem with an latex image file."
-
-                #TODO: check this code below:
-                #if latex inside codemirror does not work
-                #this is the best choice: 
-                #print "You can download %s.tex and use your windows LaTeX editor to help find the error." % gfilename
-#                os.system("mv _images/%s.tex ." % gfilename)
-#
-#                #Using HTML and CodeMirror to show the error.
-#                print "You can open %s.html to help debuging." % gfilename
-#                tikz_html = templates.render("latex_viewer.html", 
-#                                pgfrealjobname=r"\pgfrealjobname{%s}"%self.name, 
-#                                beginname=r"\beginpgfgraphicnamed{%s}"%gfilename, 
-#                                tikz_tex=tikz_tex,
-#                                sname=self.name,
-#                                errmessage=match.group(0),
-#                                linenum=match.group(1)
-#                                )
-#
-#                f = codecs.open(gfilename+'.html', mode='w', encoding='utf-8')
-#                f.write(tikz_html)
-#                f.close()
-#                print "================"
+        #Produce pdf and png files: blocks are compiled at the same time.
+        if len(jobs) > 1:
+            pool = ThreadPool(min(len(jobs),LATEX_RENDER_WORKERS))
+            try:
+                errors = pool.map(self._latex_image, jobs)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            errors = [self._latex_image(job) for job in jobs]
+
+        #Report errors of each block
+        for (job,err) in zip(jobs,errors):
+            if err is None:
+                continue
+
+            print 'LaTeX error in image "%s" (see %s):' % (job[1],err.filename)
+            match = latex_error_pattern.search(err.output) 
+            if match:
+                print match.group(0)
+            else:
+                print "There was a problem with an latex image file."
+
+            #TODO: check this code below:
+            #if latex inside codemirror does not work
+            #this is the best choice: 
+            #print "You can download %s.tex and use your windows LaTeX editor to help find the error." % gfilename
+            #Using HTML and CodeMirror to show the error: see template latex_viewer.html.
+
+        for err in errors:
+            if err is not None:
                 raise err
 
+        graphic_number = len(jobs)
+
 
         #Cycle through existent tikz code and produce a new html string .
         new_text = input_text